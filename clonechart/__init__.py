@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+clonechart makes clone distribution charts of ImmuneDB databases: how many clones every subject has, and how they are divided among
+the metadata of its samples.
+
+    import clonechart
+    with clonechart.Connection(database='lp15', user='username', password='password', ssh_host='10.0.0.1', ssh_username='username', ssh_password='password') as connection:
+        clonechart.make_clone_distribution_chart(None, None, None, 'tissue', 'None', 'chart.html', {}, connection=connection)
+
+The connection is only opened when data is downloaded, and plotly is only imported when a chart is rendered.
+"""
+
+from .aggregate import SubjectSummary, summarize_subject
+from .batch import run_batch
+from .benchmark import run_benchmark
+from .chart import load_tables, make_clone_distribution_chart
+from .connection import Connection, as_connection
+from .instrument import run_report
+from .metadata import build_sample_metadata, get_metadata_labels
+from .service import ChartService
+from .summary import read_chart_summary, render_chart_summary, write_chart_summary
+from .synthetic import make_synthetic_immunedb
+
+__all__ = ['ChartService', 'Connection', 'SubjectSummary', 'as_connection', 'build_sample_metadata', 'get_metadata_labels', 'load_tables',
+           'make_clone_distribution_chart', 'make_synthetic_immunedb', 'read_chart_summary', 'render_chart_summary', 'run_batch', 'run_benchmark', 'run_report',
+           'summarize_subject', 'write_chart_summary']
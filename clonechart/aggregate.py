@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Counting of the clones of a subject for its subplot, with the "pandas" engine (a sparse clones x samples matrix) or the "sql" engine
+(distinct counts computed inside the database).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sqlalchemy import bindparam, text
+
+from .connection import as_connection
+from .instrument import get_frame_bytes, measure_stage
+from .loading import load_clone_membership
+from .metadata import get_x_axis_values, map_samples_to_values
+
+
+###Sparse clones x samples matrix of one subject. matrix[i, j] is True when clone clone_ids[i] is found in sample sample_ids[j].
+CloneMatrix = namedtuple('CloneMatrix', ['matrix', 'clone_ids', 'sample_ids'])
+
+###Build the CloneMatrix of a subject from its (sample_id, clone_id) pairs.
+def build_clone_matrix(df):
+    clone_codes, clone_ids = pd.factorize(df['clone_id'], sort=True)
+    sample_codes, sample_ids = pd.factorize(df['sample_id'], sort=True)
+    matrix = sparse.csc_matrix((np.ones(len(df), dtype=bool), (clone_codes, sample_codes)), shape=(len(clone_ids), len(sample_ids)))
+    return CloneMatrix(matrix, np.asarray(clone_ids), np.asarray(sample_ids))
+
+###Samples x groups indicator matrix from (sample_id, pos) rows, such as the ones made by map_samples_to_values.
+###Samples without clones are not in the CloneMatrix and are left out.
+def get_sample_groups(clone_matrix, sample_positions, num_groups):
+    rows = pd.Index(clone_matrix.sample_ids).get_indexer(sample_positions['sample_id'])
+    keep = rows >= 0
+    return sparse.csr_matrix((np.ones(keep.sum(), dtype=np.int32), (rows[keep], sample_positions['pos'].to_numpy()[keep])), shape=(len(clone_matrix.sample_ids), num_groups))
+
+###Clones x groups matrix that is True when a clone is in any sample of the group (an OR over the group's columns).
+def get_group_clones(clone_matrix, groups):
+    return (clone_matrix.matrix.astype(np.int32) @ groups) > 0
+
+###Number of clones that each pair of labels (values of key) shares, from a single sparse matrix product. The diagonal is the number of clones of each label.
+def build_overlap_matrix(clone_matrix, sample_metadata, key, labels, sample_ids):
+    groups = get_sample_groups(clone_matrix, map_samples_to_values(sample_metadata, key, labels, sample_ids), len(labels))
+    group_clones = get_group_clones(clone_matrix, groups).astype(np.int32)
+    overlap = (group_clones.T @ group_clones).toarray()
+    return pd.DataFrame(overlap, index=labels, columns=labels)
+
+###Cells of the graph of one subject, one per (x value, y label) in x-major order, and the samples of every cell.
+###cell_samples has one row per (sample_id, x_pos, y_pos, pos), where pos is the position of the cell in cells. num_samples is the number of samples of every cell.
+CellSamples = namedtuple('CellSamples', ['cells', 'cell_samples', 'x_axis_values_sorted', 'y_labels', 'num_samples'])
+
+###Map every sample of a subject once to the (x, y) cells it belongs to. The cells are the same for all the aggregation engines.
+def get_cell_samples(sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list):
+    use_x = x_axis_input != 'None'
+    use_y = len(total_tissue_list) > 0 or not use_x
+    
+    ###get the sample_ids that belong to each x position and each y position
+    if use_x:
+        ###pod and timepoint values are matched with their label as it appears in the metadata table
+        x_match_values = [x_axis_values_unedited_sorted[x_axis_values_sorted.index(x)] for x in x_axis_values_sorted]
+        x_samples = map_samples_to_values(sample_metadata, x_axis_input, x_match_values, sample_ids).rename(columns={'pos': 'x_pos'})
+        x_positions = range(len(x_axis_values_sorted))
+    else:
+        x_positions = [0]
+    if use_y:
+        y_samples = map_samples_to_values(sample_metadata, y_axis_key, list(total_tissue_list), sample_ids).rename(columns={'pos': 'y_pos'})
+        y_labels = list(total_tissue_list)
+    else:
+        y_labels = [""]
+    
+    ###assign every sample to its cells
+    if use_x and use_y:
+        cell_samples = x_samples.merge(y_samples, on='sample_id')
+    elif use_x:
+        cell_samples = x_samples.assign(y_pos=0)
+    else:
+        cell_samples = y_samples.assign(x_pos=0)
+    cells = pd.MultiIndex.from_product([x_positions, range(len(y_labels))], names=['x_pos', 'y_pos'])
+    cell_samples = cell_samples.assign(pos=cells.get_indexer(pd.MultiIndex.from_frame(cell_samples[['x_pos', 'y_pos']])))
+    
+    ###count the samples of every cell. When both axes are used, this is the number of samples that have either value.
+    if use_x and use_y:
+        x_counts = x_samples.groupby('x_pos')['sample_id'].nunique().reindex(cells.get_level_values('x_pos'), fill_value=0).to_numpy()
+        y_counts = y_samples.groupby('y_pos')['sample_id'].nunique().reindex(cells.get_level_values('y_pos'), fill_value=0).to_numpy()
+        both_counts = cell_samples.groupby(['x_pos', 'y_pos'])['sample_id'].nunique().reindex(cells, fill_value=0).to_numpy()
+        num_samples = (x_counts + y_counts - both_counts).tolist()
+    else:
+        num_samples = cell_samples.groupby(['x_pos', 'y_pos'])['sample_id'].nunique().reindex(cells, fill_value=0).tolist()
+    return CellSamples(cells, cell_samples, x_axis_values_sorted, y_labels, num_samples)
+
+###The dataframe for the graph of one subject, from the number of distinct clones of every cell of cell_samples and of the whole subject.
+def make_distribution_chart(cell_samples, cell_clones, total_clones):
+    if total_clones > 0:
+        num_clones = (np.asarray(cell_clones) / total_clones * 100).tolist()
+    else:
+        num_clones = [0 for x in range(len(cell_samples.cells))]
+    distribution_chart = pd.DataFrame()
+    distribution_chart['x_axis'] = [cell_samples.x_axis_values_sorted[x] for x, y in cell_samples.cells]
+    distribution_chart['num_clones'] = num_clones
+    distribution_chart['y_axis'] = [cell_samples.y_labels[y] for x, y in cell_samples.cells]
+    distribution_chart['num_samples'] = cell_samples.num_samples
+    return distribution_chart
+
+###Build the dataframe for the graph of one subject from its CloneMatrix. This is the "pandas" aggregation engine.
+###Every sample is mapped once to the (x, y) cells it belongs to, and the distinct clones of all the cells are counted
+###with one OR reduction of the matrix columns of each cell.
+def build_distribution_chart(clone_matrix, sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list):
+    cell_samples = get_cell_samples(sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list)
+    ###count the distinct clones of every cell at once
+    groups = get_sample_groups(clone_matrix, cell_samples.cell_samples, len(cell_samples.cells))
+    cell_clones = get_group_clones(clone_matrix, groups).getnnz(axis=0)
+    return make_distribution_chart(cell_samples, cell_clones, len(clone_matrix.clone_ids))
+
+###Build the dataframe for the graph of one subject inside the database. This is the "sql" aggregation engine.
+###Only the distinct clone counts per (x value, y value), the subject's total clone count and the sample counts are downloaded, instead of every sequence.
+###Samples are matched to the axis values (values of x_axis_input and y_axis_key) like build_distribution_chart does, so both engines give the same dataframe.
+###clone_source is the table the clones are counted in ("sequences" or "clone_stats").
+###Returns the dataframe and the total number of clones of the subject.
+def build_distribution_chart_sql(sql_engine, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list, clone_source='sequences'):
+    use_x = x_axis_input != 'None'
+    use_y = len(total_tissue_list) > 0 or not use_x
+    sample_ids = sorted(int(x) for x in sample_ids)
+    ###pod and timepoint values are matched with their label as it appears in the metadata table
+    x_match_values = [str(x_axis_values_unedited_sorted[x_axis_values_sorted.index(x)]) for x in x_axis_values_sorted]
+    y_match_values = [str(y) for y in total_tissue_list]
+    
+    ###the metadata tables are joined once for each axis that is used
+    joins = []
+    where = ["s.clone_id IS NOT NULL", "s.sample_id IN :sample_ids"]
+    group_by = []
+    params = {'sample_ids': sample_ids}
+    if use_x:
+        joins.append("JOIN sample_metadata mx ON mx.sample_id = s.sample_id AND mx.`key` = :x_key")
+        where.append("mx.value IN :x_values")
+        group_by.append("mx.value")
+        params['x_values'] = x_match_values
+    if use_y:
+        joins.append("JOIN sample_metadata my ON my.sample_id = s.sample_id AND my.`key` = :y_key")
+        where.append("my.value IN :y_values")
+        group_by.append("my.value")
+        params['y_values'] = y_match_values
+    
+    if len(sample_ids) == 0 or (use_x and len(x_match_values) == 0) or (use_y and len(y_match_values) == 0):
+        cell_clones = {}
+    else:
+        query = text("select {}, count(distinct s.clone_id) as num_clones from {} s {} where {} group by {}".format(
+            ", ".join(group_by), clone_source, " ".join(joins), " and ".join(where), ", ".join(group_by)))
+        query = query.bindparams(*[bindparam(x, expanding=True) for x in params])
+        if use_x:
+            params['x_key'] = x_axis_input
+        if use_y:
+            params['y_key'] = y_axis_key
+        cell_counts = pd.read_sql_query(query, sql_engine, params=params)
+        cell_clones = {tuple(row[:-1]): row[-1] for row in cell_counts.itertuples(index=False)}
+    
+    ###get the number of clones for the whole subject
+    if len(sample_ids) > 0:
+        query = text("select count(distinct clone_id) as num_clones from {} where clone_id IS NOT NULL and sample_id IN :sample_ids".format(clone_source)).bindparams(bindparam('sample_ids', expanding=True))
+        total_clones = int(pd.read_sql_query(query, sql_engine, params={'sample_ids': sample_ids})['num_clones'].iloc[0])
+    else:
+        total_clones = 0
+    
+    ###count the samples that belong to each value, and to each pair of values. This only touches the sample_metadata table.
+    value_samples = {}
+    pair_samples = {}
+    value_conditions = []
+    params = {'sample_ids': sample_ids}
+    if use_x and len(x_match_values) > 0:
+        value_conditions.append("(`key` = :x_key and value IN :x_values)")
+        params.update({'x_key': x_axis_input, 'x_values': x_match_values})
+    if use_y and len(y_match_values) > 0:
+        value_conditions.append("(`key` = :y_key and value IN :y_values)")
+        params.update({'y_key': y_axis_key, 'y_values': y_match_values})
+    if len(sample_ids) > 0 and len(value_conditions) > 0:
+        query = text("select `key`, value, count(distinct sample_id) as num_samples from sample_metadata where sample_id IN :sample_ids and ({}) group by `key`, value".format(" or ".join(value_conditions)))
+        query = query.bindparams(*[bindparam(x, expanding=True) for x in ('sample_ids', 'x_values', 'y_values') if x in params])
+        value_counts = pd.read_sql_query(query, sql_engine, params=params)
+        value_samples = {(key, value): n for key, value, n in value_counts.itertuples(index=False)}
+        if use_x and use_y and len(value_conditions) == 2:
+            query = text("select mx.value as x_value, my.value as y_value, count(distinct mx.sample_id) as num_samples from sample_metadata mx "
+                         "join sample_metadata my on my.sample_id = mx.sample_id and my.`key` = :y_key where mx.sample_id IN :sample_ids and mx.`key` = :x_key and mx.value IN :x_values and my.value IN :y_values group by mx.value, my.value")
+            query = query.bindparams(bindparam('sample_ids', expanding=True), bindparam('x_values', expanding=True), bindparam('y_values', expanding=True))
+            pair_counts = pd.read_sql_query(query, sql_engine, params=params)
+            pair_samples = {(x, y): n for x, y, n in pair_counts.itertuples(index=False)}
+    
+    ###lay out the cells in the same order as build_distribution_chart
+    num_clones = []
+    x_axis_list = []
+    y_axis_list = []
+    num_samples = []
+    for x_value, x_match in zip(x_axis_values_sorted, x_match_values if use_x else [None for x in x_axis_values_sorted]):
+        for y_value in (total_tissue_list if use_y else [""]):
+            y_match = str(y_value) if use_y else None
+            cell = tuple(x for x in (x_match, y_match) if x is not None)
+            if total_clones > 0:
+                num_clones.append(int(cell_clones.get(cell, 0))/total_clones * 100)
+            else:
+                num_clones.append(0)
+            y_axis_list.append(y_value)
+            x_axis_list.append(x_value)
+            if use_x and use_y:
+                ###number of samples that have either value
+                num_samples.append(int(value_samples.get((x_axis_input, x_match), 0) + value_samples.get((y_axis_key, y_match), 0) - pair_samples.get((x_match, y_match), 0)))
+            elif use_x:
+                num_samples.append(int(value_samples.get((x_axis_input, x_match), 0)))
+            else:
+                num_samples.append(int(value_samples.get((y_axis_key, y_match), 0)))
+    
+    distribution_chart = pd.DataFrame()
+    distribution_chart['x_axis'] = x_axis_list
+    distribution_chart['num_clones'] = num_clones
+    distribution_chart['y_axis'] = y_axis_list       
+    distribution_chart['num_samples'] = num_samples
+    return distribution_chart, total_clones
+
+###Summary of one subject that its subplot is drawn from. overlap is None unless it was asked for.
+SubjectSummary = namedtuple('SubjectSummary', ['distribution_chart', 'num_clones', 'x_axis_values_sorted', 'x_axis_values_unedited_sorted', 'overlap'])
+
+###Load and count the clones of one subject with the given aggregation engine and return its SubjectSummary.
+###The "approximate" engine only keeps a HyperLogLog sketch of the clones of every sample (see clonechart.sketch), so its counts are estimates.
+###The "disk" engine keeps the clones in a memory-mapped store in store_dir (see clonechart.store), which is removed once they are counted.
+###load_clones can replace the download of the (sample_id, clone_id) pairs, for example to read them from the cache.
+###The clones themselves are dropped once they are counted, so only the small summary is kept. The connection is not opened if load_clones doesn't need it.
+###For the "pandas" engine, an already built clone_matrix of the subject can be given instead, so that several charts can be counted from one download.
+def summarize_subject(connection, subject_name, sample_ids, sample_metadata, x_axis_input, y_axis_key, total_tissue_list, aggregation_engine='pandas', clone_source='sequences', chunk_size=1000000, overlap=False, shard_size=0, shard_workers=1, load_clones=None, clone_matrix=None, store_dir=None):
+    print("Making graph for: " + subject_name)
+    connection = as_connection(connection)
+    
+    ###get subject-specific metadata labels
+    x_axis_values_sorted, x_axis_values_unedited_sorted = get_x_axis_values(sample_metadata, sample_ids, x_axis_input)
+    
+    # =============================================================================
+    # Build the dataframe for graph
+    # =============================================================================
+    overlap_matrix = None
+    if aggregation_engine == 'sql':
+        print("Counting the clones of {} in the database.".format(subject_name))
+        with measure_stage('count in database', subject_name, num_samples=len(sample_ids)) as measures:
+            distribution_chart, num_clones = connection.retry(lambda sql_engine: build_distribution_chart_sql(sql_engine, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list, clone_source),
+                                                              "count of the clones")
+            measures.update(cells=len(distribution_chart), num_clones=int(num_clones))
+    elif aggregation_engine == 'approximate':
+        from .sketch import build_clone_sketches, build_distribution_chart_approximate, load_clone_sketches
+        print("Loading the clone sketches of {}. This can take several minutes depending on the table size and download speed.".format(subject_name))
+        with measure_stage('load sketches', subject_name, num_samples=len(sample_ids)) as measures:
+            if load_clones is None:
+                sketches = load_clone_sketches(connection, sample_ids, clone_source, chunk_size, shard_size, shard_workers)
+            else:
+                sketches = build_clone_sketches(load_clones(), sample_ids)
+            measures['bytes'] = int(sketches.registers.nbytes)
+        with measure_stage('count', subject_name) as measures:
+            distribution_chart, num_clones = build_distribution_chart_approximate(sketches, sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list)
+            measures.update(cells=len(distribution_chart), num_clones=num_clones)
+    elif aggregation_engine == 'disk':
+        from .store import build_distribution_chart_store, fetch_clone_store, get_store_bytes, temporary_store_path, write_clone_store
+        print("Loading {} table for {} to disk. This can take several minutes depending on the table size and download speed.".format(clone_source, subject_name))
+        with temporary_store_path(store_dir) as store_path:
+            with measure_stage('load clones', subject_name, num_samples=len(sample_ids)) as measures:
+                if load_clones is None:
+                    store = connection.retry(lambda sql_engine: fetch_clone_store(sql_engine, sample_ids, store_path, clone_source, chunk_size), "download of the clones")
+                else:
+                    store = write_clone_store(store_path, [load_clones()], sample_ids, chunk_size)
+                measures.update(pairs=len(store.clone_positions), bytes=get_store_bytes(store))
+            num_clones = len(store.clone_ids)
+            with measure_stage('count', subject_name, num_clones=num_clones) as measures:
+                distribution_chart = build_distribution_chart_store(store, sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list, chunk_size)
+                measures['cells'] = len(distribution_chart)
+            ###close the memory maps before the store is removed
+            del store
+    else:
+        if clone_matrix is None:
+            ###sequences table
+            print("Loading {} table for {}. This can take several minutes depending on the table size and download speed.".format(clone_source, subject_name))
+            with measure_stage('load clones', subject_name, num_samples=len(sample_ids)) as measures:
+                if load_clones is None:
+                    sequences_table = load_clone_membership(connection, sample_ids, clone_source, chunk_size, shard_size, shard_workers)
+                else:
+                    sequences_table = load_clones()
+                measures.update(rows=len(sequences_table), bytes=get_frame_bytes(sequences_table))
+            print("Finished loading table for {}. Now counting clones.".format(subject_name))
+            with measure_stage('build clone matrix', subject_name):
+                clone_matrix = build_clone_matrix(sequences_table)
+            del sequences_table
+        
+        ###get the number of clones for current subject
+        num_clones = len(clone_matrix.clone_ids)
+        with measure_stage('count', subject_name, num_clones=num_clones) as measures:
+            distribution_chart = build_distribution_chart(clone_matrix, sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list)
+            measures['cells'] = len(distribution_chart)
+        
+        if overlap:
+            ###the tissue list is reversed for the y-axis, so reverse it back
+            with measure_stage('count overlap', subject_name):
+                if len(total_tissue_list) > 0:
+                    overlap_matrix = build_overlap_matrix(clone_matrix, sample_metadata, y_axis_key, total_tissue_list[::-1], sample_ids)
+                else:
+                    overlap_matrix = build_overlap_matrix(clone_matrix, sample_metadata, x_axis_input, list(dict.fromkeys(x_axis_values_unedited_sorted)), sample_ids)
+    return SubjectSummary(distribution_chart, num_clones, x_axis_values_sorted, x_axis_values_unedited_sorted, overlap_matrix)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Batch mode: many charts of many databases from one job spec, with the data of every database loaded only once.
+
+The job spec is a json file such as:
+    {
+        "options": {"num_workers": 4, "plotlyjs": "shared", "cache_dir": "path/to/cache_dir"},
+        "databases": [
+            {
+                "database": "lp15", "user": "username", "ssh_host": "10.0.0.1", "ssh_username": "username",
+                "charts": [
+                    {"y_axis_input": "tissue", "x_axis_input": "timepoint", "path": "lp15_tissue_timepoint.html"},
+                    {"y_axis_input": "tissue", "x_axis_input": "None", "path": "lp15_tissue.html", "tissue_color_dict": {"PBMC": "#67001f", "Spleen": "#d6604d"}},
+                    {"y_axis_input": "None", "x_axis_input": "timepoint", "path": "lp15_timepoint.html"}
+                ]
+            },
+            {"url": "sqlite:///influenza.sqlite", "charts": [{"y_axis_input": "None", "x_axis_input": "timepoint", "path": "influenza.html"}]}
+        ]
+    }
+The connection settings of a database are the arguments of clonechart.Connection. Passwords that are not in the file are read from the
+CLONECHART_PASSWORD and CLONECHART_SSH_PASSWORD environment variables. "options" apply to every database and chart, and can be changed
+for one database or one chart by setting them there.
+
+The tables of a database are loaded once. The clones of every subject are downloaded (or read from the cache) once and counted for all
+the charts before the next subject is loaded, so the memory used doesn't grow with the number of charts. The charts are counted with the
+"pandas" aggregation engine, from one clone matrix of the subject.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from .aggregate import build_clone_matrix, summarize_subject
+from .cache import evict_cache
+from .chart import get_clone_loader, get_y_axis_labels, load_chart_data, write_chart_outputs
+from .connection import Connection, as_connection
+from .instrument import get_frame_bytes, measure_stage
+
+
+CONNECTION_SETTINGS = ('database', 'user', 'password', 'host', 'port', 'ssh_host', 'ssh_username', 'ssh_password', 'ssh_port', 'ssh_private_key', 'url',
+                       'keepalive', 'pool_recycle', 'retries', 'retry_wait')
+###Options of a database, with their defaults.
+DATABASE_OPTIONS = {'clone_source': 'auto', 'memory_limit_mb': 4096, 'num_workers': 1, 'shard_size': 0, 'shard_workers': 1,
+                    'cache_dir': None, 'cache_size_limit_mb': 10240, 'cache_offline': False}
+###Options of a chart, with their defaults.
+CHART_OPTIONS = {'y_axis_input': 'None', 'x_axis_input': 'None', 'path': None, 'tissue_color_dict': {}, 'overlap_path': None,
+                 'compact_rendering': True, 'plotlyjs': 'inline', 'summary_path': None}
+
+def load_batch_spec(path):
+    with open(path) as f:
+        spec = json.load(f)
+    check_batch_spec(spec)
+    return spec
+
+###Raise a ValueError for settings that batch mode doesn't know, so that a typo doesn't silently fall back to a default.
+def check_batch_spec(spec):
+    def check(settings, allowed, where):
+        unknown = sorted(set(settings) - set(allowed))
+        if len(unknown) > 0:
+            raise ValueError("Unknown settings in {}: {}".format(where, ", ".join(unknown)))
+    check(spec, ('options', 'databases'), "the job spec")
+    if len(spec.get('databases', [])) == 0:
+        raise ValueError("The job spec has no databases")
+    check(spec.get('options', {}), list(DATABASE_OPTIONS) + list(CHART_OPTIONS), "options")
+    for i, database_spec in enumerate(spec['databases']):
+        check(database_spec, CONNECTION_SETTINGS + tuple(DATABASE_OPTIONS) + tuple(CHART_OPTIONS) + ('charts',), "database {}".format(i + 1))
+        if len(database_spec.get('charts', [])) == 0:
+            raise ValueError("Database {} has no charts".format(i + 1))
+        for chart in database_spec['charts']:
+            check(chart, CHART_OPTIONS, "a chart of database {}".format(i + 1))
+
+###Settings of one level of the spec, from its defaults, overridden by each of the given dicts in turn.
+def merge_options(defaults, *overrides):
+    options = dict(defaults)
+    for override in overrides:
+        options.update({x: y for x, y in override.items() if x in defaults})
+    return options
+
+###Connection of a database of the spec. Passwords that are not in the spec are read from the environment.
+###Returns a connection that raises an error when it is used if the spec has no connection settings (for cached data).
+def get_spec_connection(database_spec, pool_size=5):
+    settings = {x: y for x, y in database_spec.items() if x in CONNECTION_SETTINGS}
+    if len(settings) == 0:
+        return as_connection(None)
+    if 'url' not in settings:
+        settings.setdefault('password', os.environ.get('CLONECHART_PASSWORD'))
+        if 'ssh_host' in settings:
+            settings.setdefault('ssh_password', os.environ.get('CLONECHART_SSH_PASSWORD'))
+    return Connection(pool_size=pool_size, **settings)
+
+###Make all the charts of one database. Returns the timings as (database, chart, step, seconds) rows.
+###The times of loading and counting the clones are summed over the subjects, so with num_workers > 1 they can add up to more than the time that passed.
+def run_database_batch(database_spec, options):
+    timings = []
+    database_options = merge_options(DATABASE_OPTIONS, options, database_spec)
+    charts = [merge_options(CHART_OPTIONS, options, database_spec, x) for x in database_spec['charts']]
+    num_workers = database_options['num_workers']
+    shard_size = database_options['shard_size']
+    shard_workers = database_options['shard_workers']
+    cache_dir = database_options['cache_dir']
+    cache_offline = database_options['cache_offline']
+
+    pool_size = max(5, num_workers * (shard_workers if shard_size else 1))
+    connection = get_spec_connection(database_spec, pool_size)
+    database = connection.name
+    if cache_dir and database is None:
+        raise ValueError("A database with cache_dir and no connection needs the database setting")
+    print("Making {} charts for: {}".format(len(charts), database))
+
+    with connection:
+        start = time.perf_counter()
+        data = load_chart_data(connection, database, database_options['clone_source'], database_options['memory_limit_mb'], num_workers, cache_dir, cache_offline)
+        subjects_dict, samples_dict, sample_metadata, clone_source = data.subjects_dict, data.samples_dict, data.sample_metadata, data.clone_source
+        timings.append((database, '', 'load tables', time.perf_counter() - start))
+
+        chart_labels = [get_y_axis_labels(sample_metadata, x['y_axis_input'], x['tissue_color_dict']) for x in charts]
+
+        ###load the clones of a subject once and count them for every chart
+        step_seconds = {'load clones': 0.0, 'count': [0.0 for x in charts]}
+        lock = threading.Lock()
+        def summarize(subject_id):
+            start = time.perf_counter()
+            print("Loading {} table for {}, for {} charts.".format(clone_source, subjects_dict[subject_id], len(charts)))
+            with measure_stage('load clones', subjects_dict[subject_id], num_samples=len(samples_dict[subject_id])) as measures:
+                clone_membership = get_clone_loader(connection, data, subject_id, shard_size, shard_workers, cache_dir, database, cache_offline)()
+                measures.update(rows=len(clone_membership), bytes=get_frame_bytes(clone_membership))
+            clone_matrix = build_clone_matrix(clone_membership)
+            del clone_membership
+            load_seconds = time.perf_counter() - start
+            summaries = []
+            count_seconds = []
+            for chart, (y_axis_key, total_tissue_list, tissue_color_dict) in zip(charts, chart_labels):
+                start = time.perf_counter()
+                summaries.append(summarize_subject(connection, subjects_dict[subject_id], samples_dict[subject_id], sample_metadata, chart['x_axis_input'], y_axis_key,
+                                                   total_tissue_list, 'pandas', clone_source, overlap=bool(chart['overlap_path']), clone_matrix=clone_matrix))
+                count_seconds.append(time.perf_counter() - start)
+            with lock:
+                step_seconds['load clones'] += load_seconds
+                step_seconds['count'] = [x + y for x, y in zip(step_seconds['count'], count_seconds)]
+            return summaries
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                subject_summaries = dict(zip(subjects_dict.keys(), executor.map(summarize, subjects_dict.keys())))
+        else:
+            subject_summaries = {subject_id: summarize(subject_id) for subject_id in subjects_dict.keys()}
+        timings.append((database, '', 'load clones', step_seconds['load clones']))
+    evict_cache(cache_dir, database_options['cache_size_limit_mb'])
+
+    for i, (chart, (y_axis_key, total_tissue_list, tissue_color_dict)) in enumerate(zip(charts, chart_labels)):
+        chart_name = chart['path'] or "{} x {}".format(chart['y_axis_input'], chart['x_axis_input'])
+        timings.append((database, chart_name, 'count', step_seconds['count'][i]))
+        summaries = {x: y[i] for x, y in subject_summaries.items()}
+        start = time.perf_counter()
+        write_chart_outputs(summaries, subjects_dict, total_tissue_list, tissue_color_dict, chart['y_axis_input'], chart['x_axis_input'], database, chart['path'],
+                            chart['summary_path'], chart['overlap_path'], chart['compact_rendering'], chart['plotlyjs'])
+        timings.append((database, chart_name, 'render', time.perf_counter() - start))
+    return timings
+
+###Make all the charts of a job spec (a dict like the one described at the top, or the path of its json file).
+###Returns the timings as a DataFrame with one row per database and step (load tables, load clones) and per chart and step (count, render).
+def run_batch(spec):
+    if not isinstance(spec, dict):
+        spec = load_batch_spec(spec)
+    else:
+        check_batch_spec(spec)
+    timings = []
+    start = time.perf_counter()
+    for database_spec in spec['databases']:
+        timings.extend(run_database_batch(database_spec, spec.get('options', {})))
+    timings.append(('', '', 'total', time.perf_counter() - start))
+    return pd.DataFrame(timings, columns=['database', 'chart', 'step', 'seconds'])
+
+###Timings of run_batch as a table with one row per database and chart and one column per step.
+def format_batch_timings(timings):
+    steps = timings.loc[timings['step'] != 'total']
+    rows = list(dict.fromkeys(zip(steps['database'], steps['chart'])))
+    table = steps.groupby(['database', 'chart', 'step'])['seconds'].sum().unstack('step', fill_value=0)
+    table = table.reindex(index=pd.MultiIndex.from_tuples(rows, names=['database', 'chart']),
+                          columns=[x for x in ('load tables', 'load clones', 'count', 'render') if x in table.columns], fill_value=0)
+    total = timings['seconds'].loc[timings['step'] == 'total'].sum()
+    return table.round(2).to_string() + "\nTotal: {:.2f} seconds".format(total)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite: times the stages of a clone distribution chart on synthetic databases of growing size, and records the peak memory.
+
+    clonechart benchmark --scales tiny small medium -o benchmark.json
+    clonechart benchmark --scales tiny small medium -o new.json --compare benchmark.json
+
+For every scale (see clonechart.synthetic.SYNTHETIC_SCALES) a synthetic ImmuneDB database is made once in the work folder and reused by
+later runs. Every aggregation engine is then run on it in a new process, so that the peak memory of one run doesn't hide the next one.
+The stages are the ones of make_clone_distribution_chart:
+    load tables    download of the subjects, samples and sample_metadata tables, and the metadata index
+    load clones    download of the clones of every subject and their clone matrix ("pandas" engine only)
+    count          counting of the clones of every subject (for the "sql" engine, the queries that count them in the database, and for the
+                   "approximate" and "disk" engines, the download of the clones into sketches or onto disk and their counting)
+    render         the html file of the chart, with the compact rendering
+peak_memory_mb is the peak memory of the process at the end of the stage, so it includes the stages before it.
+
+The results are saved as a json file:
+    {
+        "format": "clonechart-benchmark", "version": 1,
+        "clonechart_version": "0.2.0", "python": "3.8.10", "platform": "Linux-5.4.0-x86_64", "date": "2020-06-01T12:00:00",
+        "settings": {"y_axis_input": "tissue", "x_axis_input": "timepoint", "repeat": 1, "seed": 0},
+        "results": [
+            {"scale": "small", "num_subjects": 5, "num_samples": 80, "num_metadata_keys": 4, "num_sequences": 160198,
+             "aggregation_engine": "pandas", "run": 1, "stage": "load tables", "seconds": 0.05, "peak_memory_mb": 150.2},
+            ...
+        ]
+    }
+Two results files, for example of two versions of clonechart, are compared with --compare, which lists the stages that got slower or use more memory.
+
+The grid benchmark only times the counting of the clones of every cell of one subject with many timepoints and tissues, with the one pass of
+build_distribution_chart and with the per-cell loop it replaced, and checks that both give the same dataframe:
+
+    clonechart benchmark --grids small large
+"""
+
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+from .synthetic import SYNTHETIC_SCALES, make_synthetic_immunedb
+
+
+BENCHMARK_FORMAT = 'clonechart-benchmark'
+BENCHMARK_VERSION = 1
+BENCHMARK_STAGES = ('load tables', 'load clones', 'count', 'render')
+###Subjects of the grid benchmark: (number of timepoints, number of tissues, number of (sample_id, clone_id) pairs).
+GRID_SIZES = {'small': (10, 8, 200000), 'large': (30, 20, 1000000)}
+
+###Version of the installed clonechart, or None if it is run from a source folder that isn't installed.
+def get_clonechart_version():
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        return None
+    try:
+        return version('clonechart')
+    except PackageNotFoundError:
+        return None
+
+###Path of the synthetic database of a scale in work_dir. The name has the whole scale and the seed, so a changed scale makes a new database.
+def get_synthetic_path(work_dir, scale, seed=0):
+    return os.path.join(work_dir, 'synthetic_{}_seed{}.sqlite'.format('_'.join(str(x) for x in scale), seed))
+
+###Run the stages of one chart on the database at database_path and return one row per stage with its seconds and peak memory.
+###This is run in a process of its own by run_benchmark.
+def run_benchmark_case(database_path, aggregation_engine, y_axis_input, x_axis_input, output_path):
+    from .aggregate import build_clone_matrix, summarize_subject
+    from .chart import get_subject_samples, get_y_axis_labels, load_tables
+    from .connection import Connection
+    from .instrument import get_peak_memory_mb
+    from .loading import get_clone_source, load_clone_membership
+    from .metadata import build_sample_metadata
+    from .render import render_clone_distribution_chart
+
+    rows = []
+    def add_row(stage, seconds):
+        rows.append({'stage': stage, 'seconds': seconds, 'peak_memory_mb': get_peak_memory_mb()})
+    with Connection(url='sqlite:///' + os.path.abspath(database_path)) as connection, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        subjects_table, samples_table, metadata_table = load_tables(connection)
+        clone_source = get_clone_source(connection, 'auto')
+        subjects_dict, samples_dict = get_subject_samples(subjects_table, samples_table)
+        sample_metadata = build_sample_metadata(metadata_table)
+        y_axis_key, total_tissue_list, tissue_color_dict = get_y_axis_labels(sample_metadata, y_axis_input, {})
+        add_row('load tables', time.perf_counter() - start)
+
+        summaries = {}
+        load_seconds = 0.0
+        count_seconds = 0.0
+        for subject_id, subject_name in subjects_dict.items():
+            clone_matrix = None
+            if aggregation_engine == 'pandas':
+                start = time.perf_counter()
+                clone_matrix = build_clone_matrix(load_clone_membership(connection, samples_dict[subject_id], clone_source))
+                load_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            summaries[subject_id] = summarize_subject(connection, subject_name, samples_dict[subject_id], sample_metadata, x_axis_input, y_axis_key, total_tissue_list,
+                                                      aggregation_engine, clone_source, clone_matrix=clone_matrix)
+            count_seconds += time.perf_counter() - start
+            del clone_matrix
+        if aggregation_engine == 'pandas':
+            add_row('load clones', load_seconds)
+        add_row('count', count_seconds)
+
+        start = time.perf_counter()
+        render_clone_distribution_chart(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, output_path, connection.name, True, 'cdn')
+        add_row('render', time.perf_counter() - start)
+    return rows
+
+###Run the benchmark suite. scales are names of SYNTHETIC_SCALES or (name, SyntheticScale) pairs. Every scale is run repeat times with every
+###aggregation engine. The synthetic databases and the charts are kept in work_dir. Returns the results as a dict like the one described at the top.
+def run_benchmark(scales=('tiny', 'small'), aggregation_engines=('pandas', 'sql'), y_axis_input='tissue', x_axis_input='timepoint', work_dir='clonechart_benchmark',
+                  repeat=1, seed=0):
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    for scale_name in scales:
+        if isinstance(scale_name, str):
+            scale = SYNTHETIC_SCALES[scale_name]
+        else:
+            scale_name, scale = scale_name
+        database_path = get_synthetic_path(work_dir, scale, seed)
+        if not os.path.exists(database_path):
+            print("Making the {} synthetic database.".format(scale_name))
+            make_synthetic_immunedb(database_path + '.tmp', scale, seed)
+            os.replace(database_path + '.tmp', database_path)
+        db = sqlite3.connect(database_path)
+        num_sequences = db.execute("select count(*) from sequences").fetchone()[0]
+        db.close()
+        for aggregation_engine in aggregation_engines:
+            for run in range(1, repeat + 1):
+                print("Running {} with the {} engine ({} of {}).".format(scale_name, aggregation_engine, run, repeat))
+                output_path = os.path.join(work_dir, 'chart_{}_{}.html'.format(scale_name, aggregation_engine))
+                ###a new process for every run, so that its peak memory is its own
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                    rows = executor.submit(run_benchmark_case, database_path, aggregation_engine, y_axis_input, x_axis_input, output_path).result()
+                for row in rows:
+                    results.append(dict({'scale': scale_name, 'num_subjects': scale.num_subjects, 'num_samples': scale.num_subjects * scale.samples_per_subject,
+                                         'num_metadata_keys': scale.num_metadata_keys, 'num_sequences': num_sequences,
+                                         'aggregation_engine': aggregation_engine, 'run': run}, **row))
+    return {
+        'format': BENCHMARK_FORMAT,
+        'version': BENCHMARK_VERSION,
+        'clonechart_version': get_clonechart_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'settings': {'y_axis_input': y_axis_input, 'x_axis_input': x_axis_input, 'repeat': repeat, 'seed': seed},
+        'results': results,
+    }
+
+def write_benchmark_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+
+def read_benchmark_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('format') != BENCHMARK_FORMAT:
+        raise ValueError("{} is not a benchmark results file".format(path))
+    if results['version'] > BENCHMARK_VERSION:
+        raise ValueError("{} is a version {} benchmark results file, this version of clonechart reads up to version {}".format(path, results['version'], BENCHMARK_VERSION))
+    return results
+
+###Median seconds and peak memory of every (scale, aggregation_engine, stage) of a results dict, over its runs.
+def get_benchmark_table(results):
+    table = pd.DataFrame(results['results'])
+    table = table.groupby(['scale', 'aggregation_engine', 'stage'], sort=False)[['seconds', 'peak_memory_mb']].median()
+    return table
+
+###Results as a table with one row per scale and engine and the seconds of every stage, followed by the peak memory.
+def format_benchmark_results(results):
+    table = get_benchmark_table(results)
+    seconds = table['seconds'].unstack('stage')
+    seconds = seconds[[x for x in BENCHMARK_STAGES if x in seconds.columns]]
+    seconds['peak_memory_mb'] = table['peak_memory_mb'].groupby(level=['scale', 'aggregation_engine'], sort=False).max()
+    return seconds.round(2).to_string()
+
+###Compare two results dicts, such as the ones of two versions of clonechart. Returns one row per (scale, aggregation_engine, stage) that both
+###have, with the old and new median seconds and peak memory and their ratios. regression is True where either got more than threshold times larger.
+###Stages that take less than min_seconds in both are not counted as slower, since their time is mostly noise.
+def compare_benchmarks(old_results, new_results, threshold=1.25, min_seconds=0.05):
+    old = get_benchmark_table(old_results)
+    new = get_benchmark_table(new_results)
+    comparison = old.join(new, how='inner', lsuffix='_old', rsuffix='_new')
+    comparison['seconds_ratio'] = comparison['seconds_new'] / comparison['seconds_old']
+    comparison['memory_ratio'] = comparison['peak_memory_mb_new'] / comparison['peak_memory_mb_old']
+    slower = (comparison['seconds_ratio'] > threshold) & (comparison[['seconds_old', 'seconds_new']].max(axis=1) >= min_seconds)
+    comparison['regression'] = slower | (comparison['memory_ratio'] > threshold)
+    return comparison[['seconds_old', 'seconds_new', 'seconds_ratio', 'peak_memory_mb_old', 'peak_memory_mb_new', 'memory_ratio', 'regression']]
+
+###One random subject for the grid benchmark, with samples_per_cell samples of every (timepoint, tissue) and num_pairs random (sample_id, clone_id)
+###pairs. Returns the pairs, the subject's rows of the sample_metadata table, the timepoints and the tissues.
+def make_grid_subject(num_timepoints, num_tissues, num_pairs, samples_per_cell=2, seed=0):
+    rng = np.random.default_rng(seed)
+    timepoints = ['day {}'.format(x * 7) for x in range(num_timepoints)]
+    tissues = ['tissue {}'.format(x) for x in range(num_tissues)]
+    num_samples = num_timepoints * num_tissues * samples_per_cell
+    sample_ids = np.arange(1, num_samples + 1)
+    cells = np.arange(num_samples) // samples_per_cell
+    metadata_table = pd.concat([
+        pd.DataFrame({'sample_id': sample_ids, 'key': 'timepoint', 'value': [timepoints[x] for x in cells // num_tissues]}),
+        pd.DataFrame({'sample_id': sample_ids, 'key': 'tissue', 'value': [tissues[x] for x in cells % num_tissues]}),
+    ], ignore_index=True)
+    ###about as many clones as a tenth of the pairs, so that most clones are in several cells
+    clone_membership = pd.DataFrame({'sample_id': rng.choice(sample_ids, num_pairs), 'clone_id': rng.integers(1, max(2, num_pairs // 10), num_pairs)})
+    return clone_membership.drop_duplicates(ignore_index=True), metadata_table, timepoints, tissues
+
+###The dataframe of build_distribution_chart with timepoints on the x-axis and tissues on the y-axis, counted the way it was before the cells
+###were counted in one pass: the metadata is filtered again for every cell and the clones of its samples are collected in a set.
+###Only kept as the baseline of the grid benchmark.
+def build_distribution_chart_per_cell(df, metadata_table, timepoints, tissues):
+    num_clones = []
+    x_axis_list = []
+    y_axis_list = []
+    num_samples = []
+    for x_value in timepoints:
+        x_current_sample_ids = metadata_table['sample_id'].loc[metadata_table['value'] == x_value].unique().tolist()
+        for y_value in tissues:
+            y_current_sample_ids = metadata_table['sample_id'].loc[metadata_table['value'] == y_value].unique().tolist()
+            sample_ids_in_both = set(x_current_sample_ids).intersection(set(y_current_sample_ids))
+            clones_in_both = set(df['clone_id'].loc[df['sample_id'].isin(sample_ids_in_both)].unique())
+            if len(df['clone_id'].unique()) > 0:
+                num_clones.append(len(clones_in_both) / len(df['clone_id'].unique()) * 100)
+            else:
+                num_clones.append(0)
+            y_axis_list.append(y_value)
+            x_axis_list.append(x_value)
+            num_samples.append(len(set(x_current_sample_ids).union(set(y_current_sample_ids))))
+    distribution_chart = pd.DataFrame()
+    distribution_chart['x_axis'] = x_axis_list
+    distribution_chart['num_clones'] = num_clones
+    distribution_chart['y_axis'] = y_axis_list
+    distribution_chart['num_samples'] = num_samples
+    return distribution_chart
+
+###Run the grid benchmark. grids are names of GRID_SIZES or (name, (num_timepoints, num_tissues, num_pairs)) pairs. Every grid is counted repeat
+###times both ways, and the median seconds are kept. The one pass includes building the clone matrix from the pairs. Returns one row per grid
+###with the seconds of the per-cell loop and of the one pass, and how many times faster the one pass is.
+def run_grid_benchmark(grids=('small', 'large'), repeat=1, seed=0):
+    from .aggregate import build_clone_matrix, build_distribution_chart
+    from .metadata import build_sample_metadata
+
+    results = []
+    for grid_name in grids:
+        if isinstance(grid_name, str):
+            grid = GRID_SIZES[grid_name]
+        else:
+            grid_name, grid = grid_name
+        num_timepoints, num_tissues, num_pairs = grid
+        clone_membership, metadata_table, timepoints, tissues = make_grid_subject(num_timepoints, num_tissues, num_pairs, seed=seed)
+        sample_metadata = build_sample_metadata(metadata_table)
+        sample_ids = metadata_table['sample_id'].unique().tolist()
+        per_cell_seconds = []
+        one_pass_seconds = []
+        for run in range(repeat):
+            print("Counting the {} grid ({} of {}).".format(grid_name, run + 1, repeat))
+            start = time.perf_counter()
+            per_cell_chart = build_distribution_chart_per_cell(clone_membership, metadata_table, timepoints, tissues)
+            per_cell_seconds.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            one_pass_chart = build_distribution_chart(build_clone_matrix(clone_membership), sample_metadata, sample_ids, 'timepoint', 'tissue', timepoints, timepoints, tissues)
+            one_pass_seconds.append(time.perf_counter() - start)
+        pd.testing.assert_frame_equal(one_pass_chart, per_cell_chart, check_dtype=False)
+        results.append({'grid': grid_name, 'num_timepoints': num_timepoints, 'num_tissues': num_tissues, 'num_pairs': len(clone_membership),
+                        'per_cell_seconds': float(np.median(per_cell_seconds)), 'one_pass_seconds': float(np.median(one_pass_seconds))})
+    results = pd.DataFrame(results)
+    results['speedup'] = results['per_cell_seconds'] / results['one_pass_seconds']
+    return results
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for clonechart.
+
+The cache keeps the sample_metadata, samples and subjects tables, and the (sample_id, clone_id) pairs of every subject, as Parquet files:
+    cache_dir/<database>/tables/<table>.parquet
+    cache_dir/<database>/<clone_source>/subject_<subject_id>.parquet
+Each file has a .json file next to it with the fingerprint of the database rows it was made from.
+The clones are fingerprinted by the row count and the largest clone_id of every sample, and are downloaded again when that changes in the database.
+The tables are small, and a relabeled tissue or a corrected metadata value doesn't change any count, so they are downloaded on every run that isn't
+offline. Their fingerprint is a hash of their rows, so the cached file is only rewritten when they changed, and offline runs read them from the cache.
+
+In the incremental mode, the fingerprint of the clones is instead the row of every sample in the samples table, with its row count and largest clone_id.
+Only the samples that are new or whose fingerprint changed are downloaded and merged into the cached clones, and the summaries of the subjects that didn't change are reused from
+    cache_dir/<database>/summaries/subject_<subject_id>.pkl
+
+To see what is in the cache, or to clear it, run:
+    clonechart cache inspect path/to/cache_dir
+    clonechart cache clear path/to/cache_dir [--database database]
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+from .loading import load_table
+
+
+###Folder of a database inside the cache. Characters that are not safe in file names are replaced.
+def get_database_dir(cache_dir, database):
+    return os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', str(database)))
+
+def read_fingerprint(data_path):
+    try:
+        with open(data_path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+###Write the data first and the fingerprint last, both through temporary files, so an interrupted run never leaves a fingerprint without its data.
+def write_cache_entry(data_path, data, fingerprint):
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    data.to_parquet(data_path + '.tmp', index=False)
+    os.replace(data_path + '.tmp', data_path)
+    with open(data_path + '.json.tmp', 'w') as f:
+        json.dump(fingerprint, f)
+    os.replace(data_path + '.json.tmp', data_path + '.json')
+
+###Read a cache entry and mark it as recently used, which is what evict_cache goes by.
+def read_cache_entry(data_path):
+    data = pd.read_parquet(data_path)
+    os.utime(data_path)
+    return data
+
+def get_clone_path(cache_dir, database, clone_source, subject_id):
+    return os.path.join(get_database_dir(cache_dir, database), clone_source, 'subject_{}.parquet'.format(subject_id))
+
+def get_summary_path(cache_dir, database, subject_id):
+    return os.path.join(get_database_dir(cache_dir, database), 'summaries', 'subject_{}.pkl'.format(subject_id))
+
+###Fingerprint of a whole downloaded table (data): its number of rows and a hash of their content, so that any changed value changes it.
+def get_table_fingerprint(table, data):
+    content_hash = hashlib.sha256("\n".join(get_row_hashes(data)).encode()).hexdigest()
+    return {'table': table, 'num_rows': len(data), 'content_hash': content_hash}
+
+###Fingerprint of the clones of some samples: the number of rows and the largest clone_id of every sample in clone_source.
+def get_clone_fingerprint(sql_engine, sample_ids, clone_source):
+    sample_ids = sorted(int(x) for x in sample_ids)
+    fingerprint = {'clone_source': clone_source, 'sample_ids': sample_ids, 'samples': []}
+    if len(sample_ids) > 0:
+        query = text("select sample_id, count(*) as num_rows, max(clone_id) as max_clone_id from {} where clone_id IS NOT NULL and sample_id IN :sample_ids group by sample_id".format(clone_source))
+        query = query.bindparams(bindparam('sample_ids', expanding=True))
+        counts = pd.read_sql_query(query, sql_engine, params={'sample_ids': sample_ids}).sort_values('sample_id')
+        fingerprint['samples'] = [[int(x) for x in row] for row in counts.itertuples(index=False)]
+    return fingerprint
+
+###The clone source ("clone_stats" or "sequences") that has cached clones for this database, or None. The most recently used one is preferred.
+def get_cached_clone_source(cache_dir, database):
+    database_dir = get_database_dir(cache_dir, database)
+    sources = [x for x in ('clone_stats', 'sequences') if os.path.isdir(os.path.join(database_dir, x))]
+    if len(sources) == 0:
+        return None
+    return max(sources, key=lambda x: os.path.getmtime(os.path.join(database_dir, x)))
+
+###Hash of every row of a table, as text so that it can be saved in json. The hash doesn't depend on the column types.
+def get_row_hashes(table):
+    return [str(x) for x in pd.util.hash_pandas_object(table.astype(str), index=False)]
+
+###Fingerprint of every sample for the incremental mode: a hash of its row in the samples table.
+def get_sample_rows(samples_table):
+    return dict(zip((int(x) for x in samples_table['id']), get_row_hashes(samples_table)))
+
+###Fingerprint of every sample of a subject for the incremental mode: sample_rows (made by get_sample_rows, for the samples of the subject) with the
+###number of rows and the largest clone_id of every sample in clone_source, so that a sample whose clones were imported again is downloaded again.
+def get_subject_sample_rows(connection, sample_rows, clone_source):
+    fingerprint = connection.retry(lambda sql_engine: get_clone_fingerprint(sql_engine, sample_rows, clone_source), "check of the clones")
+    clone_counts = {x: '{}:{}'.format(y, z) for x, y, z in fingerprint['samples']}
+    return {x: '{}/{}'.format(y, clone_counts.get(x, '0:0')) for x, y in sample_rows.items()}
+
+###Compare the samples of a subject (sample_rows, made by get_sample_rows) with the ones its clones were cached from.
+###Returns the samples that are new or changed, and the samples that are gone.
+def get_changed_samples(cache_dir, database, subject_id, clone_source, sample_rows):
+    data_path = get_clone_path(cache_dir, database, clone_source, subject_id)
+    cached_fingerprint = read_fingerprint(data_path)
+    if cached_fingerprint is None or 'sample_rows' not in cached_fingerprint or not os.path.exists(data_path):
+        return sorted(sample_rows), []
+    cached_rows = {int(x): y for x, y in cached_fingerprint['sample_rows'].items()}
+    changed = sorted(x for x, y in sample_rows.items() if cached_rows.get(x) != y)
+    removed = sorted(x for x in cached_rows if x not in sample_rows)
+    return changed, removed
+
+###Update the cached (sample_id, clone_id) pairs of a subject for the incremental mode and return them.
+###The pairs of samples that are gone or changed are dropped, and only the new and changed samples are downloaded with load(sample_ids).
+def refresh_cached_clone_membership(subject_id, clone_source, sample_rows, load, cache_dir, database):
+    data_path = get_clone_path(cache_dir, database, clone_source, subject_id)
+    changed, removed = get_changed_samples(cache_dir, database, subject_id, clone_source, sample_rows)
+    data = pd.DataFrame({'sample_id': pd.Series([], dtype='int32'), 'clone_id': pd.Series([], dtype='int32')})
+    if len(changed) < len(sample_rows):
+        data = read_cache_entry(data_path)
+        data = data.loc[data['sample_id'].isin([x for x in sample_rows if x not in changed])]
+    if len(changed) == 0 and len(removed) == 0:
+        return data
+    if len(changed) > 0:
+        data = pd.concat([data, load(changed)], ignore_index=True)
+    write_cache_entry(data_path, data, {'clone_source': clone_source, 'sample_ids': sorted(sample_rows), 'sample_rows': {str(x): y for x, y in sample_rows.items()}})
+    return data
+
+###Summary of a subject (a dict of its fields) saved by the last incremental run, if it was made with the same params. Otherwise None.
+def load_cached_summary(cache_dir, database, subject_id, params):
+    try:
+        with open(get_summary_path(cache_dir, database, subject_id), 'rb') as f:
+            saved = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    os.utime(get_summary_path(cache_dir, database, subject_id))
+    return saved['summary'] if saved['params'] == params else None
+
+def write_cached_summary(cache_dir, database, subject_id, params, summary):
+    summary_path = get_summary_path(cache_dir, database, subject_id)
+    os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+    with open(summary_path + '.tmp', 'wb') as f:
+        pickle.dump({'params': params, 'summary': summary}, f)
+    os.replace(summary_path + '.tmp', summary_path)
+
+###Load a whole table (such as sample_metadata) through the cache.
+###If offline is True, a cached table is used without checking the database, and the connection is not opened. Otherwise the table is downloaded
+###and the cached copy is only written again if its content changed.
+def load_cached_table(connection, table, cache_dir, database, offline=False):
+    data_path = os.path.join(get_database_dir(cache_dir, database), 'tables', table + '.parquet')
+    cached_fingerprint = read_fingerprint(data_path)
+    if offline and cached_fingerprint is not None and os.path.exists(data_path):
+        return read_cache_entry(data_path)
+    data = load_table(connection, table)
+    fingerprint = get_table_fingerprint(table, data)
+    if fingerprint == cached_fingerprint and os.path.exists(data_path):
+        os.utime(data_path)
+    else:
+        write_cache_entry(data_path, data, fingerprint)
+    return data
+
+###Load the (sample_id, clone_id) pairs of a subject through the cache. load is called to download the pairs when the cache is missing or out of date.
+###If offline is True, cached pairs are used without checking the database, and the connection is not opened.
+def load_cached_clone_membership(connection, subject_id, sample_ids, clone_source, load, cache_dir, database, offline=False):
+    data_path = get_clone_path(cache_dir, database, clone_source, subject_id)
+    cached_fingerprint = read_fingerprint(data_path)
+    if offline and cached_fingerprint is not None and cached_fingerprint['sample_ids'] == sorted(int(x) for x in sample_ids) and os.path.exists(data_path):
+        return read_cache_entry(data_path)
+    fingerprint = connection.retry(lambda sql_engine: get_clone_fingerprint(sql_engine, sample_ids, clone_source), "check of the clones")
+    if fingerprint == cached_fingerprint and os.path.exists(data_path):
+        return read_cache_entry(data_path)
+    data = load()
+    write_cache_entry(data_path, data, fingerprint)
+    return data
+
+###List the entries of the cache, most recently used first.
+def inspect_cache(cache_dir):
+    entries = []
+    if os.path.isdir(cache_dir):
+        for root, dirs, files in os.walk(cache_dir):
+            for name in files:
+                if name.endswith('.parquet') or name.endswith('.pkl'):
+                    data_path = os.path.join(root, name)
+                    size = os.path.getsize(data_path) + (os.path.getsize(data_path + '.json') if os.path.exists(data_path + '.json') else 0)
+                    entries.append({'entry': os.path.relpath(data_path, cache_dir), 'size_mb': size / 1024**2,
+                                    'last_used': datetime.datetime.fromtimestamp(os.path.getmtime(data_path))})
+    entries = pd.DataFrame(entries, columns=['entry', 'size_mb', 'last_used'])
+    return entries.sort_values('last_used', ascending=False, ignore_index=True)
+
+###Remove the least recently used entries until the cache is no bigger than size_limit_mb. Returns the removed entries.
+###Without a cache_dir, there is no cache and nothing is removed.
+def evict_cache(cache_dir, size_limit_mb):
+    if not cache_dir:
+        return []
+    entries = inspect_cache(cache_dir)
+    removed = []
+    total_mb = entries['size_mb'].sum()
+    for entry, size_mb in zip(entries['entry'][::-1], entries['size_mb'][::-1]):
+        if total_mb <= size_limit_mb:
+            break
+        data_path = os.path.join(cache_dir, entry)
+        for path in (data_path, data_path + '.json'):
+            if os.path.exists(path):
+                os.remove(path)
+        total_mb -= size_mb
+        removed.append(entry)
+    return removed
+
+###Remove the cache of one database, or the whole cache if database is None.
+def clear_cache(cache_dir, database=None):
+    path = cache_dir if database is None else get_database_dir(cache_dir, database)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
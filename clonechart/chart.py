@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Clone distribution chart of an ImmuneDB database: loads the tables, counts the clones of every subject and renders the chart.
+"""
+
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .aggregate import SubjectSummary, summarize_subject
+from .cache import (evict_cache, get_cached_clone_source, get_changed_samples, get_row_hashes, get_sample_rows, get_subject_sample_rows, load_cached_clone_membership,
+                    load_cached_summary, load_cached_table, refresh_cached_clone_membership, write_cached_summary)
+from .connection import as_connection
+from .instrument import get_frame_bytes, get_peak_memory_mb, log_stage, measure_stage
+from .loading import get_chunk_size, get_clone_source, load_clone_membership, load_table
+from .metadata import build_sample_metadata, get_key_values, get_y_axis_key
+from .render import check_compact_rendering, make_overlap_chart, render_clone_distribution_chart
+from .sketch import MAX_APPROXIMATION_ERROR, check_approximate_summaries, get_relative_error
+from .summary import ChartSummary, write_chart_summary
+
+
+###Load the sample_metadata, samples and subjects tables, through the cache if cache_dir is set. Returns (subjects_table, samples_table, metadata_table).
+def load_tables(connection, cache_dir=None, database=None, cache_offline=False):
+    connection = as_connection(connection)
+    tables = {}
+    with measure_stage('load tables', cached=bool(cache_dir)) as measures:
+        for table in ('sample_metadata', 'samples', 'subjects'):
+            print("Loading {} table.".format(table))
+            if cache_dir:
+                tables[table] = load_cached_table(connection, table, cache_dir, database or connection.name, cache_offline)
+            else:
+                tables[table] = load_table(connection, table)
+        measures.update(rows=sum(len(x) for x in tables.values()), bytes=sum(get_frame_bytes(x) for x in tables.values()))
+    return tables['subjects'], tables['samples'], tables['sample_metadata']
+
+###Names of the subjects and the samples of every subject, by subject_id.
+def get_subject_samples(subjects_table, samples_table):
+    ###Make dictionary of subjects
+    subjects_dict = {}
+    for subject_id, subject_name in zip(subjects_table['id'], subjects_table['identifier']):
+        subjects_dict[subject_id] = subject_name
+
+    ###get the samples that belong to each subject
+    samples_dict = {}
+    for subject_id in subjects_dict.keys():
+        samples_dict[subject_id] = set(samples_table['id'].loc[samples_table['subject_id'] == subject_id])
+    return subjects_dict, samples_dict
+
+###Metadata key of the y-axis, its labels in plotting order (total_tissue_list) and the color of every label.
+###If tissue_color_dict is empty, the labels are taken from the metadata and get random colors.
+def get_y_axis_labels(sample_metadata, y_axis_input, tissue_color_dict):
+    y_axis_key = get_y_axis_key(sample_metadata, y_axis_input)
+
+    ###make a list with all tissues to be used for shared yaxis and build a tissue_color_dict that associates a tissue with a color
+    if len(tissue_color_dict) == 0:
+        total_tissue_list = get_key_values(sample_metadata, y_axis_key)
+        tissue_color_dict = {}
+        for tissue in total_tissue_list:
+            tissue_color_dict[tissue] = "#" + ''.join([random.choice('0123456789ABCDEF') for j in range(6)])
+    elif y_axis_input == "None":
+        ###without a y-axis label no sample can match the tissues
+        total_tissue_list = []
+    else:
+        total_tissue_list = list(tissue_color_dict.keys())
+        
+    ###reverse the list so the gut tissues are toward the bottom of the y-axis (only relevant if tissue_color_dict is specified with blood first and gut last)
+    if len(tissue_color_dict) > 0:
+        total_tissue_list = total_tissue_list[::-1]
+    return y_axis_key, total_tissue_list, tissue_color_dict
+
+###Everything the charts of a database are counted from. chunk_size is the download chunk size of a subject, with the memory limit shared by the
+###subjects that are loaded at the same time.
+ChartData = namedtuple('ChartData', ['subjects_table', 'samples_table', 'metadata_table', 'subjects_dict', 'samples_dict', 'sample_metadata', 'clone_source', 'chunk_size'])
+
+###Load the tables of a database (the ones of tables that are None, through the cache if cache_dir is set), decide which table the clones are
+###read from and index the metadata. With cache_offline and clone_source = "auto", the clone source that has cached clones is used without the database.
+###Returns a ChartData.
+def load_chart_data(connection, database, clone_source='auto', memory_limit_mb=4096, num_workers=1, cache_dir=None, cache_offline=False, tables=(None, None, None)):
+    if any(x is None for x in tables):
+        tables = [x if x is not None else y for x, y in zip(tables, load_tables(connection, cache_dir, database, cache_offline))]
+    subjects_table, samples_table, metadata_table = tables
+    if cache_dir and cache_offline and clone_source == 'auto' and get_cached_clone_source(cache_dir, database) is not None:
+        clone_source = get_cached_clone_source(cache_dir, database)
+    clone_source = get_clone_source(connection, clone_source)
+    print("Reading clones from the {} table.".format(clone_source))
+    subjects_dict, samples_dict = get_subject_samples(subjects_table, samples_table)
+    ###index the metadata once, all the axis values and their samples are looked up in it
+    return ChartData(subjects_table, samples_table, metadata_table, subjects_dict, samples_dict, build_sample_metadata(metadata_table), clone_source,
+                     get_chunk_size(memory_limit_mb / max(1, num_workers)))
+
+###Function that loads the (sample_id, clone_id) pairs of a subject of data (a ChartData), through the cache if cache_dir is set.
+def get_clone_loader(connection, data, subject_id, shard_size=0, shard_workers=1, cache_dir=None, database=None, cache_offline=False):
+    sample_ids = data.samples_dict[subject_id]
+    download = lambda: load_clone_membership(connection, sample_ids, data.clone_source, data.chunk_size, shard_size, shard_workers)
+    if cache_dir:
+        return lambda: load_cached_clone_membership(connection, subject_id, sample_ids, data.clone_source, download, cache_dir, database, cache_offline)
+    return download
+
+###Write the outputs of a chart from the SubjectSummary of every subject: the chart summary at summary_path, the html chart at path and the clone
+###overlap heatmaps at overlap_path, for the ones that are set.
+def write_chart_outputs(summaries, subjects_dict, total_tissue_list, tissue_color_dict, y_axis_input, x_axis_input, database, path=None, summary_path=None,
+                        overlap_path=None, compact_rendering=False, plotlyjs='inline'):
+    if summary_path:
+        with measure_stage('write summary', path=summary_path):
+            write_chart_summary(summary_path, ChartSummary(summaries, subjects_dict, total_tissue_list, tissue_color_dict, y_axis_input, x_axis_input, database))
+        print("You can find the chart summary at: " + summary_path)
+    if path:
+        render_stats = render_clone_distribution_chart(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, path, database, compact_rendering, plotlyjs)
+        print("Finished!")
+        print("You can find the graph at: " + path)
+        print("Rendered {:,} traces in {:.2f} seconds, the html file is {:,.2f} MB.".format(*render_stats))
+    if overlap_path:
+        make_overlap_chart({x: y.overlap for x, y in summaries.items()}, subjects_dict, overlap_path, database, plotlyjs)
+        print("You can find the clone overlap heatmaps at: " + overlap_path)
+
+###Count the subjects one at a time like summarize does, but download the clones of the next subject (with the load function that
+###get_subject_clone_loader gives) in the background while the current one is counted, so that the download and the counting overlap.
+###The clones of two subjects are in memory at the same time.
+def summarize_with_prefetch(subject_ids, get_subject_clone_loader, summarize):
+    summaries = {}
+    if len(subject_ids) == 0:
+        return summaries
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        ###the downloads are kept by subject until they are used, so that a subject's clones are dropped once it is counted
+        downloads = {subject_ids[0]: executor.submit(get_subject_clone_loader(subject_ids[0]))}
+        try:
+            for i, subject_id in enumerate(subject_ids):
+                if i + 1 < len(subject_ids):
+                    downloads[subject_ids[i + 1]] = executor.submit(get_subject_clone_loader(subject_ids[i + 1]))
+                summaries[subject_id] = summarize(subject_id, load_clones=lambda: downloads.pop(subject_id).result())
+        finally:
+            for x in downloads.values():
+                x.cancel()
+    return summaries
+
+###Make the clone distribution chart of a database and write it to path. Returns the SubjectSummary of every subject, by subject_id.
+###connection is a Connection, a SQLAlchemy engine or a url. It is only opened when data has to be downloaded, so a run on pre-loaded tables
+###with cache_offline (or with aggregation_engine = "pandas" and cached clones) never connects. subjects_table, samples_table and metadata_table
+###can be given as DataFrames, the ones that are None are loaded with the connection. database is the name used in the titles and the cache, and
+###defaults to the name of the connection's database. If path is None, the clones are counted but nothing is rendered, and plotly is not imported.
+###compact_rendering and plotlyjs are passed to render_clone_distribution_chart. If check_rendering is True, the compact and the original
+###rendering are both built and compared, and a ValueError is raised if they don't draw the same chart.
+###If summary_path is set, the counted clones are also saved there as a chart summary, which clonechart.render_chart_summary can draw again without the database.
+###aggregation_engine = "approximate" estimates the clone counts from HyperLogLog sketches (see clonechart.sketch). If check_approximation is True,
+###the clones are also counted exactly ("sql" engine, or "pandas" from the cache with cache_dir) and a ValueError is raised if an estimate is
+###more than MAX_APPROXIMATION_ERROR standard errors off. aggregation_engine = "disk" keeps the clones of a subject in a memory-mapped store in
+###store_dir (the temporary folder of the system by default) instead of memory, see clonechart.store.
+###If incremental is True, only the clones of new or changed samples are downloaded into the cache, and the graphs of unchanged subjects are
+###reused. It needs cache_dir and aggregation_engine = "pandas", and a ValueError is raised without them or with cache_offline.
+###If prefetch is True, the clones of the next subject are downloaded while the current one is counted. It needs num_workers = 1 (with more
+###workers, the subjects already overlap) and aggregation_engine = "pandas", and can't be used with incremental.
+def make_clone_distribution_chart(subjects_table, samples_table, metadata_table, y_axis_input, x_axis_input, path, tissue_color_dict, aggregation_engine='pandas', clone_source='sequences', memory_limit_mb=4096, overlap_path=None, num_workers=1, shard_size=0, shard_workers=1, cache_dir=None, cache_size_limit_mb=10240, cache_offline=False, incremental=False, connection=None, database=None, compact_rendering=False, plotlyjs='inline', check_rendering=False, summary_path=None, check_approximation=False, store_dir=None, prefetch=False):
+    
+    start = time.perf_counter()
+    if aggregation_engine not in ('sql', 'pandas', 'approximate', 'disk'):
+        raise ValueError("aggregation_engine must be 'sql', 'pandas', 'approximate' or 'disk', not {!r}".format(aggregation_engine))
+    if overlap_path and aggregation_engine != 'pandas':
+        raise ValueError("overlap_path needs aggregation_engine = 'pandas'")
+    if check_approximation and aggregation_engine != 'approximate':
+        raise ValueError("check_approximation needs aggregation_engine = 'approximate'")
+    if incremental and (not cache_dir or aggregation_engine != 'pandas' or cache_offline):
+        raise ValueError("incremental needs cache_dir and aggregation_engine = 'pandas', and can't be used with cache_offline")
+    if prefetch and (num_workers > 1 or aggregation_engine != 'pandas' or incremental):
+        raise ValueError("prefetch needs num_workers = 1 and aggregation_engine = 'pandas', and can't be used with incremental")
+    connection = as_connection(connection, pool_size=max(5, num_workers * (shard_workers if shard_size else 1)))
+    if database is None:
+        database = connection.name
+    if cache_dir and database is None:
+        raise ValueError("cache_dir needs the name of the database")
+    if tissue_color_dict is None:
+        tissue_color_dict = {}
+    data = load_chart_data(connection, database, clone_source, memory_limit_mb, num_workers, cache_dir, cache_offline, (subjects_table, samples_table, metadata_table))
+    samples_table, metadata_table, sample_metadata = data.samples_table, data.metadata_table, data.sample_metadata
+    subjects_dict, samples_dict, clone_source, chunk_size = data.subjects_dict, data.samples_dict, data.clone_source, data.chunk_size
+    y_axis_key, total_tissue_list, tissue_color_dict = get_y_axis_labels(sample_metadata, y_axis_input, tissue_color_dict)
+    
+    ###load and count the clones of every subject, num_workers subjects at a time. The summaries are kept in the order of subjects_dict.
+    if incremental:
+        sample_rows = get_sample_rows(samples_table)
+    get_subject_clone_loader = lambda subject_id: get_clone_loader(connection, data, subject_id, shard_size, shard_workers, cache_dir, database, cache_offline)
+    def summarize(subject_id, aggregation_engine=aggregation_engine, load_clones=None):
+        if incremental:
+            subject_rows = get_subject_sample_rows(connection, {x: sample_rows[x] for x in samples_dict[subject_id]}, clone_source)
+            ###the graph of a subject only has to be made again if its samples, its metadata or the settings changed
+            summary_params = {'x_axis_input': x_axis_input, 'y_axis_key': y_axis_key, 'total_tissue_list': list(total_tissue_list), 'clone_source': clone_source, 'overlap': bool(overlap_path),
+                              'metadata': sorted(get_row_hashes(metadata_table.loc[metadata_table['sample_id'].isin(samples_dict[subject_id])]))}
+            changed, removed = get_changed_samples(cache_dir, database, subject_id, clone_source, subject_rows)
+            if len(changed) == 0 and len(removed) == 0:
+                summary = load_cached_summary(cache_dir, database, subject_id, summary_params)
+                if summary is not None:
+                    print("No new samples for {}, reusing its graph.".format(subjects_dict[subject_id]))
+                    return SubjectSummary(**summary)
+            print("{} new or changed samples for {}.".format(len(changed), subjects_dict[subject_id]))
+            download = lambda sample_ids: load_clone_membership(connection, sample_ids, clone_source, chunk_size, shard_size, shard_workers)
+            load_clones = lambda: refresh_cached_clone_membership(subject_id, clone_source, subject_rows, download, cache_dir, database)
+            summary = summarize_subject(connection, subjects_dict[subject_id], samples_dict[subject_id], sample_metadata, x_axis_input, y_axis_key, total_tissue_list, aggregation_engine, clone_source, chunk_size, bool(overlap_path), shard_size, shard_workers, load_clones, store_dir=store_dir)
+            write_cached_summary(cache_dir, database, subject_id, summary_params, dict(summary._asdict()))
+            return summary
+        elif cache_dir and load_clones is None:
+            load_clones = get_subject_clone_loader(subject_id)
+        return summarize_subject(connection, subjects_dict[subject_id], samples_dict[subject_id], sample_metadata, x_axis_input, y_axis_key, total_tissue_list, aggregation_engine, clone_source, chunk_size, bool(overlap_path), shard_size, shard_workers, load_clones, store_dir=store_dir)
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            summaries = dict(zip(subjects_dict.keys(), executor.map(summarize, subjects_dict.keys())))
+    elif prefetch:
+        summaries = summarize_with_prefetch(list(subjects_dict.keys()), get_subject_clone_loader, summarize)
+    else:
+        summaries = {subject_id: summarize(subject_id) for subject_id in subjects_dict.keys()}
+    if aggregation_engine == 'approximate':
+        print("The clone counts are estimated, with a relative standard error of {:.2%}.".format(get_relative_error()))
+    if check_approximation:
+        exact_engine = 'pandas' if cache_dir else 'sql'
+        print("Counting the clones exactly with the {} engine to check the estimates.".format(exact_engine))
+        check = check_approximate_summaries(summaries, {x: summarize(x, exact_engine) for x in subjects_dict.keys()})
+        print("{:.1%} of the {:,} estimated clone counts are within one standard error of the exact count, {:.1%} within two and {:.1%} within three "
+              "(expected: 68%, 95% and 99.7%). The largest error is {:.2f} standard errors.".format(check.within_one, check.num_counts, check.within_two, check.within_three, check.max_error))
+        if check.max_error > MAX_APPROXIMATION_ERROR:
+            raise ValueError("An estimated clone count is {:.1f} standard errors off the exact count".format(check.max_error))
+    evict_cache(cache_dir, cache_size_limit_mb)
+    
+    write_chart_outputs(summaries, subjects_dict, total_tissue_list, tissue_color_dict, y_axis_input, x_axis_input, database, path, summary_path, overlap_path,
+                        compact_rendering, plotlyjs)
+    if check_rendering:
+        differences = check_compact_rendering(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database)
+        if len(differences) > 0:
+            raise ValueError("The compact rendering doesn't draw the same chart as the original one. These parts differ: " + ", ".join(differences))
+        print("The compact rendering draws the same chart as the original one.")
+    log_stage('chart', time.perf_counter() - start, database=database, aggregation_engine=aggregation_engine, num_subjects=len(subjects_dict))
+    peak_memory_mb = get_peak_memory_mb()
+    if peak_memory_mb is not None:
+        print("Peak memory usage: {:,.0f} MB".format(peak_memory_mb))
+    return summaries
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface of clonechart.
+
+    clonechart chart --database lp15 --user username --ssh-host 10.0.0.1 --ssh-username username -y tissue -x None -o chart.html
+    clonechart labels --url sqlite:///immunedb.sqlite
+    clonechart batch jobs.json
+    clonechart render summary.json -o chart.html
+    clonechart serve databases.json --http-port 8050
+    clonechart synthetic immunedb.sqlite --scale medium
+    clonechart benchmark --scales tiny small medium -o benchmark.json
+    clonechart benchmark --grids small large
+    clonechart cache inspect path/to/cache_dir
+
+The passwords can be given with the CLONECHART_PASSWORD and CLONECHART_SSH_PASSWORD environment variables instead of on the command line.
+Run "clonechart <command> --help" for all the options.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from .connection import Connection
+
+
+def add_connection_arguments(parser):
+    group = parser.add_argument_group('database connection')
+    group.add_argument('--url', default=None, help="SQLAlchemy url of the database, instead of the MySQL settings below (for example sqlite:///immunedb.sqlite)")
+    group.add_argument('--database', default=None, help="name of the MySQL database")
+    group.add_argument('--user', default=None, help="MySQL user")
+    group.add_argument('--password', default=os.environ.get('CLONECHART_PASSWORD'), help="MySQL password (default: $CLONECHART_PASSWORD)")
+    group.add_argument('--host', default='127.0.0.1', help="MySQL host, as seen from the ssh host if one is used (default: %(default)s)")
+    group.add_argument('--port', type=int, default=3306, help="MySQL port (default: %(default)s)")
+    group.add_argument('--ssh-host', default=None, help="host to open an ssh tunnel to. Leave it out to connect directly")
+    group.add_argument('--ssh-username', default=None)
+    group.add_argument('--ssh-password', default=os.environ.get('CLONECHART_SSH_PASSWORD'), help="ssh password (default: $CLONECHART_SSH_PASSWORD)")
+    group.add_argument('--ssh-port', type=int, default=22, help="(default: %(default)s)")
+    group.add_argument('--ssh-private-key', default=None, help="path of the ssh key, if one is needed")
+    group.add_argument('--keepalive', type=float, default=30, help="seconds between the keepalives of the ssh tunnel (default: %(default)s)")
+    group.add_argument('--retries', type=int, default=3, help="times a download is tried again if the connection is lost (default: %(default)s)")
+    group.add_argument('--retry-wait', type=float, default=5, help="seconds to wait before the first new try, doubled at every try (default: %(default)s)")
+
+
+def add_instrument_arguments(parser, report=True):
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--log-level', choices=['debug', 'info', 'warning'], default=None, help="show the time, rows and memory of every stage with info")
+    if report:
+        group.add_argument('--report', default=None, help="json file to write the time, rows and memory of every stage to")
+        group.add_argument('--profile', default=None, help="file to write the cProfile stats of the run to (use --num-workers 1)")
+        group.add_argument('--trace-memory', action='store_true', help="trace the memory allocations with tracemalloc and add the largest ones to the report")
+
+
+def get_connection(args, pool_size=5):
+    if args.url is None and args.database is None:
+        return None
+    return Connection(database=args.database, user=args.user, password=args.password, host=args.host, port=args.port, ssh_host=args.ssh_host,
+                      ssh_username=args.ssh_username, ssh_password=args.ssh_password, ssh_port=args.ssh_port, ssh_private_key=args.ssh_private_key,
+                      url=args.url, pool_size=pool_size, keepalive=args.keepalive, retries=args.retries, retry_wait=args.retry_wait)
+
+
+###--tissue-colors is either a json object or the path of a json file, such as {"PBMC": "#67001f", "Spleen": "#d6604d"}
+def load_tissue_colors(value):
+    if value is None:
+        return {}
+    if os.path.exists(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+###Fill in the defaults of the chart settings that depend on other flags, and report the flags that can't be used together like argparse does,
+###instead of with the ValueError of make_clone_distribution_chart.
+def check_chart_args(parser, args):
+    needs_pandas = [x for x, y in (('--incremental', args.incremental), ('--prefetch', args.prefetch), ('--overlap-path', args.overlap_path)) if y]
+    if args.aggregation_engine is None:
+        args.aggregation_engine = 'pandas' if len(needs_pandas) > 0 else 'sql'
+    if args.num_workers is None:
+        args.num_workers = 1 if args.prefetch else 4
+    for flag in needs_pandas:
+        if args.aggregation_engine != 'pandas':
+            parser.error("{} needs --aggregation-engine pandas".format(flag))
+    if args.check_approximation and args.aggregation_engine != 'approximate':
+        parser.error("--check-approximation needs --aggregation-engine approximate")
+    if args.incremental and not args.cache_dir:
+        parser.error("--incremental needs --cache-dir")
+    if args.incremental and args.offline:
+        parser.error("--incremental can't be used with --offline")
+    if args.prefetch and args.num_workers > 1:
+        parser.error("--prefetch needs --num-workers 1")
+    if args.prefetch and args.incremental:
+        parser.error("--prefetch can't be used with --incremental")
+
+
+def run_chart(args):
+    from .chart import make_clone_distribution_chart
+    connection = get_connection(args, pool_size=max(5, args.num_workers * (args.shard_workers if args.shard_size else 1)))
+    if connection is None and not (args.cache_dir and args.offline):
+        raise SystemExit("clonechart chart: give --url or --database, or use --cache-dir with --offline")
+    try:
+        make_clone_distribution_chart(None, None, None, args.y_axis, args.x_axis, args.output, load_tissue_colors(args.tissue_colors), args.aggregation_engine,
+                                      args.clone_source, args.memory_limit_mb, args.overlap_path, args.num_workers, args.shard_size, args.shard_workers,
+                                      args.cache_dir, args.cache_size_limit_mb, args.offline, args.incremental, connection, args.database_name or args.database,
+                                      not args.original_rendering, args.plotlyjs, args.check_rendering, args.summary_path, args.check_approximation, args.store_dir, args.prefetch)
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def run_labels(args):
+    from .loading import load_table
+    from .metadata import get_metadata_labels
+    connection = get_connection(args)
+    if connection is None:
+        raise SystemExit("clonechart labels: give --url or --database")
+    with connection:
+        print("\n".join(str(x) for x in get_metadata_labels(load_table(connection, 'sample_metadata'))))
+
+
+def run_render(args):
+    from .summary import render_chart_summary
+    render_stats = render_chart_summary(args.summary, args.output, load_tissue_colors(args.tissue_colors), not args.original_rendering, args.plotlyjs, args.overlap_path)
+    print("You can find the graph at: " + args.output)
+    print("Rendered {:,} traces in {:.2f} seconds, the html file is {:,.2f} MB.".format(*render_stats))
+
+
+def run_serve(args):
+    from .service import ChartService, load_service_connections, serve
+    pool_size = max(5, args.num_workers)
+    if args.config is not None:
+        connections = load_service_connections(args.config, pool_size)
+    else:
+        connection = get_connection(args, pool_size)
+        if connection is None:
+            raise SystemExit("clonechart serve: give a config file, --url or --database")
+        connections = {args.database_name or connection.name: connection}
+    plotlyjs = '/plotly.min.js' if args.plotlyjs == 'shared' else args.plotlyjs
+    service = ChartService(connections, args.memory_budget_mb, args.clone_source, args.memory_limit_mb, args.num_workers, args.cache_dir, args.offline, plotlyjs)
+    serve(service, args.http_host, args.http_port)
+
+
+def run_batch(args):
+    from .batch import format_batch_timings, run_batch
+    timings = run_batch(args.spec)
+    print(format_batch_timings(timings))
+    if args.timings:
+        timings.to_csv(args.timings, index=False)
+        print("You can find the timings at: " + args.timings)
+
+
+def run_synthetic(args):
+    from .synthetic import SYNTHETIC_SCALES, make_synthetic_immunedb
+    scale = SYNTHETIC_SCALES[args.scale]
+    scale = scale._replace(**{x: getattr(args, x) for x in scale._fields if getattr(args, x) is not None})
+    num_rows = make_synthetic_immunedb(args.path, scale, args.seed)
+    print("\n".join("{}: {:,} rows".format(x, y) for x, y in num_rows.items()))
+    print("You can find the database at: sqlite:///" + os.path.abspath(args.path))
+
+
+def run_benchmark(args):
+    from .benchmark import compare_benchmarks, format_benchmark_results, read_benchmark_results, run_benchmark, run_grid_benchmark, write_benchmark_results
+    if args.grids:
+        print(run_grid_benchmark(args.grids, args.repeat, args.seed).round(2).to_string(index=False))
+        return
+    results = run_benchmark(args.scales, args.engines, args.y_axis, args.x_axis, args.work_dir, args.repeat, args.seed)
+    print(format_benchmark_results(results))
+    if args.output:
+        write_benchmark_results(args.output, results)
+        print("You can find the results at: " + args.output)
+    if args.compare:
+        comparison = compare_benchmarks(read_benchmark_results(args.compare), results, args.threshold)
+        print(comparison.round(2).to_string())
+        regressions = comparison.loc[comparison['regression']]
+        if len(regressions) > 0:
+            raise SystemExit("{} stages got slower or use more memory than in {}".format(len(regressions), args.compare))
+        print("No stage got slower or uses more memory than in " + args.compare)
+
+
+def run_cache(args):
+    from .cache import clear_cache, get_database_dir, inspect_cache
+    if args.cache_command == 'inspect':
+        entries = inspect_cache(args.cache_dir)
+        print(entries.to_string(index=False) if len(entries) > 0 else "The cache is empty.")
+        print("Total size: {:,.1f} MB".format(entries['size_mb'].sum()))
+    else:
+        clear_cache(args.cache_dir, args.database)
+        print("Cleared the cache at: " + (args.cache_dir if args.database is None else get_database_dir(args.cache_dir, args.database)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='clonechart', description="Clone distribution charts of ImmuneDB databases.")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    chart = commands.add_parser('chart', help="make the clone distribution chart of a database")
+    add_connection_arguments(chart)
+    group = chart.add_argument_group('chart')
+    group.add_argument('-y', '--y-axis', default='None', help="metadata label of the y-axis, or None (default: %(default)s)")
+    group.add_argument('-x', '--x-axis', default='None', help="metadata label of the x-axis, or None (default: %(default)s)")
+    group.add_argument('-o', '--output', default=None, help="html file to write the chart to. Leave it out to only count the clones")
+    group.add_argument('--tissue-colors', default=None, help="order and colors of the y-axis labels, as a json object or a json file")
+    group.add_argument('--overlap-path', default=None, help="html file to write the clone overlap heatmaps to (needs the pandas engine, which is then the default)")
+    group.add_argument('--original-rendering', action='store_true', help="draw one Scatter trace per x value, instead of one WebGL trace per subject")
+    group.add_argument('--plotlyjs', default='inline', help="where the html file gets plotly.js from: inline, cdn, shared, or the path of a .js file (default: %(default)s)")
+    group.add_argument('--check-rendering', action='store_true', help="check that the compact and the original rendering draw the same chart")
+    group.add_argument('--check-approximation', action='store_true', help="also count the clones exactly and report how far the estimates of the approximate engine are from them")
+    group.add_argument('--summary-path', default=None, help="json file to save the counted clones to, so that the chart can be drawn again with \"clonechart render\"")
+    group.add_argument('--database-name', default=None, help="name of the database in the titles and the cache (default: the name in the connection settings)")
+    group = chart.add_argument_group('performance')
+    group.add_argument('--aggregation-engine', choices=['sql', 'pandas', 'approximate', 'disk'], default=None,
+                       help="where the clones are counted. approximate estimates them from small sketches of the samples, disk counts them from "
+                            "memory-mapped files for subjects that don't fit in memory (default: pandas with --incremental, --prefetch or --overlap-path, and sql otherwise)")
+    group.add_argument('--store-dir', default=None, help="folder for the files of the disk engine (default: the temporary folder of the system)")
+    group.add_argument('--clone-source', choices=['auto', 'clone_stats', 'sequences'], default='auto', help="table the clones are read from (default: %(default)s)")
+    group.add_argument('--memory-limit-mb', type=float, default=4096, help="approximate memory used while downloading clones (default: %(default)s)")
+    group.add_argument('--num-workers', type=int, default=None, help="subjects that are loaded at the same time (default: 1 with --prefetch, and 4 otherwise)")
+    group.add_argument('--shard-size', type=int, default=0, help="split the clone download of a subject into shards of this many samples (default: no shards)")
+    group.add_argument('--prefetch', action='store_true', help="download the next subject while the current one is counted (needs --num-workers 1 and the pandas engine, not with --incremental)")
+    group.add_argument('--shard-workers', type=int, default=4, help="shards that are downloaded at the same time (default: %(default)s)")
+    group = chart.add_argument_group('cache')
+    group.add_argument('--cache-dir', default=None, help="folder where the tables and clones are kept between runs")
+    group.add_argument('--cache-size-limit-mb', type=float, default=10240, help="(default: %(default)s)")
+    group.add_argument('--offline', action='store_true', help="use the cached data without checking the database for changes")
+    group.add_argument('--incremental', action='store_true', help="only download the clones of new or changed samples (needs --cache-dir and the pandas engine, not with --offline)")
+    add_instrument_arguments(chart)
+    chart.set_defaults(run=run_chart)
+
+    labels = commands.add_parser('labels', help="list the metadata labels that can be used for the axes")
+    add_connection_arguments(labels)
+    labels.set_defaults(run=run_labels)
+
+    render = commands.add_parser('render', help="draw a chart again from its chart summary, without the database")
+    render.add_argument('summary', help="chart summary made with --summary-path")
+    render.add_argument('-o', '--output', required=True, help="html file to write the chart to")
+    render.add_argument('--tissue-colors', default=None, help="new order and colors of the y-axis labels, as a json object or a json file")
+    render.add_argument('--overlap-path', default=None, help="html file to write the clone overlap heatmaps to, if the summary has them")
+    render.add_argument('--original-rendering', action='store_true', help="draw one Scatter trace per x value, instead of one WebGL trace per subject")
+    render.add_argument('--plotlyjs', default='inline', help="where the html file gets plotly.js from: inline, cdn, shared, or the path of a .js file (default: %(default)s)")
+    add_instrument_arguments(render)
+    render.set_defaults(run=run_render)
+
+    serve = commands.add_parser('serve', help="serve the charts of one or more databases over HTTP, keeping the loaded data in memory")
+    serve.add_argument('config', nargs='?', default=None, help="json file with the databases to serve (see clonechart.service). Leave it out to serve the database of the connection settings")
+    add_connection_arguments(serve)
+    serve.add_argument('--database-name', default=None, help="name of the database in the requests and the titles (default: the name in the connection settings)")
+    group = serve.add_argument_group('service')
+    group.add_argument('--http-host', default='127.0.0.1', help="address the service listens on (default: %(default)s)")
+    group.add_argument('--http-port', type=int, default=8050, help="port the service listens on (default: %(default)s)")
+    group.add_argument('--memory-budget-mb', type=float, default=4096, help="memory for the loaded tables, clones and charts, the least recently used are dropped past it (default: %(default)s)")
+    group.add_argument('--plotlyjs', choices=['shared', 'inline', 'cdn'], default='shared', help="where the pages get plotly.js from, shared is served by the service (default: %(default)s)")
+    group.add_argument('--clone-source', choices=['auto', 'clone_stats', 'sequences'], default='auto', help="table the clones are read from (default: %(default)s)")
+    group.add_argument('--memory-limit-mb', type=float, default=1024, help="approximate memory used while downloading clones (default: %(default)s)")
+    group.add_argument('--num-workers', type=int, default=4, help="subjects that are loaded at the same time (default: %(default)s)")
+    group.add_argument('--cache-dir', default=None, help="folder where the tables and clones are also kept between runs")
+    group.add_argument('--offline', action='store_true', help="use the cached data without checking the database for changes")
+    add_instrument_arguments(serve, report=False)
+    serve.set_defaults(run=run_serve)
+
+    batch = commands.add_parser('batch', help="make many charts of one or more databases, loading each database once")
+    batch.add_argument('spec', help="json file with the databases and the charts to make (see clonechart.batch)")
+    batch.add_argument('--timings', default=None, help="csv file to write the time of every step to")
+    add_instrument_arguments(batch)
+    batch.set_defaults(run=run_batch)
+
+    synthetic = commands.add_parser('synthetic', help="make a synthetic ImmuneDB database in a SQLite file, for testing")
+    synthetic.add_argument('path', help="SQLite file to write, it is replaced if it exists")
+    synthetic.add_argument('--scale', choices=['tiny', 'small', 'medium', 'large'], default='small', help="size of the database (see clonechart.synthetic, default: %(default)s)")
+    synthetic.add_argument('--num-subjects', type=int, default=None, help="change the number of subjects of the scale")
+    synthetic.add_argument('--samples-per-subject', type=int, default=None)
+    synthetic.add_argument('--num-metadata-keys', type=int, default=None)
+    synthetic.add_argument('--sequences-per-sample', type=int, default=None)
+    synthetic.add_argument('--clones-per-subject', type=int, default=None)
+    synthetic.add_argument('--clone-size-skew', type=float, default=None, help="exponent of the power law of the clone sizes")
+    synthetic.add_argument('--unclustered-fraction', type=float, default=None, help="fraction of the sequences without a clone")
+    synthetic.add_argument('--seed', type=int, default=0, help="(default: %(default)s)")
+    synthetic.set_defaults(run=run_synthetic)
+
+    benchmark = commands.add_parser('benchmark', help="time the stages of a chart on synthetic databases of growing size")
+    benchmark.add_argument('--scales', nargs='+', choices=['tiny', 'small', 'medium', 'large'], default=['tiny', 'small'], help="(default: %(default)s)")
+    benchmark.add_argument('--engines', nargs='+', choices=['pandas', 'sql', 'approximate', 'disk'], default=['pandas', 'sql'], help="aggregation engines to run (default: %(default)s)")
+    benchmark.add_argument('-y', '--y-axis', default='tissue', help="(default: %(default)s)")
+    benchmark.add_argument('-x', '--x-axis', default='timepoint', help="(default: %(default)s)")
+    benchmark.add_argument('--repeat', type=int, default=1, help="runs of every scale and engine, the median is reported (default: %(default)s)")
+    benchmark.add_argument('--seed', type=int, default=0, help="seed of the synthetic databases (default: %(default)s)")
+    benchmark.add_argument('--work-dir', default='clonechart_benchmark', help="folder for the synthetic databases, which are reused, and the charts (default: %(default)s)")
+    benchmark.add_argument('-o', '--output', default=None, help="json file to write the results to")
+    benchmark.add_argument('--compare', default=None, help="results json file of an earlier run. Exits with an error if a stage got slower or uses more memory")
+    benchmark.add_argument('--grids', nargs='+', choices=['small', 'large'], default=None,
+                           help="only time the counting of the cells of one subject with many timepoints and tissues, against the per-cell loop it replaced")
+    benchmark.add_argument('--threshold', type=float, default=1.25, help="ratio to the earlier run that counts as slower or more memory (default: %(default)s)")
+    benchmark.set_defaults(run=run_benchmark)
+
+    cache = commands.add_parser('cache', help="inspect or clear the cache")
+    cache.add_argument('cache_command', choices=['inspect', 'clear'])
+    cache.add_argument('cache_dir')
+    cache.add_argument('--database', default=None, help="only clear the cache of this database")
+    cache.set_defaults(run=run_cache)
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'run', None) is run_chart:
+        check_chart_args(parser, args)
+    if getattr(args, 'log_level', None):
+        logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if getattr(args, 'report', None) or getattr(args, 'profile', None) or getattr(args, 'trace_memory', False):
+        from .instrument import run_report
+        settings = {x: y for x, y in vars(args).items() if x != 'run' and 'password' not in x}
+        if settings.get('url'):
+            from sqlalchemy.engine import make_url
+            settings['url'] = repr(make_url(settings['url']))
+        with run_report(args.report, args.profile, args.trace_memory, settings):
+            args.run(args)
+    else:
+        args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
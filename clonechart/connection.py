@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy connection to an ImmuneDB database.
+
+A Connection only holds the connection settings. The ssh tunnel and the SQLAlchemy engine are opened the first time
+Connection.engine is used, so the parts of a run that don't need the database (cached or pre-loaded data) never connect.
+All the queries of a run share the one tunnel and the pool of connections of its engine. The tunnel sends ssh keepalives and
+the pool checks a connection before it is reused, so a run survives idle connections that the server or a firewall closed.
+
+Downloads that can take minutes go through Connection.retry: if the connection (or the tunnel) is lost while they run, the engine
+and the tunnel are opened again and only that download is repeated. The downloads are small units (a table, the clones of a subject
+or of a shard of its samples), and the ones that already finished are kept, so a dropped tunnel costs one unit instead of the whole run.
+"""
+
+import socket
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import DBAPIError
+
+from .instrument import log_stage
+
+
+###MySQL client errors that mean the server can't be reached or the connection to it was lost.
+MYSQL_CONNECTION_ERRORS = (2002, 2003, 2006, 2013, 2055)
+
+###Whether error means that the connection to the database or its ssh tunnel was lost, so the query can be tried again on a new connection.
+###The errors it was raised from are checked too, since pandas raises its own DatabaseError from the errors of SQLAlchemy.
+def is_connection_error(error):
+    try:
+        from sshtunnel import BaseSSHTunnelForwarderError
+    except ImportError:
+        BaseSSHTunnelForwarderError = ()
+    while error is not None:
+        if isinstance(error, DBAPIError):
+            if error.connection_invalidated:
+                return True
+            args = getattr(error.orig, 'args', ())
+            if len(args) > 0 and args[0] in MYSQL_CONNECTION_ERRORS:
+                return True
+        elif isinstance(error, (ConnectionError, socket.timeout, EOFError, BaseSSHTunnelForwarderError)):
+            return True
+        error = error.__cause__
+    return False
+
+
+class Connection:
+    """Connection settings of an ImmuneDB database, opened on first use.
+
+    Either give the MySQL settings (database, user, password, host, port), optionally with the ssh settings to reach the host
+    through a tunnel, or give a SQLAlchemy url (for example "sqlite:///immunedb.sqlite"). pool_size is the number of
+    connections that can be used at the same time.
+
+    keepalive is the number of seconds between the ssh keepalives of the tunnel, and pool_recycle the age in seconds after which a
+    connection of the pool is replaced. A download that loses the connection is tried again up to retries times, after retry_wait
+    seconds, doubled at every new try.
+    """
+
+    def __init__(self, database=None, user=None, password=None, host='127.0.0.1', port=3306, ssh_host=None, ssh_username=None,
+                 ssh_password=None, ssh_port=22, ssh_private_key=None, url=None, pool_size=5, keepalive=30, pool_recycle=3600, retries=3, retry_wait=5):
+        if url is None and database is None:
+            raise ValueError("Connection needs a database name or a url")
+        self.database = database
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.ssh_host = ssh_host
+        self.ssh_username = ssh_username
+        self.ssh_password = ssh_password
+        self.ssh_port = ssh_port
+        self.ssh_private_key = ssh_private_key
+        self.url = url
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.pool_recycle = pool_recycle
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self._tunnel = None
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        """Name of the database, used for titles and for the cache folder."""
+        if self.database is not None:
+            return self.database
+        return make_url(self.url).database
+
+    @property
+    def is_open(self):
+        return self._engine is not None
+
+    @property
+    def engine(self):
+        """SQLAlchemy engine of the database. The ssh tunnel and the engine are opened on first use."""
+        with self._lock:
+            if self._engine is None:
+                self._engine = self._open()
+            return self._engine
+
+    def _open(self):
+        if self.url is not None:
+            if self.url.startswith('sqlite'):
+                return create_engine(self.url)
+            return create_engine(self.url, pool_size=self.pool_size, pool_pre_ping=True, pool_recycle=self.pool_recycle)
+        host, port = self.host, self.port
+        if self.ssh_host is not None:
+            from sshtunnel import SSHTunnelForwarder
+            self._tunnel = SSHTunnelForwarder(
+                (self.ssh_host, self.ssh_port),
+                ssh_username=self.ssh_username,
+                ssh_password=self.ssh_password,
+                ssh_pkey=self.ssh_private_key,
+                remote_bind_address=(self.host, self.port),
+                set_keepalive=self.keepalive
+                )
+            self._tunnel.start()
+            host, port = '127.0.0.1', self._tunnel.local_bind_port
+        connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'.format(self.user, self.password, host, port, self.database)
+        return create_engine(connect_string, pool_size=self.pool_size, pool_pre_ping=True, pool_recycle=self.pool_recycle)
+
+    def _close(self):
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+        if self._tunnel is not None:
+            self._tunnel.stop()
+            self._tunnel = None
+
+    def close(self):
+        """Close the engine and the ssh tunnel, if they were opened. The connection is opened again if it is used after this."""
+        with self._lock:
+            self._close()
+
+    def reset(self, engine=None):
+        """Close a lost engine and its tunnel, so that they are opened again when they are next used. If engine is given, the connection
+        is only closed if engine is still its engine, so that threads that lost the same engine only open a new one once."""
+        with self._lock:
+            if engine is None or engine is self._engine:
+                self._close()
+
+    def retry(self, function, description='download'):
+        """Return function(engine), calling it again with a new engine if it fails because the connection was lost, up to retries times.
+        function must start its work from the beginning every time it is called."""
+        attempt = 0
+        while True:
+            engine = self.engine
+            try:
+                return function(engine)
+            except Exception as e:
+                if attempt >= self.retries or not is_connection_error(e):
+                    raise
+                attempt += 1
+                wait = self.retry_wait * 2 ** (attempt - 1)
+                print("Lost the connection to {} during the {} ({}: {}). Trying again in {:g} seconds ({} of {}).".format(
+                    self.name, description, type(e).__name__, str(e).splitlines()[0] if str(e) else "", wait, attempt, self.retries))
+                start = time.perf_counter()
+                self.reset(engine)
+                time.sleep(wait)
+                log_stage('reconnect', time.perf_counter() - start, description=description, attempt=attempt, error=type(e).__name__)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        if self.url is not None:
+            return 'Connection(url={!r})'.format(make_url(self.url))
+        return 'Connection(database={!r}, host={!r}, ssh_host={!r})'.format(self.database, self.host, self.ssh_host)
+
+
+###Turn a Connection, a SQLAlchemy engine or a url into a Connection.
+###None gives a connection that raises an error when it is used, for runs that only use pre-loaded or cached data.
+###pool_size is used for a connection that is made from a url.
+def as_connection(connection, pool_size=5):
+    if connection is None:
+        return NoConnection()
+    if isinstance(connection, Connection):
+        return connection
+    if isinstance(connection, Engine):
+        return EngineConnection(connection)
+    if isinstance(connection, str):
+        return Connection(url=connection, pool_size=pool_size)
+    raise TypeError("connection must be a Connection, a SQLAlchemy engine or a url, not {!r}".format(type(connection).__name__))
+
+
+class EngineConnection(Connection):
+    """Connection around an engine that was already made by the caller. It is not disposed of by close()."""
+
+    def __init__(self, engine):
+        super().__init__(database=engine.url.database or '')
+        self._engine = engine
+
+    def __repr__(self):
+        return 'Connection(engine={!r})'.format(self._engine)
+
+    def close(self):
+        pass
+
+    def reset(self, engine=None):
+        ###the engine belongs to the caller, so only the lost connections of its pool are dropped
+        self._engine.dispose()
+
+
+class NoConnection(Connection):
+    """Placeholder for runs without a database. Using its engine raises an error."""
+
+    def __init__(self):
+        super().__init__(database='')
+
+    @property
+    def name(self):
+        return None
+
+    @property
+    def engine(self):
+        raise RuntimeError("This needs the database, but no connection was given. Pass a connection, or pre-load the tables and use a cache.")
+
+    def __repr__(self):
+        return 'Connection(None)'
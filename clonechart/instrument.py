@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of clonechart runs: every stage of a chart (the download of a table or of the clones of a subject, the counting, the
+rendering...) is measured and logged through the "clonechart" logger of the logging module, with its time, the rows and bytes it handled
+and the peak memory of the process so far.
+
+To see the stages as they happen, configure logging, for example with logging.basicConfig(level=logging.INFO), or run clonechart with
+--log-level info. To save them, run the chart inside run_report:
+
+    with clonechart.run_report('run.json'):
+        clonechart.make_clone_distribution_chart(...)
+
+which writes a json run report:
+    {
+        "format": "clonechart-run-report", "version": 1,
+        "started": "2020-06-01T12:00:00", "seconds": 42.0, "peak_memory_mb": 812.5, "settings": {...},
+        "stages": [{"stage": "load clones", "subject": "D207", "seconds": 3.2, "rows": 1234567, "bytes": 9876536, "peak_memory_mb": 640.1}, ...],
+        "totals": {"load clones": {"count": 12, "seconds": 30.5, "rows": 9876543, "bytes": 79012344}, ...}
+    }
+run_report can also run the profiler (profile_path, a cProfile file that can be opened with pstats or snakeviz) and trace the memory
+allocations of python and numpy (trace_memory, which adds the lines that allocated the most memory to the report). Both slow the run down.
+The profiler only sees the thread it was started in, so use num_workers = 1 when profiling.
+"""
+
+import cProfile
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: ###resource is not available on Windows
+    resource = None
+
+
+REPORT_FORMAT = 'clonechart-run-report'
+REPORT_VERSION = 1
+
+logger = logging.getLogger('clonechart')
+
+###Peak memory (resident set size) of this process in megabytes, or None if it can't be measured on this system.
+def get_peak_memory_mb():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin': ###macOS reports bytes, Linux reports kilobytes
+            return peak / 1024**2
+        return peak / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().peak_wset / 1024**2
+
+###Memory used by a DataFrame in bytes, as a measure of how much was downloaded.
+def get_frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+###Log one measured stage. measures are numbers or strings such as rows, bytes or num_traces. The stage is logged as a message and
+###as the "clonechart_stage" attribute of the log record, which RunReport collects.
+def log_stage(stage, seconds, subject=None, **measures):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    record = {'stage': stage, 'subject': subject, 'seconds': seconds}
+    record.update(measures)
+    record['peak_memory_mb'] = get_peak_memory_mb()
+    details = ", ".join("{}: {:,}".format(x, y) if isinstance(y, int) and not isinstance(y, bool) else "{}: {}".format(x, y) for x, y in measures.items())
+    logger.info("%s%s in %.3f seconds%s%s", stage, "" if subject is None else " of " + str(subject), seconds, " (" + details + ")" if details else "",
+                "" if record['peak_memory_mb'] is None else ", peak memory {:,.0f} MB".format(record['peak_memory_mb']), extra={'clonechart_stage': record})
+
+###Measure the stage in the with block. The measures dict that it gives can be filled in inside the block, for example with the rows that were loaded.
+@contextmanager
+def measure_stage(stage, subject=None, **measures):
+    start = time.perf_counter()
+    yield measures
+    log_stage(stage, time.perf_counter() - start, subject, **measures)
+
+
+class RunReport(logging.Handler):
+    """Logging handler that collects the stages logged by log_stage, and makes the json run report of them."""
+
+    def __init__(self, settings=None):
+        super().__init__(logging.INFO)
+        self.settings = settings or {}
+        self.started = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.stages = []
+        self.extra = {}
+        self._stages_lock = threading.Lock()
+
+    def emit(self, record):
+        stage = getattr(record, 'clonechart_stage', None)
+        if stage is not None:
+            with self._stages_lock:
+                self.stages.append(dict(stage, thread=record.threadName))
+
+    ###Sums of the seconds, rows and bytes of every kind of stage, in the order the stages were first logged.
+    def get_totals(self):
+        totals = {}
+        for stage in self.stages:
+            total = totals.setdefault(stage['stage'], {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += stage['seconds']
+            for x in ('rows', 'bytes'):
+                if x in stage:
+                    total[x] = total.get(x, 0) + stage[x]
+        return totals
+
+    def to_dict(self):
+        report = {
+            'format': REPORT_FORMAT,
+            'version': REPORT_VERSION,
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': time.perf_counter() - self.start,
+            'peak_memory_mb': get_peak_memory_mb(),
+            'settings': self.settings,
+            'stages': self.stages,
+            'totals': self.get_totals(),
+        }
+        report.update(self.extra)
+        return report
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, default=str)
+
+
+###Lines of code that allocated the most memory that is still in use, from a tracemalloc snapshot.
+def get_top_allocations(snapshot, limit=20):
+    return [{'location': "{}:{}".format(x.traceback[0].filename, x.traceback[0].lineno), 'size_mb': x.size / 1024**2, 'count': x.count}
+            for x in snapshot.statistics('lineno')[:limit]]
+
+###Collect the stages logged in the with block into a RunReport, which is given to the block and written to path (if it is set) at the end.
+###settings are saved in the report as they are. profile_path runs cProfile and writes its stats there. trace_memory traces the memory
+###allocations with tracemalloc and adds the traced peak and the lines that allocated the most memory to the report.
+@contextmanager
+def run_report(path=None, profile_path=None, trace_memory=False, settings=None):
+    report = RunReport(settings)
+    level = logger.level
+    if not logger.isEnabledFor(logging.INFO):
+        logger.setLevel(logging.INFO)
+    logger.addHandler(report)
+    profiler = None
+    if trace_memory:
+        tracemalloc.start()
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            report.extra['profile_path'] = profile_path
+            print("You can find the profile at: " + profile_path)
+        if trace_memory:
+            report.extra['traced_peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+            report.extra['top_allocations'] = get_top_allocations(tracemalloc.take_snapshot())
+            tracemalloc.stop()
+        logger.removeHandler(report)
+        logger.setLevel(level)
+        if path:
+            report.write(path)
+            print("You can find the run report at: " + path)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Download of the ImmuneDB tables and of the clone membership of the samples.
+
+Functions that take a connection only open it when they actually query the database. A connection can be a
+clonechart.Connection or a SQLAlchemy engine. Their queries go through Connection.retry, so a query that loses the connection is tried again.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from sqlalchemy import bindparam, inspect, text
+
+from .connection import as_connection
+from .instrument import get_frame_bytes, log_stage, measure_stage
+
+
+###Download a whole table.
+def load_table(connection, table):
+    with measure_stage('load table', table=table) as measures:
+        df = as_connection(connection).retry(lambda sql_engine: pd.read_sql_query("select * from {}".format(table), sql_engine), "download of the {} table".format(table))
+        measures.update(rows=len(df), bytes=get_frame_bytes(df))
+    return df
+
+###Decide which table the clone membership is read from. Returns "clone_stats" or "sequences".
+###For "auto", clone_stats is used when the table exists and has rows for every sample that has clones in the sequences table (ImmuneDB fills it
+###with immunedb_clone_stats, so samples imported after it last ran are missing). Otherwise the clones of the missing samples would be lost,
+###so the sequences table is used. The connection is only opened for "auto".
+def get_clone_source(connection, clone_source='auto'):
+    if clone_source not in ('auto', 'clone_stats', 'sequences'):
+        raise ValueError("clone_source must be 'auto', 'clone_stats' or 'sequences', not {!r}".format(clone_source))
+    if clone_source != 'auto':
+        return clone_source
+    def find_clone_source(sql_engine):
+        if 'clone_stats' not in inspect(sql_engine).get_table_names():
+            return 'sequences'
+        stats_samples = set(pd.read_sql_query("select distinct sample_id from clone_stats where sample_id IS NOT NULL", sql_engine)['sample_id'])
+        if len(stats_samples) == 0:
+            return 'sequences'
+        sequence_samples = set(pd.read_sql_query("select distinct sample_id from sequences where clone_id IS NOT NULL", sql_engine)['sample_id'])
+        missing = sequence_samples - stats_samples
+        if len(missing) > 0:
+            print("The clone_stats table has no rows for {:,} of the {:,} samples with clones, so the sequences table is used. Run immunedb_clone_stats to update it.".format(
+                len(missing), len(sequence_samples)))
+            return 'sequences'
+        return 'clone_stats'
+    return as_connection(connection).retry(find_clone_source, "check of the clone_stats table")
+
+###Number of rows to download at a time so that a chunk, while it is being converted, stays within a quarter of memory_limit_mb.
+###A row costs about 200 bytes before it is converted to int32 columns.
+def get_chunk_size(memory_limit_mb):
+    return max(10000, int(memory_limit_mb * 1024**2 / 4 / 200))
+
+###Query of the (sample_id, clone_id) pairs of the samples in the sample_ids parameter (a list) in clone_source.
+def get_clone_membership_query(clone_source):
+    query = text("select sample_id, clone_id from {} where clone_id IS NOT NULL and sample_id IN :sample_ids".format(clone_source))
+    return query.bindparams(bindparam('sample_ids', expanding=True))
+
+###Download the clone membership of the given samples from clone_source as distinct (sample_id, clone_id) pairs, stored as int32, over a single connection.
+###Only the sample_id and clone_id columns are read, chunk_size rows at a time over a server-side cursor. Each chunk is deduplicated
+###and merged into the pairs found so far, so the memory used is set by the chunk size and the number of distinct pairs, not by the number of sequences.
+###The time until the first chunk arrives (mostly the query in the database) and the rows and bytes that were downloaded are logged.
+def fetch_clone_membership(sql_engine, sample_ids, clone_source='sequences', chunk_size=1000000):
+    sample_ids = sorted(int(x) for x in sample_ids)
+    clone_membership = pd.DataFrame({'sample_id': pd.Series([], dtype='int32'), 'clone_id': pd.Series([], dtype='int32')})
+    if len(sample_ids) == 0:
+        return clone_membership
+    query = get_clone_membership_query(clone_source)
+    pending = []
+    pending_rows = 0
+    start = time.perf_counter()
+    first_chunk_seconds = None
+    fetched_rows = 0
+    fetched_bytes = 0
+    with sql_engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        for chunk in pd.read_sql_query(query, connection, params={'sample_ids': sample_ids}, chunksize=chunk_size):
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.perf_counter() - start
+            fetched_rows += len(chunk)
+            fetched_bytes += get_frame_bytes(chunk)
+            chunk = chunk.astype('int32').drop_duplicates()
+            pending.append(chunk)
+            pending_rows += len(chunk)
+            ###only merge once the pending chunks outgrow the pairs found so far, so each pair is copied a few times at most
+            if pending_rows > max(len(clone_membership), chunk_size):
+                clone_membership = pd.concat([clone_membership] + pending, ignore_index=True).drop_duplicates(ignore_index=True)
+                pending = []
+                pending_rows = 0
+    if len(pending) > 0:
+        clone_membership = pd.concat([clone_membership] + pending, ignore_index=True).drop_duplicates(ignore_index=True)
+    log_stage('fetch clones', time.perf_counter() - start, clone_source=clone_source, num_samples=len(sample_ids), rows=fetched_rows, bytes=fetched_bytes,
+              pairs=len(clone_membership), first_chunk_seconds=round(first_chunk_seconds or 0.0, 3))
+    return clone_membership
+
+###Download the clone membership of the given samples like fetch_clone_membership does.
+###If shard_size is set, the samples are split into shards of shard_size samples that are fetched over shard_workers connections at the same time.
+###A sample is never split between shards, so the pairs of different shards never overlap and can simply be concatenated.
+###If the connection is lost, only the shard (or the subject, without shards) that was being downloaded is downloaded again.
+def load_clone_membership(connection, sample_ids, clone_source='sequences', chunk_size=1000000, shard_size=0, shard_workers=1):
+    sample_ids = sorted(int(x) for x in sample_ids)
+    connection = as_connection(connection)
+    if not shard_size or len(sample_ids) <= shard_size:
+        return connection.retry(lambda sql_engine: fetch_clone_membership(sql_engine, sample_ids, clone_source, chunk_size), "download of the clones")
+    shards = [sample_ids[i:i + shard_size] for i in range(0, len(sample_ids), shard_size)]
+    ###the chunks of the shards are in memory at the same time
+    shard_chunk_size = max(10000, chunk_size // max(1, shard_workers))
+    def fetch_shard(shard):
+        return connection.retry(lambda sql_engine: fetch_clone_membership(sql_engine, shard, clone_source, shard_chunk_size), "download of a shard of the clones")
+    with ThreadPoolExecutor(max_workers=max(1, shard_workers)) as executor:
+        shard_memberships = list(executor.map(fetch_shard, shards))
+    return pd.concat(shard_memberships, ignore_index=True)
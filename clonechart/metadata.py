@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Sample metadata of an ImmuneDB database, indexed once per run, and the x-axis and y-axis values that are looked up in it.
+"""
+
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+
+###Wide, indexed version of the sample_metadata table, built once per run.
+###table has one row per sample_id and one categorical column per key. The categories are in the order they first appear in sample_metadata.
+###value_samples maps every (key, value) to the sorted array of sample_ids that have it, so the samples of a value are found without scanning the metadata.
+SampleMetadata = namedtuple('SampleMetadata', ['table', 'value_samples'])
+
+def build_sample_metadata(metadata_table):
+    metadata_table = metadata_table[['sample_id', 'key', 'value']].drop_duplicates(['sample_id', 'key'])
+    table = metadata_table.pivot(index='sample_id', columns='key', values='value')
+    for key in table.columns:
+        table[key] = pd.Categorical(table[key], categories=metadata_table['value'].loc[metadata_table['key'] == key].unique())
+    value_samples = {}
+    for (key, value), sample_ids in metadata_table.groupby(['key', 'value'])['sample_id']:
+        value_samples[(key, value)] = np.sort(sample_ids.to_numpy())
+    return SampleMetadata(table, value_samples)
+
+###Values of key among the given samples (all samples if sample_ids is None), in the order they first appear in sample_metadata.
+def get_key_values(sample_metadata, key, sample_ids=None):
+    if key not in sample_metadata.table.columns:
+        return []
+    column = sample_metadata.table[key]
+    if sample_ids is not None:
+        column = column.loc[column.index.intersection(list(sample_ids))]
+    return column.cat.remove_unused_categories().cat.categories.tolist()
+
+###Metadata key of the y-axis. "tissue" and "sample_origin" mean the same thing in different databases, so the one the database has is used.
+def get_y_axis_key(sample_metadata, y_axis_input):
+    if y_axis_input == 'tissue' or y_axis_input == 'sample_origin':
+        for key in ('tissue', 'sample_origin'):
+            if key in sample_metadata.table.columns:
+                return key
+    return y_axis_input
+
+###Number that a pod or timepoint value is sorted by. pod values such as "POD 12" become 12, timepoints such as "12h" or "7d" become days.
+def parse_x_axis_value(x_axis_input, value):
+    if x_axis_input == 'pod':
+        return int(re.sub(r'\D', '', value.split(" ")[0]))
+    if "h" in value:
+        return float(value.replace("h", "")) / 24
+    elif "d" in value:
+        return float(value.replace("d", ""))
+    return float(value)
+
+###Find the x-axis values of a subject. Returns the values in plotting order, along with the labels as they appear in the metadata table.
+###For pod and timepoint, the values are converted to numbers (days) so they can be sorted.
+def get_x_axis_values(sample_metadata, sample_ids, x_axis_input):
+    if x_axis_input == "None":
+        return [""], [""]
+    x_axis_values_unedited = get_key_values(sample_metadata, x_axis_input, sample_ids)
+    if x_axis_input == 'pod' or x_axis_input == 'timepoint': ###timepoint is used in the Influenza dataset
+        ###sort the labels based on their numerical version
+        pairs = sorted(((parse_x_axis_value(x_axis_input, x), x) for x in x_axis_values_unedited), key=lambda pair: pair[0])
+        return [x for x, y in pairs], [y for x, y in pairs]
+    return x_axis_values_unedited, x_axis_values_unedited
+
+###Map the samples of a subject (sample_ids) to the positions of match_values. Returns one row per (sample_id, pos) for every sample that has
+###the value at that position for key. The samples of each value come from the reverse index of sample_metadata.
+def map_samples_to_values(sample_metadata, key, match_values, sample_ids):
+    sample_ids = np.asarray(sorted(sample_ids))
+    value_sample_ids = []
+    for value in match_values:
+        samples = sample_metadata.value_samples.get((key, value), sample_ids[:0])
+        value_sample_ids.append(samples[np.isin(samples, sample_ids, assume_unique=True)])
+    return pd.DataFrame({'sample_id': np.concatenate([sample_ids[:0]] + value_sample_ids),
+                         'pos': np.repeat(np.arange(len(match_values)), [len(x) for x in value_sample_ids])})
+
+###Metadata labels (keys) that are available in the sample_metadata table.
+def get_metadata_labels(metadata_table):
+    return metadata_table['key'].unique().tolist()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of the clone distribution chart and of the clone overlap heatmaps with plotly.
+
+plotly is only imported when a chart is rendered, so counting the clones doesn't need it.
+
+The chart can be drawn in two ways. The original rendering adds one Scatter trace for every x value of every subject and updates the axes
+of each subplot one at a time. The compact rendering puts all the circles of a subject in a single Scattergl (WebGL) trace and sets all the
+axes in one layout update, which is much faster to build and to open when there are many subjects and x values. Both draw the same chart,
+which check_compact_rendering verifies.
+"""
+
+import json
+import math
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .instrument import log_stage, measure_stage
+
+
+###Number of traces of a rendered chart, the seconds it took to build and write it, and the size of the html file in megabytes.
+RenderStats = namedtuple('RenderStats', ['num_traces', 'seconds', 'size_mb'])
+
+###Circles of the subplot of one subject, one row for every cell of its distribution_chart that has clones. The cells of a distribution_chart
+###are in x-major order with one cell per y-axis label, so the x and y positions of a circle (counted from 1) come from its row number.
+def get_subplot_markers(distribution_chart, total_tissue_list, tissue_color_dict):
+    num_y = max(1, len(total_tissue_list))
+    cells = np.arange(len(distribution_chart))
+    markers = pd.DataFrame({'x': cells // num_y + 1, 'y': cells % num_y + 1,
+                            'size': distribution_chart['num_clones'].to_numpy(), 'num_samples': distribution_chart['num_samples'].to_numpy()})
+    if len(total_tissue_list) > 0:
+        labels = [total_tissue_list[y - 1] for y in markers['y']]
+        markers['color'] = [tissue_color_dict[x] for x in labels]
+        ###allografted tissues get an outline
+        markers['line_width'] = [2 if 'allograft' in x else 0 for x in labels]
+    else:
+        markers['color'] = 'black'
+        markers['line_width'] = 0
+    ###only add circles for the cells that have clones
+    return markers.loc[markers['size'] != 0].reset_index(drop=True)
+
+###Scatter trace of the circles in markers (made by get_subplot_markers), as a dict.
+def make_marker_trace(markers):
+    return dict(
+        x=markers['x'].tolist(), y=markers['y'].tolist(),
+        text=['Clones: ' + str(round(size, 1)) + "%" +
+              '<br>Samples: ' + str(num_samples)
+              for size, num_samples in zip(markers['size'].tolist(), markers['num_samples'].tolist())],
+        mode='markers',
+        showlegend=False,
+        marker=dict(
+            size=markers['size'].tolist(),
+            sizemin=4,
+            color=markers['color'].tolist(),
+            line=dict(
+                color=['orchid' for x in range(len(markers))],
+                width=markers['line_width'].tolist()),
+            opacity=1,
+                    )
+    )
+
+###Names of the x and y axes of a subplot in the layout ("xaxis2", "yaxis2"). make_subplots numbers the subplots row by row.
+###Traces refer to the axes without "axis" ("x2", "y2").
+def get_subplot_axes(row, col, num_cols):
+    number = (row - 1) * num_cols + col
+    suffix = str(number) if number > 1 else ''
+    return 'xaxis' + suffix, 'yaxis' + suffix
+
+
+###Build the figure of the clone distribution chart. summaries maps every subject_id of subjects_dict to its SubjectSummary, and the subplots are in the order of subjects_dict.
+###total_tissue_list is the list of y-axis labels in plotting order, and tissue_color_dict has the color of each of them.
+###If compact is True, each subject is drawn with a single Scattergl trace, and the traces and the axes of the subplots are added in one go
+###to the plain dict of the figure, which is returned instead of a go.Figure. plotly then doesn't validate every circle one at a time.
+def build_clone_distribution_figure(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database, compact=False):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    
+    if len(subjects_dict) < 4:
+        ###find total number of rows for subplots
+        num_rows = 1 ###math.ceil rounds up, so that there will be enough subplot spaces if number of subjects is odd
+        num_cols = 3
+        
+        fig = make_subplots(rows=num_rows, cols=num_cols, subplot_titles=["temp" for x in range(len(subjects_dict))], shared_yaxes=True, vertical_spacing=0.031, horizontal_spacing=0.01, 
+           )
+    else:                                       
+        ###find total number of rows for subplots
+        num_rows = math.ceil(len(subjects_dict)/2) ###math.ceil rounds up, so that there will be enough subplot spaces if number of subjects is odd
+        num_cols = round(len(subjects_dict)/2)
+        
+        fig = make_subplots(rows=num_rows, cols=num_cols, subplot_titles=["temp" for x in range(len(subjects_dict))], shared_yaxes=True, vertical_spacing=0.031, horizontal_spacing=0.01, 
+                            ) 
+    # =============================================================================
+    # Now build the subplots for each subject  
+    # =============================================================================
+    row_counter = 1
+    col_counter = 1
+    tissue_legend = []
+    num_clones_dict = {}
+    subplot_titles = []
+    layout_update = {}
+    traces = []
+    for subject_id in subjects_dict.keys():
+    # for subject_id in [1]:
+        distribution_chart, num_clones_dict[subject_id], x_axis_values_sorted, x_axis_values_unedited_sorted, overlap = summaries[subject_id]
+        
+        ###make the titles of the subplots
+        subplot_titles.append("<b>" + subjects_dict[subject_id] + "</b><br>" + str(f'{num_clones_dict[subject_id]:,}') + " clones") 
+        
+        # =============================================================================
+        # Add the circles of the subject to the graph
+        # =============================================================================
+        markers = get_subplot_markers(distribution_chart, total_tissue_list, tissue_color_dict)
+        x_axis_name, y_axis_name = get_subplot_axes(row_counter, col_counter, num_cols)
+        if compact:
+            traces.append(dict(make_marker_trace(markers), type='scattergl', xaxis=x_axis_name.replace('axis', ''), yaxis=y_axis_name.replace('axis', '')))
+        else:
+            ###one trace for each x value
+            for x_axis_counter in range(1, len(x_axis_values_sorted) + 1):
+                fig.add_trace(go.Scatter(make_marker_trace(markers.loc[markers['x'] == x_axis_counter])), row=row_counter, col=col_counter)
+            
+        ###fix x-axis values from the numerical value to its corresponding label
+        if x_axis_input == 'timepoint':                       
+            x_tick_text = ["<b>" + str(x) + "<b>" for x in x_axis_values_unedited_sorted]    
+        else:                       
+            x_tick_text = ["<b>" + str(x) + "<b>" for x in x_axis_values_sorted]    
+        x_axis_update = dict(
+            ticktext=x_tick_text,
+            tickvals=[x for x in range(1, len(x_axis_values_sorted) + 1)],
+            tickangle=90,
+        )
+                              
+        ###add this subject's tissues to tissue_legend list      
+        temp = total_tissue_list
+        for tissue in temp:           
+            if tissue not in tissue_legend:               
+                tissue_legend.append(tissue)
+        
+        ###change y-axis values from the numerical value to its corresponding label
+        y_axis_update = dict(
+            ticktext=temp,
+            tickfont=dict(
+                 family="Arial",
+                 color="black"
+                ),
+            tickvals=[x for x in range(1, len(total_tissue_list) + 1)],
+        )
+        if compact:
+            layout_update[x_axis_name] = x_axis_update
+            layout_update[y_axis_name] = y_axis_update
+        else:
+            fig.update_xaxes(row=row_counter, col=col_counter, **x_axis_update)
+            fig.update_yaxes(row=row_counter, col=col_counter, **y_axis_update)
+                   
+        col_counter += 1      
+        if col_counter > num_cols:         
+            row_counter += 1
+            col_counter = 1
+ 
+    ###add allograft outline legend
+    if any('allograft' in tissue for tissue in total_tissue_list):
+        fig.add_trace(go.Scatter(
+            x=[None], y=[None],
+            mode='markers',
+            showlegend=True,
+            name="allografted tissue",
+            marker=dict(
+                size=20,
+                color='white',
+                line=dict(
+                    color='orchid',
+                    width=2),
+                opacity=1,    
+            )
+        ),row=1, col=1)
+        
+    ###add tissue legend
+    tissue_legend_sorted = [x for x in tissue_color_dict.keys() if x in tissue_legend]
+    for tissue in tissue_legend_sorted:
+        
+        if 'allograft' not in tissue:
+            
+            fig.add_trace(go.Scatter(
+                x=[None], y=[None],
+                mode='markers',
+                showlegend=True,
+                name=tissue,
+                marker=dict(
+                    size=20,
+                    color=tissue_color_dict[tissue],         
+                    opacity=1,    
+                )
+            ),row=1, col=1)
+
+        else:
+        
+            fig.add_trace(go.Scatter(
+                x=[None], y=[None],
+                mode='markers',
+                showlegend=True,
+                name=tissue,
+                marker=dict(
+                    size=20,
+                    color=tissue_color_dict[tissue],         
+                    opacity=1,
+                    line=dict(
+                        color="Orchid",
+                        width=2,
+                        ),
+                )
+            ),row=1, col=1)
+                
+    ###Update subplot titles
+    if not compact:
+        for i, subplot_title in zip(fig['layout']['annotations'], subplot_titles):
+                i['text'] = subplot_title
+                i['font'] = dict(size=30, color='black', family="Arial")
+
+    fig.update_layout(plot_bgcolor='whitesmoke', title='Clone Distribution Chart for: ' + str(database),
+                       height=1300 * num_rows / 2,
+                       width=1200 * num_cols / 3,
+                      font=dict(
+                                family="Courier New, monospace",
+                                size=20,
+                                color="black"
+                               ),
+                      margin=dict(
+                            # l=50,
+                            # r=50,
+                            # b=100,
+                            t=180,
+                            # pad=4
+                        ),
+    )    
+    if compact:
+        figure = fig.to_dict()
+        figure['data'] = traces + figure['data']
+        for axis_name, axis_update in layout_update.items():
+            figure['layout'][axis_name].update(axis_update)
+        for i, subplot_title in zip(figure['layout']['annotations'], subplot_titles):
+            i.update(text=subplot_title, font=dict(size=30, color='black', family="Arial"))
+        return figure
+    return fig
+
+###Write a figure (a go.Figure or a figure dict) to an html file. A dict is written as it is, without validating it. plotlyjs is where the page gets the plotly.js library (a few megabytes) from:
+###"inline" puts it in the html file, which then works offline. "cdn" loads it from the plotly CDN.
+###"shared" writes it once to plotly-<version>.min.js next to the html file, so that many charts in the same folder share one copy.
+###A path ending in .js (relative to the html file) works like "shared" with that file.
+def write_figure(fig, path, plotlyjs='inline'):
+    import plotly
+    import plotly.io as pio
+    if plotlyjs == 'inline':
+        include_plotlyjs = True
+    elif plotlyjs == 'cdn':
+        include_plotlyjs = 'cdn'
+    elif plotlyjs == 'shared' or plotlyjs.endswith('.js'):
+        if plotlyjs == 'shared':
+            plotlyjs = 'plotly-{}.min.js'.format(plotly.__version__)
+        bundle_path = os.path.join(os.path.dirname(os.path.abspath(path)), plotlyjs)
+        if not os.path.exists(bundle_path):
+            from plotly.offline import get_plotlyjs
+            os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+            with open(bundle_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(get_plotlyjs())
+            os.replace(bundle_path + '.tmp', bundle_path)
+        include_plotlyjs = plotlyjs.replace(os.sep, '/')
+    else:
+        raise ValueError("plotlyjs must be 'inline', 'cdn', 'shared' or the path of a .js file, not {!r}".format(plotlyjs))
+    pio.write_html(fig, file=path, include_plotlyjs=include_plotlyjs, validate=not isinstance(fig, dict))
+
+###The html page of a figure (a go.Figure or a figure dict), for pages that are not written to a file. plotlyjs is "inline", "cdn", or the url of
+###plotly.js for a page that is served next to it.
+def get_figure_html(fig, plotlyjs='inline'):
+    import plotly.io as pio
+    include_plotlyjs = {'inline': True, 'cdn': 'cdn'}.get(plotlyjs, plotlyjs)
+    return pio.to_html(fig, include_plotlyjs=include_plotlyjs, validate=not isinstance(fig, dict))
+
+###Draw the clone distribution chart (see build_clone_distribution_figure) and write it to path (see write_figure). Returns its RenderStats.
+def render_clone_distribution_chart(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, path, database, compact=False, plotlyjs='inline'):
+    start = time.perf_counter()
+    fig = build_clone_distribution_figure(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database, compact)
+    build_seconds = time.perf_counter() - start
+    log_stage('build figure', build_seconds, num_subjects=len(summaries), num_traces=len(fig['data']), compact=compact)
+    write_figure(fig, path, plotlyjs)
+    render_stats = RenderStats(len(fig['data']), time.perf_counter() - start, os.path.getsize(path) / 1024**2)
+    log_stage('write html', render_stats.seconds - build_seconds, path=path, bytes=os.path.getsize(path), plotlyjs=plotlyjs)
+    return render_stats
+
+###What a reader sees in a clone distribution figure: every circle (its subplot, position, size, color, outline and hover text),
+###the axis labels, the legend and the titles. The circles are sorted, so figures that draw them with different traces give the same output.
+def get_visible_output(fig):
+    import plotly.io as pio
+    figure = json.loads(pio.to_json(fig, validate=False))
+    circles = []
+    legend = []
+    for trace in figure['data']:
+        if trace.get('showlegend'):
+            legend.append((trace.get('name'), json.dumps(trace.get('marker'), sort_keys=True)))
+            continue
+        marker = trace['marker']
+        num_circles = len(trace['x'])
+        for i in range(num_circles):
+            circles.append((trace.get('xaxis', 'x'), trace['x'][i], trace['y'][i], marker['size'][i], marker['color'][i], marker['line']['width'][i],
+                            marker['line']['color'][i], trace['text'][i]))
+    layout = figure['layout']
+    axes = {x: (y.get('ticktext'), y.get('tickvals'), y.get('tickangle')) for x, y in layout.items() if x.startswith('xaxis') or x.startswith('yaxis')}
+    titles = [(x['text'], json.dumps(x.get('font'), sort_keys=True)) for x in layout.get('annotations', [])] + [layout['title']['text']]
+    return {'circles': sorted(circles), 'axes': axes, 'legend': legend, 'titles': titles, 'size': (layout.get('height'), layout.get('width'))}
+
+###Check that the compact rendering draws the same chart as the original one. Returns the parts of the visible output that differ (none if they match).
+def check_compact_rendering(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database):
+    original = get_visible_output(build_clone_distribution_figure(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database, compact=False))
+    compact = get_visible_output(build_clone_distribution_figure(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database, compact=True))
+    return [x for x in original if original[x] != compact[x]]
+
+###Write one heatmap per subject with the number of clones shared by each pair of labels (made by build_overlap_matrix).
+def make_overlap_chart(overlap_dict, subjects_dict, overlap_path, database, plotlyjs='inline'):
+    with measure_stage('overlap chart', path=overlap_path, num_subjects=len(overlap_dict)):
+        import plotly.graph_objects as go
+        from plotly.subplots import make_subplots
+    
+        num_cols = min(3, max(1, len(overlap_dict)))
+        num_rows = math.ceil(len(overlap_dict) / num_cols)
+        fig = make_subplots(rows=max(1, num_rows), cols=num_cols, subplot_titles=["<b>" + subjects_dict[x] + "</b>" for x in overlap_dict.keys()], horizontal_spacing=0.08, vertical_spacing=0.12)
+        for i, overlap in enumerate(overlap_dict.values()):
+            fig.add_trace(go.Heatmap(
+                z=overlap.values,
+                x=[str(x) for x in overlap.columns],
+                y=[str(x) for x in overlap.index],
+                coloraxis='coloraxis',
+                hovertemplate='%{y} / %{x}<br>Shared clones: %{z:,}<extra></extra>',
+            ), row=i // num_cols + 1, col=i % num_cols + 1)
+        fig.update_yaxes(autorange='reversed')
+        fig.update_layout(title='Clone Overlap for: ' + str(database),
+                          coloraxis=dict(colorscale='Blues'),
+                          height=500 * max(1, num_rows),
+                          width=550 * num_cols,
+                          font=dict(family="Arial", color="black"),
+        )
+        write_figure(fig, overlap_path, plotlyjs)
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Chart service: a local HTTP server that keeps the database connections open and the loaded data in memory, and draws charts on request.
+
+    clonechart serve databases.json --http-port 8050 --memory-budget-mb 4096
+
+databases.json lists the databases that the service can draw, with the connection settings of clonechart.Connection, like the job spec of
+batch mode (without the charts):
+    {"databases": [{"database": "lp15", "user": "username", "ssh_host": "10.0.0.1", "ssh_username": "username"}, {"url": "sqlite:///influenza.sqlite"}]}
+The passwords that are not in the file are read from the CLONECHART_PASSWORD and CLONECHART_SSH_PASSWORD environment variables.
+
+Requests:
+    GET  /                                          the databases of the service, as json
+    GET  /chart?database=lp15&y=tissue&x=timepoint  the clone distribution chart as an html page. Optional: colors={"PBMC": "#67001f", ...}
+                                                    (order and colors of the y-axis labels) and rendering=original
+    GET  /labels?database=lp15                      the metadata labels that can be used for the axes, as json
+    GET  /status                                    what is kept in memory, as json
+    POST /reload?database=lp15                      forget everything that was loaded from the database, after it was changed
+
+The tables of every database, the clone matrix of every subject and the rendered pages are kept in one least recently used cache. When
+their size goes over the memory budget, the entries that were used the longest time ago are dropped, and loaded again when they are needed.
+A page is rendered once for every set of parameters, and the clones of a subject are downloaded once for all the charts.
+The connections (and their ssh tunnels) are opened on the first request of a database and stay open until the service stops.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from .aggregate import CloneMatrix, build_clone_matrix, summarize_subject
+from .batch import CONNECTION_SETTINGS, get_spec_connection
+from .chart import get_clone_loader, get_y_axis_labels, load_chart_data
+from .metadata import get_metadata_labels, get_y_axis_key
+from .render import build_clone_distribution_figure, get_figure_html
+
+
+###Everything about a database that the charts are counted from, without its tables. The clone matrices of the subjects are kept separately.
+Dataset = namedtuple('Dataset', ['subjects_dict', 'samples_dict', 'sample_metadata', 'labels', 'clone_source', 'chunk_size'])
+
+###Approximate memory used by a value that is kept in the MemoryLRU, in megabytes.
+def get_size_mb(value):
+    if isinstance(value, bytes):
+        return len(value) / 1024**2
+    if isinstance(value, pd.DataFrame):
+        return value.memory_usage(deep=True).sum() / 1024**2
+    if isinstance(value, CloneMatrix):
+        matrix = value.matrix
+        return (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes + value.clone_ids.nbytes + value.sample_ids.nbytes) / 1024**2
+    if isinstance(value, Dataset):
+        sample_metadata = value.sample_metadata
+        return (get_size_mb(sample_metadata.table) + sum(x.nbytes for x in sample_metadata.value_samples.values()) / 1024**2
+                + sum(len(x) for x in value.samples_dict.values()) * 32 / 1024**2)
+    raise TypeError("Can't measure the size of {!r}".format(type(value).__name__))
+
+
+class MemoryLRU:
+    """Least recently used cache with a memory budget in megabytes.
+
+    Entries are dropped, starting with the one that was used the longest time ago, when the total size goes over budget_mb. The entry that
+    was just added is never dropped, so an entry that is bigger than the budget is still kept until the next one is added.
+    get_or_load loads a missing entry only once when several threads ask for it at the same time. The lock that makes them wait is only
+    kept while the entry is loaded, so keys that come from requests don't pile up.
+    """
+
+    def __init__(self, budget_mb):
+        self.budget_mb = budget_mb
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size_mb = 0.0
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    @property
+    def size_mb(self):
+        return self._size_mb
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, size_mb=None):
+        if size_mb is None:
+            size_mb = get_size_mb(value)
+        with self._lock:
+            if key in self._entries:
+                self._size_mb -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size_mb)
+            self._size_mb += size_mb
+            while self._size_mb > self.budget_mb and len(self._entries) > 1:
+                self._size_mb -= self._entries.popitem(last=False)[1][1]
+        return value
+
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            try:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                        return self._entries[key][0]
+                return self.put(key, load())
+            finally:
+                ###the threads that already wait for this lock find the entry, later ones find it without a lock
+                with self._lock:
+                    if self._load_locks.get(key) is load_lock:
+                        del self._load_locks[key]
+
+    ###Drop the entries whose key matches, such as all the entries of one database.
+    def discard(self, match):
+        with self._lock:
+            for key in [x for x in self._entries if match(x)]:
+                self._size_mb -= self._entries.pop(key)[1]
+
+    ###(key, size_mb) of every entry, from the least to the most recently used.
+    def items(self):
+        with self._lock:
+            return [(x, y[1]) for x, y in self._entries.items()]
+
+
+class ChartService:
+    """Draws the charts of a fixed set of databases, keeping what was loaded in a MemoryLRU of memory_budget_mb megabytes.
+
+    connections maps the name of every database to its Connection. The other settings are the ones of make_clone_distribution_chart.
+    plotlyjs is "inline" or "cdn", or the url that the pages load plotly.js from (the HTTP server serves it at /plotly.min.js).
+    Every chart is counted with the "pandas" aggregation engine from the clone matrices in memory, so a new chart of a database that was
+    already loaded doesn't download anything.
+    """
+
+    def __init__(self, connections, memory_budget_mb=4096, clone_source='auto', memory_limit_mb=1024, num_workers=1, cache_dir=None,
+                 cache_offline=False, plotlyjs='/plotly.min.js'):
+        self.connections = dict(connections)
+        self.memory = MemoryLRU(memory_budget_mb)
+        self.clone_source = clone_source
+        self.memory_limit_mb = memory_limit_mb
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+        self.cache_offline = cache_offline
+        self.plotlyjs = plotlyjs
+
+    def get_connection(self, database):
+        if database not in self.connections:
+            raise KeyError("Unknown database {!r}, the service has: {}".format(database, ", ".join(self.connections)))
+        return self.connections[database]
+
+    def get_dataset(self, database):
+        connection = self.get_connection(database)
+        def load():
+            data = load_chart_data(connection, database, self.clone_source, self.memory_limit_mb, self.num_workers, self.cache_dir, self.cache_offline)
+            return Dataset(data.subjects_dict, data.samples_dict, data.sample_metadata, get_metadata_labels(data.metadata_table), data.clone_source, data.chunk_size)
+        return self.memory.get_or_load(('dataset', database), load)
+
+    def get_clone_matrix(self, database, dataset, subject_id):
+        connection = self.get_connection(database)
+        def load():
+            print("Loading {} table for {}.".format(dataset.clone_source, dataset.subjects_dict[subject_id]))
+            return build_clone_matrix(get_clone_loader(connection, dataset, subject_id, cache_dir=self.cache_dir, database=database, cache_offline=self.cache_offline)())
+        return self.memory.get_or_load(('clones', database, subject_id), load)
+
+    ###Html page of the clone distribution chart of a database. The page is rendered once for every set of parameters.
+    def get_chart(self, database, y_axis_input='None', x_axis_input='None', tissue_color_dict=None, compact_rendering=True):
+        tissue_color_dict = tissue_color_dict or {}
+        dataset = self.get_dataset(database)
+        for label in (y_axis_input, x_axis_input):
+            if label != 'None' and get_y_axis_key(dataset.sample_metadata, label) not in dataset.labels:
+                raise ValueError("{} has no metadata label {!r}".format(database, label))
+        key = ('chart', database, y_axis_input, x_axis_input, json.dumps(tissue_color_dict), compact_rendering)
+        def render():
+            y_axis_key, total_tissue_list, chart_colors = get_y_axis_labels(dataset.sample_metadata, y_axis_input, tissue_color_dict)
+            def summarize(subject_id):
+                clone_matrix = self.get_clone_matrix(database, dataset, subject_id)
+                return summarize_subject(None, dataset.subjects_dict[subject_id], dataset.samples_dict[subject_id], dataset.sample_metadata, x_axis_input,
+                                         y_axis_key, total_tissue_list, 'pandas', dataset.clone_source, clone_matrix=clone_matrix)
+            if self.num_workers > 1:
+                with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                    summaries = dict(zip(dataset.subjects_dict.keys(), executor.map(summarize, dataset.subjects_dict.keys())))
+            else:
+                summaries = {x: summarize(x) for x in dataset.subjects_dict.keys()}
+            fig = build_clone_distribution_figure(summaries, dataset.subjects_dict, total_tissue_list, chart_colors, x_axis_input, database, compact_rendering)
+            return get_figure_html(fig, self.plotlyjs).encode('utf-8')
+        return self.memory.get_or_load(key, render)
+
+    def get_labels(self, database):
+        return self.get_dataset(database).labels
+
+    ###Forget everything that was loaded from a database, so that the next chart sees its changes.
+    def reload(self, database):
+        self.get_connection(database)
+        self.memory.discard(lambda key: key[1] == database)
+
+    def get_status(self):
+        entries = [{'kind': x[0], 'database': x[1], 'key': [str(y) for y in x[2:]], 'size_mb': round(size_mb, 3)} for x, size_mb in self.memory.items()]
+        return {'databases': {x: y.is_open for x, y in self.connections.items()}, 'memory_budget_mb': self.memory.budget_mb,
+                'memory_mb': round(self.memory.size_mb, 3), 'hits': self.memory.hits, 'misses': self.memory.misses, 'entries': entries}
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+###Connections of the databases of a service config (a dict like the one described at the top, or the path of its json file), by name.
+def load_service_connections(config, pool_size=5):
+    if not isinstance(config, dict):
+        with open(config) as f:
+            config = json.load(f)
+    if len(config.get('databases', [])) == 0:
+        raise ValueError("The service config has no databases")
+    connections = {}
+    for i, database_spec in enumerate(config['databases']):
+        unknown = sorted(set(database_spec) - set(CONNECTION_SETTINGS))
+        if len(unknown) > 0:
+            raise ValueError("Unknown settings in database {}: {}".format(i + 1, ", ".join(unknown)))
+        connection = get_spec_connection(database_spec, pool_size)
+        if connection.name is None:
+            raise ValueError("Database {} has no connection settings".format(i + 1))
+        connections[connection.name] = connection
+    return connections
+
+
+class ChartRequestHandler(BaseHTTPRequestHandler):
+    """Answers the requests described at the top with the ChartService of the server."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {x: y[-1] for x, y in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == '/':
+            self.respond(200, service.get_status()['databases'])
+        elif url.path == '/status':
+            self.respond(200, service.get_status())
+        elif url.path == '/plotly.min.js':
+            self.respond(200, self.server.get_plotlyjs(), 'application/javascript')
+        elif url.path == '/labels':
+            self.handle_request(lambda: service.get_labels(params.get('database')))
+        elif url.path == '/chart':
+            def get_chart():
+                tissue_color_dict = json.loads(params['colors'], object_pairs_hook=OrderedDict) if params.get('colors') else {}
+                return service.get_chart(params.get('database'), params.get('y', 'None'), params.get('x', 'None'), tissue_color_dict,
+                                         params.get('rendering', 'compact') != 'original')
+            self.handle_request(get_chart, 'text/html; charset=utf-8')
+        else:
+            self.respond(404, {'error': "Unknown path " + url.path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = {x: y[-1] for x, y in parse_qs(url.query).items()}
+        if url.path == '/reload':
+            def reload():
+                self.server.service.reload(params.get('database'))
+                return {'reloaded': params.get('database')}
+            self.handle_request(reload)
+        else:
+            self.respond(404, {'error': "Unknown path " + url.path})
+
+    ###Answer with what get_response returns, or with the error it raised: 404 for an unknown database, 400 for bad parameters.
+    def handle_request(self, get_response, content_type='application/json'):
+        start = time.perf_counter()
+        try:
+            response = get_response()
+        except KeyError as e:
+            self.respond(404, {'error': str(e.args[0]) if e.args else str(e)})
+            return
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.respond(500, {'error': "{}: {}".format(type(e).__name__, e)})
+            raise
+        self.respond(200, response, content_type)
+        self.log_message("%s answered in %.2f seconds", self.path, time.perf_counter() - start)
+
+    def respond(self, status, response, content_type='application/json'):
+        if not isinstance(response, bytes):
+            response = json.dumps(response).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class ChartServer(ThreadingMixIn, HTTPServer):
+    """HTTP server of a ChartService. Every request is answered in its own thread."""
+
+    daemon_threads = True
+
+    def __init__(self, service, host='127.0.0.1', port=8050):
+        super().__init__((host, port), ChartRequestHandler)
+        self.service = service
+        self._plotlyjs = None
+
+    def get_plotlyjs(self):
+        if self._plotlyjs is None:
+            from plotly.offline import get_plotlyjs
+            self._plotlyjs = get_plotlyjs().encode('utf-8')
+        return self._plotlyjs
+
+
+###Serve the charts of a ChartService at http://host:port until the process is stopped, then close its connections.
+def serve(service, host='127.0.0.1', port=8050):
+    server = ChartServer(service, host, port)
+    print("Serving the charts of {} at http://{}:{}/".format(", ".join(service.connections), host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+HyperLogLog sketches of the clones of samples, for the "approximate" aggregation engine.
+
+A sketch keeps 2 ** precision one-byte registers per sample instead of the sample's clone_ids (16 KB per sample with the default precision
+of 14), however many clones the sample has. The sketch of a group of samples is the element-wise maximum of their registers, so the sketches
+of a cell of the chart, of a whole subject, of the chunks of a download or of the shards of a subject are merged without going back to the
+clones, and every clone is counted once however many samples it is in.
+
+The number of distinct clones is estimated from the registers with the improved raw estimator of Ertl ("New cardinality estimation
+algorithms for HyperLogLog sketches", 2017), which needs no bias correction tables. Its relative standard error is 1.04 / sqrt(2 ** precision),
+0.81% with the default precision: about 68% of the estimates are within one standard error of the exact count, 95% within two and 99.7%
+within three. Small counts are close to exact. The percentage of a cell is the ratio of two estimates, so it can be off by a little more.
+
+clonechart chart --aggregation-engine approximate --check-approximation counts the clones both ways and reports how far apart they are.
+"""
+
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .aggregate import get_cell_samples, make_distribution_chart
+from .connection import as_connection
+from .instrument import log_stage
+from .loading import get_clone_membership_query
+
+
+DEFAULT_PRECISION = 14
+###An estimate further than this many standard errors from the exact count fails the check of the approximate engine. With the default
+###precision, about one count in two million is that far off by chance.
+MAX_APPROXIMATION_ERROR = 5
+
+###HyperLogLog sketches of some samples. registers[i] are the 2 ** precision registers of sample sample_ids[i].
+CloneSketches = namedtuple('CloneSketches', ['registers', 'sample_ids', 'precision'])
+
+###Relative standard error of an estimate made with 2 ** precision registers.
+def get_relative_error(precision=DEFAULT_PRECISION):
+    return 1.04 / math.sqrt(2 ** precision)
+
+###64-bit hashes of integer clone_ids (the splitmix64 finalizer), so that the bits of the hashes of consecutive ids look random.
+def hash_clone_ids(clone_ids):
+    with np.errstate(over='ignore'):
+        z = np.asarray(clone_ids).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+###Number of leading zero bits of every 64-bit value.
+def count_leading_zeros(values):
+    values = values.copy()
+    zeros = np.zeros(len(values), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_zero = values < np.uint64(1 << (64 - shift))
+        zeros[top_zero] += shift
+        values[top_zero] <<= np.uint64(shift)
+    zeros[values == 0] += 1
+    return zeros
+
+###Empty sketches of the given samples.
+def make_clone_sketches(sample_ids, precision=DEFAULT_PRECISION):
+    sample_ids = np.asarray(sorted(int(x) for x in sample_ids), dtype=np.int64)
+    return CloneSketches(np.zeros((len(sample_ids), 2 ** precision), dtype=np.uint8), sample_ids, precision)
+
+###Add (sample_id, clone_id) pairs, such as a chunk of a download, to the sketches of their samples. The sketches are changed in place.
+###Pairs that were already added don't change the sketches, so the pairs don't have to be distinct.
+def add_to_sketches(sketches, sample_ids, clone_ids):
+    rows = np.searchsorted(sketches.sample_ids, np.asarray(sample_ids, dtype=np.int64))
+    hashes = hash_clone_ids(clone_ids)
+    ###the first precision bits of the hash pick the register, the position of the first 1 bit in the rest is the value it gets
+    registers = (hashes >> np.uint64(64 - sketches.precision)).astype(np.int64)
+    ranks = np.minimum(count_leading_zeros(hashes << np.uint64(sketches.precision)), 64 - sketches.precision) + 1
+    np.maximum.at(sketches.registers, (rows, registers), ranks.astype(np.uint8))
+    return sketches
+
+###Sketches of all the samples of a and b. The registers of a sample that is in both are merged.
+def merge_sketches(a, b):
+    if a.precision != b.precision:
+        raise ValueError("Sketches with precision {} and {} can't be merged".format(a.precision, b.precision))
+    merged = make_clone_sketches(np.union1d(a.sample_ids, b.sample_ids), a.precision)
+    for sketches in (a, b):
+        rows = np.searchsorted(merged.sample_ids, sketches.sample_ids)
+        merged.registers[rows] = np.maximum(merged.registers[rows], sketches.registers)
+    return merged
+
+def sigma(x):
+    if x == 1:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x = x * x
+        z_old = z
+        z += x * y
+        y += y
+        if z == z_old:
+            return z
+
+def tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        z_old = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == z_old:
+            return z / 3
+
+###Estimated number of distinct clones of every row of registers (a 2d array with one merged sketch per row).
+def estimate_distinct(registers):
+    registers = np.atleast_2d(registers)
+    m = registers.shape[1]
+    q = 64 - int(math.log2(m))
+    estimates = []
+    for counts in (np.bincount(x, minlength=q + 2) for x in registers):
+        z = m * tau(1 - counts[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + counts[k])
+        z += m * sigma(counts[0] / m)
+        estimates.append(m * m / (2 * math.log(2)) / z)
+    return np.array(estimates)
+
+###Download the clone membership of the given samples from clone_source like loading.fetch_clone_membership does, but only keep the sketches
+###of the samples. The memory used is set by the chunk size and the number of samples, not by the number of clones.
+def fetch_clone_sketches(sql_engine, sample_ids, clone_source='sequences', chunk_size=1000000, precision=DEFAULT_PRECISION):
+    sketches = make_clone_sketches(sample_ids, precision)
+    if len(sketches.sample_ids) == 0:
+        return sketches
+    query = get_clone_membership_query(clone_source)
+    start = time.perf_counter()
+    fetched_rows = 0
+    with sql_engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        for chunk in pd.read_sql_query(query, connection, params={'sample_ids': sketches.sample_ids.tolist()}, chunksize=chunk_size):
+            add_to_sketches(sketches, chunk['sample_id'].to_numpy(), chunk['clone_id'].to_numpy())
+            fetched_rows += len(chunk)
+    log_stage('fetch sketches', time.perf_counter() - start, clone_source=clone_source, num_samples=len(sketches.sample_ids), rows=fetched_rows,
+              bytes=int(sketches.registers.nbytes))
+    return sketches
+
+###Download the sketches of the given samples, in shards of shard_size samples over shard_workers connections like loading.load_clone_membership.
+def load_clone_sketches(connection, sample_ids, clone_source='sequences', chunk_size=1000000, shard_size=0, shard_workers=1, precision=DEFAULT_PRECISION):
+    sample_ids = sorted(int(x) for x in sample_ids)
+    connection = as_connection(connection)
+    if not shard_size or len(sample_ids) <= shard_size:
+        return connection.retry(lambda sql_engine: fetch_clone_sketches(sql_engine, sample_ids, clone_source, chunk_size, precision), "download of the clones")
+    from concurrent.futures import ThreadPoolExecutor
+    shards = [sample_ids[i:i + shard_size] for i in range(0, len(sample_ids), shard_size)]
+    shard_chunk_size = max(10000, chunk_size // max(1, shard_workers))
+    def fetch_shard(shard):
+        return connection.retry(lambda sql_engine: fetch_clone_sketches(sql_engine, shard, clone_source, shard_chunk_size, precision), "download of a shard of the clones")
+    with ThreadPoolExecutor(max_workers=max(1, shard_workers)) as executor:
+        shard_sketches = list(executor.map(fetch_shard, shards))
+    sketches = shard_sketches[0]
+    for x in shard_sketches[1:]:
+        sketches = merge_sketches(sketches, x)
+    return sketches
+
+###Sketches of (sample_id, clone_id) pairs that were already downloaded, for example from the cache.
+def build_clone_sketches(clone_membership, sample_ids, precision=DEFAULT_PRECISION):
+    sketches = make_clone_sketches(sample_ids, precision)
+    return add_to_sketches(sketches, clone_membership['sample_id'].to_numpy(), clone_membership['clone_id'].to_numpy())
+
+###Merged sketch of every cell of cell_samples, one row per cell. Cells without samples have empty sketches.
+def get_cell_sketches(sketches, cell_samples):
+    cell_registers = np.zeros((len(cell_samples.cells), sketches.registers.shape[1]), dtype=np.uint8)
+    rows = np.searchsorted(sketches.sample_ids, cell_samples.cell_samples['sample_id'].to_numpy())
+    for pos, sample_rows in pd.Series(rows).groupby(cell_samples.cell_samples['pos'].to_numpy()):
+        cell_registers[pos] = sketches.registers[sample_rows.to_numpy()].max(axis=0)
+    return cell_registers
+
+###Build the dataframe for the graph of one subject from the sketches of its samples. This is the "approximate" aggregation engine.
+###The samples are mapped to the cells like build_distribution_chart does. Returns the dataframe and the estimated number of clones of the subject.
+def build_distribution_chart_approximate(sketches, sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list):
+    cell_samples = get_cell_samples(sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list)
+    total_clones = int(round(estimate_distinct(sketches.registers.max(axis=0, initial=0))[0]))
+    ###a cell can't have more clones than its subject, even if its estimate is a little higher
+    cell_clones = np.minimum(estimate_distinct(get_cell_sketches(sketches, cell_samples)), total_clones)
+    return make_distribution_chart(cell_samples, cell_clones, total_clones), total_clones
+
+###How far the clone counts of the approximate engine are from the exact ones: the number of counts compared (the cells and the totals of the
+###subjects), the relative standard error of the sketches, the shares of the counts within one, two and three standard errors of the exact
+###count, and the largest error, in standard errors. The standard error of a count is never taken as less than one clone, since a cell of a
+###few clones that loses one to two clones falling on the same register is far more than 1% off.
+ApproximationCheck = namedtuple('ApproximationCheck', ['num_counts', 'relative_error', 'within_one', 'within_two', 'within_three', 'max_error'])
+
+###Compare the SubjectSummary of every subject made by the approximate engine with the one made by an exact engine.
+def check_approximate_summaries(approximate_summaries, exact_summaries, precision=DEFAULT_PRECISION):
+    relative_error = get_relative_error(precision)
+    errors = []
+    for subject_id, exact in exact_summaries.items():
+        approximate = approximate_summaries[subject_id]
+        if list(approximate.distribution_chart['x_axis']) != list(exact.distribution_chart['x_axis']) or list(approximate.distribution_chart['y_axis']) != list(exact.distribution_chart['y_axis']):
+            raise ValueError("The approximate and the exact chart of subject {} don't have the same cells".format(subject_id))
+        ###the charts have percentages of the subject's clones, turn them back into clone counts
+        exact_clones = np.append(exact.distribution_chart['num_clones'].to_numpy() * exact.num_clones / 100, exact.num_clones)
+        approximate_clones = np.append(approximate.distribution_chart['num_clones'].to_numpy() * approximate.num_clones / 100, approximate.num_clones)
+        errors.append(np.abs(approximate_clones - exact_clones) / np.maximum(exact_clones * relative_error, 1))
+    errors = np.concatenate(errors) if len(errors) > 0 else np.zeros(0)
+    if len(errors) == 0:
+        return ApproximationCheck(0, relative_error, 1.0, 1.0, 1.0, 0.0)
+    return ApproximationCheck(len(errors), relative_error, float(np.mean(errors <= 1)), float(np.mean(errors <= 2)), float(np.mean(errors <= 3)), float(errors.max()))
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core clone membership, for the "disk" aggregation engine: the (sample_id, clone_id) pairs of a subject are kept in memory-mapped numpy
+arrays in a folder instead of a DataFrame, so subjects with more pairs than fit in memory can still be counted.
+
+A clone store is a folder with:
+    sample_ids.npy        the samples of the subject, sorted
+    offsets.npy           the clones of sample_ids[i] are clone_positions[offsets[i]:offsets[i + 1]]
+    clone_positions.npy   the clones of every sample as positions in clone_ids, sorted and distinct within each sample
+    clone_ids.npy         the distinct clone_ids of the subject, sorted
+
+The download is written to disk as it arrives, then sorted by sample block_size pairs at a time. The distinct clones of a cell of the chart
+are counted by reading the slices of its samples, block_size pairs at a time, into a bitmap of the subject's clones. The operating system's
+page cache keeps the parts of the arrays that are in use, so the memory used is set by block_size, the number of clones of the subject
+(one byte per clone for the bitmap) and the pairs of its largest sample, not by the number of pairs of the subject.
+The stores of the "disk" engine are made in store_dir (the temporary folder of the system by default) and removed once the subject is counted.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from .aggregate import get_cell_samples, make_distribution_chart
+from .instrument import log_stage
+from .loading import get_clone_membership_query
+
+
+###A clone store opened with open_clone_store. sample_ids and offsets are in memory, clone_positions and clone_ids are memory-mapped.
+CloneStore = namedtuple('CloneStore', ['path', 'sample_ids', 'offsets', 'clone_positions', 'clone_ids'])
+
+###Open a clone store that was written by write_clone_store.
+def open_clone_store(path):
+    return CloneStore(path, np.load(os.path.join(path, 'sample_ids.npy')), np.load(os.path.join(path, 'offsets.npy')),
+                      np.load(os.path.join(path, 'clone_positions.npy'), mmap_mode='r'), np.load(os.path.join(path, 'clone_ids.npy'), mmap_mode='r'))
+
+###Size of the files of a clone store in bytes.
+def get_store_bytes(store):
+    return sum(os.path.getsize(os.path.join(store.path, x)) for x in os.listdir(store.path))
+
+###Sorted distinct values of some sorted arrays of distinct values.
+def merge_unique(arrays):
+    return np.unique(np.concatenate(arrays)) if len(arrays) > 0 else np.zeros(0, dtype=np.int64)
+
+###Write the (sample_id, clone_id) pairs in chunks (an iterable of DataFrames, such as the chunks of a download) into a clone store at path
+###and return it opened. Every sample of a pair must be in sample_ids. The pairs don't have to be distinct or sorted.
+def write_clone_store(path, chunks, sample_ids, block_size=1000000):
+    os.makedirs(path, exist_ok=True)
+    sample_ids = np.asarray(sorted(int(x) for x in sample_ids), dtype=np.int64)
+    counts = np.zeros(len(sample_ids), dtype=np.int64)
+    raw_rows_path = os.path.join(path, 'raw_rows.bin')
+    raw_clones_path = os.path.join(path, 'raw_clones.bin')
+
+    ###write the pairs to disk as they arrive, with the row of their sample in sample_ids, and collect the distinct clones of the subject
+    clone_ids = np.zeros(0, dtype=np.int64)
+    pending = []
+    pending_clones = 0
+    with open(raw_rows_path, 'wb') as rows_file, open(raw_clones_path, 'wb') as clones_file:
+        for chunk in chunks:
+            rows = np.searchsorted(sample_ids, chunk['sample_id'].to_numpy().astype(np.int64)).astype(np.int32)
+            clones = chunk['clone_id'].to_numpy().astype(np.int64)
+            rows.tofile(rows_file)
+            clones.tofile(clones_file)
+            counts += np.bincount(rows, minlength=len(sample_ids))
+            pending.append(np.unique(clones))
+            pending_clones += len(pending[-1])
+            ###only merge once the pending clones outgrow the clones found so far, like loading.fetch_clone_membership does
+            if pending_clones > max(len(clone_ids), block_size):
+                clone_ids = merge_unique([clone_ids] + pending)
+                pending = []
+                pending_clones = 0
+    clone_ids = merge_unique([clone_ids] + pending)
+    num_pairs = int(counts.sum())
+    offsets = np.zeros(len(sample_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    ###sort the pairs by sample: every block of pairs is sorted in memory and each pair is written to the next free place of its sample
+    by_sample = np.lib.format.open_memmap(os.path.join(path, 'by_sample.npy'), mode='w+', dtype=np.int32, shape=(num_pairs,))
+    if num_pairs > 0:
+        raw_rows = np.memmap(raw_rows_path, dtype=np.int32, mode='r')
+        raw_clones = np.memmap(raw_clones_path, dtype=np.int64, mode='r')
+        next_free = offsets[:-1].copy()
+        for start in range(0, num_pairs, block_size):
+            rows = np.asarray(raw_rows[start:start + block_size])
+            positions = np.searchsorted(clone_ids, raw_clones[start:start + block_size]).astype(np.int32)
+            order = np.argsort(rows, kind='stable')
+            rows = rows[order]
+            block_counts = np.bincount(rows, minlength=len(sample_ids))
+            ###place of every pair among the pairs of its sample in this block
+            ranks = np.arange(len(rows)) - (np.cumsum(block_counts) - block_counts)[rows]
+            by_sample[next_free[rows] + ranks] = positions[order]
+            next_free += block_counts
+        del raw_rows, raw_clones
+    os.remove(raw_rows_path)
+    os.remove(raw_clones_path)
+
+    ###sort the clones of every sample and drop the repeated ones, moving the samples forward in place
+    end = 0
+    for i in range(len(sample_ids)):
+        sample_positions = np.unique(by_sample[offsets[i]:offsets[i + 1]])
+        offsets[i] = end
+        by_sample[end:end + len(sample_positions)] = sample_positions
+        end += len(sample_positions)
+    offsets[-1] = end
+    clone_positions = np.lib.format.open_memmap(os.path.join(path, 'clone_positions.npy'), mode='w+', dtype=np.int32, shape=(end,))
+    for start in range(0, end, block_size):
+        clone_positions[start:start + block_size] = by_sample[start:min(start + block_size, end)]
+    clone_positions.flush()
+    del by_sample, clone_positions
+    os.remove(os.path.join(path, 'by_sample.npy'))
+
+    np.save(os.path.join(path, 'sample_ids.npy'), sample_ids)
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'clone_ids.npy'), clone_ids)
+    return open_clone_store(path)
+
+###Download the clone membership of the given samples from clone_source chunk_size rows at a time, like loading.fetch_clone_membership does,
+###straight into a clone store at path. The memory used is set by the chunk size and the number of clones, not by the number of pairs.
+def fetch_clone_store(sql_engine, sample_ids, path, clone_source='sequences', chunk_size=1000000):
+    sample_ids = sorted(int(x) for x in sample_ids)
+    start = time.perf_counter()
+    fetched_rows = [0]
+    def get_chunks():
+        if len(sample_ids) == 0:
+            return
+        with sql_engine.connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            for chunk in pd.read_sql_query(get_clone_membership_query(clone_source), connection, params={'sample_ids': sample_ids}, chunksize=chunk_size):
+                fetched_rows[0] += len(chunk)
+                yield chunk
+    store = write_clone_store(path, get_chunks(), sample_ids, chunk_size)
+    log_stage('fetch clones to disk', time.perf_counter() - start, clone_source=clone_source, num_samples=len(sample_ids), rows=fetched_rows[0],
+              pairs=len(store.clone_positions), bytes=get_store_bytes(store))
+    return store
+
+###A new folder for a clone store in store_dir (the temporary folder of the system if it is None), which is removed at the end of the with block.
+###The arrays of the store must not be used after the block.
+@contextmanager
+def temporary_store_path(store_dir=None):
+    if store_dir:
+        os.makedirs(store_dir, exist_ok=True)
+    path = tempfile.mkdtemp(prefix='clonechart_store_', dir=store_dir or None)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+###Number of distinct clones of every cell of cell_samples, read from the store block_size pairs at a time.
+def count_cell_clones(store, cell_samples, block_size=1000000):
+    cell_clones = np.zeros(len(cell_samples.cells), dtype=np.int64)
+    seen = np.zeros(len(store.clone_ids), dtype=bool)
+    rows = np.searchsorted(store.sample_ids, cell_samples.cell_samples['sample_id'].to_numpy().astype(np.int64))
+    for pos, sample_rows in pd.Series(rows).groupby(cell_samples.cell_samples['pos'].to_numpy()):
+        seen[:] = False
+        for row in sample_rows.unique():
+            end = store.offsets[row + 1]
+            for start in range(store.offsets[row], end, block_size):
+                seen[store.clone_positions[start:min(start + block_size, end)]] = True
+        cell_clones[pos] = np.count_nonzero(seen)
+    return cell_clones
+
+###Build the dataframe for the graph of one subject from its clone store. This is the "disk" aggregation engine.
+###The samples are mapped to the cells like build_distribution_chart does, so both engines give the same dataframe.
+def build_distribution_chart_store(store, sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list, block_size=1000000):
+    cell_samples = get_cell_samples(sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list)
+    return make_distribution_chart(cell_samples, count_cell_clones(store, cell_samples, block_size), len(store.clone_ids))
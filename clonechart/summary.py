@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Chart summary files: the counted clones of every subject of a chart, saved so that the chart can be drawn again without the database.
+
+A chart summary is a json file with everything the chart is drawn from:
+    {
+        "format": "clonechart-summary", "version": 1,
+        "database": "lp15", "y_axis_input": "tissue", "x_axis_input": "timepoint",
+        "total_tissue_list": [...],        the y-axis labels from the bottom of the y-axis to the top
+        "tissue_color_dict": {...},        the color of every y-axis label
+        "subjects": [
+            {
+                "id": 1, "name": "D207", "num_clones": 123456,
+                "x_axis_values_sorted": [...], "x_axis_values_unedited_sorted": [...],
+                "cells": {"x_axis": [...], "y_axis": [...], "num_clones": [...], "num_samples": [...]},
+                "overlap": {"labels": [...], "num_clones": [[...], ...]} or null
+            },
+            ...
+        ]
+    }
+"cells" is the distribution_chart of the subject: one entry per (x value, y label) with the percentage of the subject's clones and the
+number of samples. The subjects are in plotting order.
+
+The version is raised whenever the format changes in a way that older readers can't read.
+"""
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .aggregate import SubjectSummary
+from .render import make_overlap_chart, render_clone_distribution_chart
+
+
+SUMMARY_FORMAT = 'clonechart-summary'
+SUMMARY_VERSION = 1
+
+###Everything a clone distribution chart is drawn from. summaries maps every subject_id of subjects_dict to its SubjectSummary.
+ChartSummary = namedtuple('ChartSummary', ['summaries', 'subjects_dict', 'total_tissue_list', 'tissue_color_dict', 'y_axis_input', 'x_axis_input', 'database'])
+
+###numpy numbers, which the tables and the counts are full of, as plain python numbers for json
+def to_json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{!r} can't be saved in a chart summary".format(type(value).__name__))
+
+###Save a ChartSummary to a json file at path. The file is written through a temporary file, so a failed write never leaves half a summary.
+def write_chart_summary(path, chart_summary):
+    subjects = []
+    for subject_id, subject_name in chart_summary.subjects_dict.items():
+        summary = chart_summary.summaries[subject_id]
+        overlap = None
+        if summary.overlap is not None:
+            overlap = {'labels': summary.overlap.index.tolist(), 'num_clones': summary.overlap.values.tolist()}
+        subjects.append({
+            'id': subject_id,
+            'name': subject_name,
+            'num_clones': summary.num_clones,
+            'x_axis_values_sorted': list(summary.x_axis_values_sorted),
+            'x_axis_values_unedited_sorted': list(summary.x_axis_values_unedited_sorted),
+            'cells': {x: summary.distribution_chart[x].tolist() for x in ('x_axis', 'y_axis', 'num_clones', 'num_samples')},
+            'overlap': overlap,
+        })
+    data = {
+        'format': SUMMARY_FORMAT,
+        'version': SUMMARY_VERSION,
+        'database': chart_summary.database,
+        'y_axis_input': chart_summary.y_axis_input,
+        'x_axis_input': chart_summary.x_axis_input,
+        'total_tissue_list': list(chart_summary.total_tissue_list),
+        'tissue_color_dict': dict(chart_summary.tissue_color_dict),
+        'subjects': subjects,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, default=to_json_value, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+###Read a chart summary file written by write_chart_summary and return its ChartSummary.
+def read_chart_summary(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('format') != SUMMARY_FORMAT:
+        raise ValueError("{} is not a chart summary".format(path))
+    if data['version'] > SUMMARY_VERSION:
+        raise ValueError("{} is a version {} chart summary, this version of clonechart reads up to version {}".format(path, data['version'], SUMMARY_VERSION))
+    subjects_dict = {}
+    summaries = {}
+    for subject in data['subjects']:
+        subjects_dict[subject['id']] = subject['name']
+        overlap = None
+        if subject['overlap'] is not None:
+            overlap = pd.DataFrame(subject['overlap']['num_clones'], index=subject['overlap']['labels'], columns=subject['overlap']['labels'])
+        distribution_chart = pd.DataFrame()
+        for column in ('x_axis', 'num_clones', 'y_axis', 'num_samples'):
+            distribution_chart[column] = subject['cells'][column]
+        summaries[subject['id']] = SubjectSummary(distribution_chart, subject['num_clones'], subject['x_axis_values_sorted'], subject['x_axis_values_unedited_sorted'], overlap)
+    return ChartSummary(summaries, subjects_dict, data['total_tissue_list'], data['tissue_color_dict'], data['y_axis_input'], data['x_axis_input'], data['database'])
+
+###Put the cells of a distribution_chart in the order of a new list of y-axis labels. The cells of a distribution_chart are in x-major order,
+###with one cell per label of total_tissue_list. Labels that weren't counted get empty cells, so they have no circles.
+def reorder_distribution_chart(distribution_chart, total_tissue_list, new_tissue_list):
+    num_y = len(total_tissue_list)
+    num_x = len(distribution_chart) // num_y
+    label_positions = {x: i for i, x in enumerate(total_tissue_list)}
+    positions = np.tile([label_positions.get(x, -1) for x in new_tissue_list], num_x)
+    rows = np.repeat(np.arange(num_x) * num_y, len(new_tissue_list)) + np.maximum(positions, 0)
+    reordered = distribution_chart.iloc[rows].reset_index(drop=True)
+    reordered['x_axis'] = distribution_chart['x_axis'].iloc[np.repeat(np.arange(num_x) * num_y, len(new_tissue_list))].to_numpy()
+    reordered['y_axis'] = list(new_tissue_list) * num_x
+    reordered.loc[positions < 0, ['num_clones', 'num_samples']] = 0
+    return reordered
+
+###Change the y-axis labels of a ChartSummary to the order and colors of tissue_color_dict (blood first and gut last, like in
+###make_clone_distribution_chart), without counting the clones again.
+def restyle_chart_summary(chart_summary, tissue_color_dict):
+    if len(chart_summary.total_tissue_list) == 0:
+        raise ValueError("The chart has no y-axis labels to change")
+    new_tissue_list = list(tissue_color_dict.keys())[::-1]
+    summaries = {x: y._replace(distribution_chart=reorder_distribution_chart(y.distribution_chart, chart_summary.total_tissue_list, new_tissue_list))
+                 for x, y in chart_summary.summaries.items()}
+    return chart_summary._replace(summaries=summaries, total_tissue_list=new_tissue_list, tissue_color_dict=dict(tissue_color_dict))
+
+###Draw the chart of a chart summary file again and write it to output_path, without the database. tissue_color_dict, if given, changes the
+###order and colors of the y-axis labels (see restyle_chart_summary). overlap_path also draws the clone overlap heatmaps, if the summary has them.
+###Returns the RenderStats of the chart.
+def render_chart_summary(path, output_path, tissue_color_dict=None, compact_rendering=True, plotlyjs='inline', overlap_path=None):
+    chart_summary = read_chart_summary(path)
+    if tissue_color_dict:
+        chart_summary = restyle_chart_summary(chart_summary, tissue_color_dict)
+    render_stats = render_clone_distribution_chart(chart_summary.summaries, chart_summary.subjects_dict, chart_summary.total_tissue_list, chart_summary.tissue_color_dict,
+                                                   chart_summary.x_axis_input, output_path, chart_summary.database, compact_rendering, plotlyjs)
+    if overlap_path:
+        overlap_dict = {x: y.overlap for x, y in chart_summary.summaries.items()}
+        if any(x is None for x in overlap_dict.values()):
+            raise ValueError("{} has no clone overlap, make it again with an overlap_path".format(path))
+        make_overlap_chart(overlap_dict, chart_summary.subjects_dict, overlap_path, chart_summary.database, plotlyjs)
+    return render_stats
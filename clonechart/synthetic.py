@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic ImmuneDB databases, for testing and benchmarking clonechart without a real database.
+
+    clonechart synthetic immunedb.sqlite --scale medium --num-subjects 40
+
+make_synthetic_immunedb writes the subjects, samples, sample_metadata, sequences, clones and clone_stats tables of an ImmuneDB database
+into a SQLite file, with the columns that clonechart reads. Every subject has its own clones. The sizes of the clones follow a power law
+(a few very large clones and many small ones, as in real repertoires), set by clone_size_skew, and the sequences of every sample are drawn
+from the clones of its subject, so the large clones are found in many samples. A small fraction of the sequences has no clone.
+
+Every sample has a tissue and a timepoint, and also a pod and further metadata keys up to num_metadata_keys. The sequences are written a
+sample at a time, so the memory used doesn't grow with the size of the database.
+
+StandInConnection opens a synthetic database like a remote one whose connection can be lost, to check that a run recovers from it:
+
+    connection = StandInConnection('immunedb.sqlite', drop_after_rows=50000, drops=2, retry_wait=0)
+    summaries = clonechart.make_clone_distribution_chart(None, None, None, 'tissue', 'timepoint', None, {}, connection=connection)
+    print(connection.num_drops)
+
+The summaries are the same as without the drops, and only the downloads that were running when the connection dropped are repeated.
+"""
+
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+from .connection import Connection
+
+
+SYNTHETIC_TISSUES = ['PBMC', 'Bone Marrow', 'Spleen', 'Lung', 'MLN', 'Duodenum_allograft', 'Jejunum', 'Ileum', 'Ileum_allograft', 'Colon_allograft']
+SYNTHETIC_TIMEPOINTS = ['2h', '12h', '1d', '3d', '7d', '14d', '30d', '90d', '180d', '365d']
+###Values of the metadata keys after tissue, timepoint and pod.
+SYNTHETIC_VALUES = ['a', 'b', 'c', 'd']
+
+###Size of a synthetic database: subjects, samples of every subject, metadata keys of every sample, sequences of every sample and clones of every subject.
+###clone_size_skew is the exponent of the power law of the clone sizes (0 makes all clones equally likely), unclustered_fraction the fraction of sequences without a clone.
+SyntheticScale = namedtuple('SyntheticScale', ['num_subjects', 'samples_per_subject', 'num_metadata_keys', 'sequences_per_sample', 'clones_per_subject',
+                                               'clone_size_skew', 'unclustered_fraction'])
+SyntheticScale.__new__.__defaults__ = (1.2, 0.05)
+
+###Scales that the benchmark suite runs, from a quick check to a database of a few million sequences.
+SYNTHETIC_SCALES = {
+    'tiny': SyntheticScale(3, 8, 3, 500, 200),
+    'small': SyntheticScale(5, 16, 4, 2000, 2000),
+    'medium': SyntheticScale(12, 32, 6, 5000, 20000),
+    'large': SyntheticScale(24, 48, 8, 10000, 100000),
+}
+
+###The tables of a synthetic database, with the ImmuneDB columns that clonechart reads, and the indexes that ImmuneDB has on them.
+SYNTHETIC_SCHEMA = '''
+create table subjects (id integer primary key, identifier text, study_id integer);
+create table samples (id integer primary key, name text, subject_id integer);
+create table sample_metadata (sample_id integer, key text, value text);
+create table sequences (ai integer primary key, seq_id text, sample_id integer, clone_id integer, copy_number integer);
+create table clones (id integer primary key, subject_id integer);
+create table clone_stats (id integer primary key, clone_id integer, sample_id integer, unique_cnt integer, total_cnt integer);
+'''
+SYNTHETIC_INDEXES = '''
+create index sequences_sample_clone on sequences (sample_id, clone_id);
+create index clone_stats_sample_clone on clone_stats (sample_id, clone_id);
+create index sample_metadata_sample on sample_metadata (sample_id, key);
+'''
+
+###Metadata keys of the samples of a synthetic database.
+def get_synthetic_metadata_keys(num_metadata_keys):
+    keys = ['tissue', 'timepoint', 'pod'] + ['key_{}'.format(i + 1) for i in range(max(0, num_metadata_keys - 3))]
+    return keys[:max(2, num_metadata_keys)]
+
+###Write a synthetic ImmuneDB database with the given SyntheticScale (or the name of one of SYNTHETIC_SCALES) to a SQLite file at path.
+###An existing file is replaced. The same seed always makes the same database. Returns the number of rows of every table.
+def make_synthetic_immunedb(path, scale='small', seed=0):
+    if isinstance(scale, str):
+        scale = SYNTHETIC_SCALES[scale]
+    rng = np.random.default_rng(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.executescript(SYNTHETIC_SCHEMA)
+    keys = get_synthetic_metadata_keys(scale.num_metadata_keys)
+
+    ###clone k of a subject has a share of its sequences proportional to 1 / k ** clone_size_skew
+    clone_weights = 1 / np.arange(1, scale.clones_per_subject + 1) ** scale.clone_size_skew
+    clone_weights /= clone_weights.sum()
+
+    num_rows = {'subjects': 0, 'samples': 0, 'sample_metadata': 0, 'sequences': 0, 'clones': 0, 'clone_stats': 0}
+    def write(table, df):
+        ###missing values (the clone_id of unclustered sequences) are written as NULL
+        rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        db.executemany("insert into {} ({}) values ({})".format(table, ", ".join(df.columns), ", ".join('?' * len(df.columns))), rows)
+        num_rows[table] += len(df)
+
+    write('subjects', pd.DataFrame({'id': np.arange(1, scale.num_subjects + 1), 'identifier': ['S{}'.format(x + 1) for x in range(scale.num_subjects)], 'study_id': 1}))
+    sample_id = 0
+    for subject_id in range(1, scale.num_subjects + 1):
+        first_clone_id = (subject_id - 1) * scale.clones_per_subject + 1
+        write('clones', pd.DataFrame({'id': np.arange(first_clone_id, first_clone_id + scale.clones_per_subject), 'subject_id': subject_id}))
+        ###the clones of a subject are shuffled, so that the largest clones don't all have the smallest ids
+        clone_ids = rng.permutation(np.arange(first_clone_id, first_clone_id + scale.clones_per_subject))
+        samples = []
+        metadata = []
+        for i in range(scale.samples_per_subject):
+            sample_id += 1
+            samples.append((sample_id, 'sample_{}'.format(sample_id), subject_id))
+            ###the samples of a subject go through the tissues, and through the timepoints for every tissue
+            values = {'tissue': SYNTHETIC_TISSUES[i % len(SYNTHETIC_TISSUES)], 'timepoint': SYNTHETIC_TIMEPOINTS[i // len(SYNTHETIC_TISSUES) % len(SYNTHETIC_TIMEPOINTS)]}
+            values['pod'] = 'POD{}'.format(SYNTHETIC_TIMEPOINTS.index(values['timepoint']) * 7)
+            metadata.extend((sample_id, x, values[x] if x in values else SYNTHETIC_VALUES[rng.integers(len(SYNTHETIC_VALUES))]) for x in keys)
+
+            num_sequences = max(1, int(rng.poisson(scale.sequences_per_sample)))
+            sequence_clones = clone_ids[rng.choice(scale.clones_per_subject, size=num_sequences, p=clone_weights)].astype(float)
+            sequence_clones[rng.random(num_sequences) < scale.unclustered_fraction] = np.nan
+            sequences = pd.DataFrame({'seq_id': ['{}_{}'.format(sample_id, x) for x in range(num_sequences)], 'sample_id': sample_id,
+                                      'clone_id': sequence_clones, 'copy_number': rng.geometric(0.5, num_sequences)})
+            write('sequences', sequences)
+            clone_stats = sequences.dropna(subset=['clone_id']).groupby('clone_id')['copy_number'].agg(['size', 'sum']).reset_index()
+            write('clone_stats', pd.DataFrame({'clone_id': clone_stats['clone_id'], 'sample_id': sample_id,
+                                               'unique_cnt': clone_stats['size'], 'total_cnt': clone_stats['sum']}))
+        write('samples', pd.DataFrame(samples, columns=['id', 'name', 'subject_id']))
+        write('sample_metadata', pd.DataFrame(metadata, columns=['sample_id', 'key', 'value']))
+        db.commit()
+    db.executescript(SYNTHETIC_INDEXES)
+    db.close()
+    return num_rows
+
+
+class StandInConnection(Connection):
+    """Connection to a SQLite database that can be lost like the connection to a remote database through an ssh tunnel.
+
+    drop() (which can be called from any thread) makes the queries that are running and every later query of the engine fail with a lost
+    connection error, until the connection is reset and opened again, as Connection.retry does. With drop_after_rows, the connection is
+    dropped by itself once that many rows were read since it was opened, up to drops times. num_drops counts the drops so far.
+    """
+
+    def __init__(self, path, drop_after_rows=None, drops=1, pool_size=5, retries=3, retry_wait=0):
+        super().__init__(url='sqlite:///' + os.path.abspath(path), pool_size=pool_size, retries=retries, retry_wait=retry_wait)
+        self.path = os.path.abspath(path)
+        self.drop_after_rows = drop_after_rows
+        self.drops_left = drops if drop_after_rows else 0
+        self.num_drops = 0
+        self._dropped = threading.Event()
+        self._rows_read = 0
+        self._rows_lock = threading.Lock()
+
+    def drop(self):
+        if not self._dropped.is_set():
+            self._dropped.set()
+            self.num_drops += 1
+
+    def _read(self, num_rows, dropped):
+        if dropped.is_set():
+            raise sqlite3.OperationalError("the connection to the database was dropped")
+        with self._rows_lock:
+            self._rows_read += num_rows
+            if self.drops_left > 0 and self._rows_read >= self.drop_after_rows:
+                self.drops_left -= 1
+                self.drop()
+
+    def _open(self):
+        ###a new engine gets a connection that works again
+        self._dropped = dropped = threading.Event()
+        self._rows_read = 0
+        stand_in = self
+
+        class StandInCursor(sqlite3.Cursor):
+            def execute(self, *args):
+                stand_in._read(0, dropped)
+                return super().execute(*args)
+
+            def fetchone(self):
+                row = super().fetchone()
+                stand_in._read(1, dropped)
+                return row
+
+            def fetchmany(self, *args):
+                rows = super().fetchmany(*args)
+                stand_in._read(len(rows), dropped)
+                return rows
+
+            def fetchall(self):
+                rows = super().fetchall()
+                stand_in._read(len(rows), dropped)
+                return rows
+
+        class StandInDBConnection(sqlite3.Connection):
+            def cursor(self, factory=StandInCursor):
+                return super().cursor(factory)
+
+        engine = create_engine(self.url, creator=lambda: sqlite3.connect(self.path, check_same_thread=False, factory=StandInDBConnection),
+                               poolclass=QueuePool, pool_size=self.pool_size)
+
+        @event.listens_for(engine, 'handle_error')
+        def mark_dropped(context):
+            if dropped.is_set():
+                context.is_disconnect = True
+        return engine
@@ -0,0 +1,17 @@
+from setuptools import find_packages, setup
+
+with open('requirements.txt') as f:
+    requirements = [x.strip() for x in f if x.strip()]
+
+setup(
+    name='clonechart',
+    version='0.2.0',
+    description="Clone distribution charts of ImmuneDB databases",
+    url='https://github.com/DrexelSystemsImmunologyLab/CloneChart',
+    packages=find_packages(),
+    python_requires='>=3.7',
+    install_requires=requirements,
+    entry_points={
+        'console_scripts': ['clonechart=clonechart.cli:main'],
+    },
+)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests: a small synthetic ImmuneDB database in a SQLite file, made once per test session.
+"""
+
+import shutil
+
+import pytest
+
+from clonechart.chart import get_subject_samples, load_tables
+from clonechart.connection import Connection
+from clonechart.metadata import build_sample_metadata
+from clonechart.synthetic import SyntheticScale, make_synthetic_immunedb
+
+
+###3 subjects of 24 samples, so that every subject has all the tissues and 3 timepoints and pods.
+TEST_SCALE = SyntheticScale(3, 24, 4, 300, 300)
+
+@pytest.fixture(scope='session')
+def synthetic_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('synthetic') / 'immunedb.sqlite')
+    make_synthetic_immunedb(path, TEST_SCALE, seed=0)
+    return path
+
+###A copy of the synthetic database that a test can change.
+@pytest.fixture
+def synthetic_copy(synthetic_path, tmp_path):
+    path = str(tmp_path / 'immunedb_copy.sqlite')
+    shutil.copy(synthetic_path, path)
+    return path
+
+@pytest.fixture
+def connection(synthetic_path):
+    with Connection(url='sqlite:///' + synthetic_path) as connection:
+        yield connection
+
+###(subjects_dict, samples_dict, sample_metadata) of the synthetic database.
+@pytest.fixture(scope='session')
+def synthetic_tables(synthetic_path):
+    with Connection(url='sqlite:///' + synthetic_path) as connection:
+        subjects_table, samples_table, metadata_table = load_tables(connection)
+    subjects_dict, samples_dict = get_subject_samples(subjects_table, samples_table)
+    return subjects_dict, samples_dict, build_sample_metadata(metadata_table)
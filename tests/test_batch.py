@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Batch mode must draw the same charts as make_clone_distribution_chart, from one download of every subject.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from clonechart.batch import format_batch_timings, run_batch
+from clonechart.chart import make_clone_distribution_chart
+from clonechart.summary import read_chart_summary
+
+
+CHARTS = [('tissue', 'timepoint'), ('None', 'timepoint'), ('tissue', 'None')]
+
+@pytest.mark.parametrize('options', [{}, {'num_workers': 2, 'cache_dir': 'cache'}])
+def test_batch_matches_single_charts(synthetic_path, connection, tmp_path, options):
+    options = dict(options, plotlyjs='cdn')
+    if 'cache_dir' in options:
+        options['cache_dir'] = str(tmp_path / options['cache_dir'])
+    charts = [{'y_axis_input': y, 'x_axis_input': x, 'summary_path': str(tmp_path / 'summary_{}.json'.format(i))} for i, (y, x) in enumerate(CHARTS)]
+    charts[0]['path'] = str(tmp_path / 'chart.html')
+    timings = run_batch({'options': options, 'databases': [{'url': 'sqlite:///' + synthetic_path, 'charts': charts}]})
+    assert os.path.exists(charts[0]['path'])
+    assert set(timings['step']) == {'load tables', 'load clones', 'count', 'render', 'total'}
+    assert 'Total' in format_batch_timings(timings)
+    if 'cache_dir' in options:
+        assert len(os.listdir(options['cache_dir'])) > 0
+
+    for (y_axis_input, x_axis_input), chart in zip(CHARTS, charts):
+        summaries = read_chart_summary(chart['summary_path']).summaries
+        expected = make_clone_distribution_chart(None, None, None, y_axis_input, x_axis_input, None, {}, aggregation_engine='sql', clone_source='auto', connection=connection)
+        assert sorted(summaries) == sorted(expected)
+        for subject_id, summary in expected.items():
+            pd.testing.assert_frame_equal(summaries[subject_id].distribution_chart, summary.distribution_chart, check_dtype=False)
+            assert summaries[subject_id].num_clones == summary.num_clones
+
+def test_batch_rejects_unknown_settings(synthetic_path):
+    with pytest.raises(ValueError, match='y_axis'):
+        run_batch({'databases': [{'url': 'sqlite:///' + synthetic_path, 'charts': [{'y_axis': 'tissue'}]}]})
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+The cache must notice changes in the database, be usable without it when offline, and stay under its size limit.
+"""
+
+import os
+import sqlite3
+
+from clonechart.cache import evict_cache, inspect_cache, load_cached_clone_membership, load_cached_table, read_fingerprint
+from clonechart.connection import Connection
+from clonechart.loading import load_clone_membership
+
+
+def execute(path, *queries):
+    db = sqlite3.connect(path)
+    for query in queries:
+        db.execute(query)
+    db.commit()
+    db.close()
+
+###a connection that fails if it is opened, for the offline runs
+def get_unreachable_connection(tmp_path):
+    return Connection(url='sqlite:///' + str(tmp_path / 'missing' / 'immunedb.sqlite'))
+
+def test_edited_table_is_downloaded_again(synthetic_copy, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    with Connection(url='sqlite:///' + synthetic_copy) as connection:
+        metadata_table = load_cached_table(connection, 'sample_metadata', cache_dir, 'db')
+        data_path = os.path.join(cache_dir, 'db', 'tables', 'sample_metadata.parquet')
+        fingerprint = read_fingerprint(data_path)
+        ###a corrected value keeps the number of rows
+        execute(synthetic_copy, "update sample_metadata set value = 'Relabeled' where sample_id = 1 and key = 'tissue'")
+        edited_table = load_cached_table(connection, 'sample_metadata', cache_dir, 'db')
+    assert len(edited_table) == len(metadata_table)
+    assert 'Relabeled' not in set(metadata_table['value'])
+    assert edited_table['value'].loc[(edited_table['sample_id'] == 1) & (edited_table['key'] == 'tissue')].tolist() == ['Relabeled']
+    assert read_fingerprint(data_path) != fingerprint
+    with get_unreachable_connection(tmp_path) as connection:
+        assert 'Relabeled' in set(load_cached_table(connection, 'sample_metadata', cache_dir, 'db', offline=True)['value'])
+
+def test_changed_clones_are_downloaded_again(synthetic_copy, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    downloads = []
+    with Connection(url='sqlite:///' + synthetic_copy) as connection:
+        sample_ids = [1, 2, 3]
+        def load():
+            downloads.append(1)
+            return load_clone_membership(connection, sample_ids)
+        first = load_cached_clone_membership(connection, 1, sample_ids, 'sequences', load, cache_dir, 'db')
+        assert len(load_cached_clone_membership(connection, 1, sample_ids, 'sequences', load, cache_dir, 'db')) == len(first)
+        assert len(downloads) == 1
+        execute(synthetic_copy, "insert into sequences (seq_id, sample_id, clone_id, copy_number) values ('new', 2, 1000000, 1)")
+        changed = load_cached_clone_membership(connection, 1, sample_ids, 'sequences', load, cache_dir, 'db')
+    assert len(downloads) == 2
+    assert len(changed) == len(first) + 1
+    ###offline, the cached clones are used without the database, and without downloading them
+    with get_unreachable_connection(tmp_path) as connection:
+        offline = load_cached_clone_membership(connection, 1, sample_ids, 'sequences', None, cache_dir, 'db', offline=True)
+    assert len(offline) == len(changed)
+
+def test_evict_cache_removes_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(os.path.join(cache_dir, 'db', 'sequences'))
+    ###four entries of 1 MB, used one after the other
+    for i in range(4):
+        data_path = os.path.join(cache_dir, 'db', 'sequences', 'subject_{}.parquet'.format(i))
+        with open(data_path, 'wb') as f:
+            f.write(b'0' * 1024**2)
+        with open(data_path + '.json', 'w') as f:
+            f.write('{}')
+        os.utime(data_path, (1000000 + i, 1000000 + i))
+    removed = evict_cache(cache_dir, 2.5)
+    assert removed == [os.path.join('db', 'sequences', 'subject_{}.parquet'.format(i)) for i in (0, 1)]
+    entries = inspect_cache(cache_dir)
+    assert entries['entry'].tolist() == [os.path.join('db', 'sequences', 'subject_{}.parquet'.format(i)) for i in (3, 2)]
+    assert entries['size_mb'].sum() <= 2.5
+    assert not os.path.exists(os.path.join(cache_dir, 'db', 'sequences', 'subject_0.parquet.json'))
+    assert evict_cache(cache_dir, 2.5) == []
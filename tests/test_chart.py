@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the settings of make_clone_distribution_chart, which are made before anything is loaded, and of the matching of samples to the axes.
+"""
+
+import pandas as pd
+import pytest
+
+from clonechart.aggregate import build_clone_matrix, build_distribution_chart
+from clonechart.chart import make_clone_distribution_chart
+from clonechart.metadata import build_sample_metadata, get_x_axis_values, get_y_axis_key, map_samples_to_values
+
+
+def make_chart(**kwargs):
+    return make_clone_distribution_chart(None, None, None, 'tissue', 'timepoint', None, {}, **kwargs)
+
+@pytest.mark.parametrize('kwargs', [
+    {'incremental': True},
+    {'incremental': True, 'cache_dir': 'cache', 'aggregation_engine': 'sql'},
+    {'incremental': True, 'cache_dir': 'cache', 'cache_offline': True},
+])
+def test_incremental_needs_pandas_and_an_online_cache(kwargs):
+    with pytest.raises(ValueError, match='incremental'):
+        make_chart(**kwargs)
+
+@pytest.mark.parametrize('kwargs', [
+    {'prefetch': True, 'num_workers': 4},
+    {'prefetch': True, 'aggregation_engine': 'sql'},
+    {'prefetch': True, 'incremental': True, 'cache_dir': 'cache'},
+])
+def test_prefetch_needs_one_worker_and_pandas(kwargs):
+    with pytest.raises(ValueError, match='prefetch'):
+        make_chart(**kwargs)
+
+###"Spleen" is the tissue of sample 1 and the sample_type of sample 2, and "7d" is the timepoint of sample 1 and the sample_type of sample 3
+OVERLAPPING_METADATA = pd.DataFrame([
+    (1, 'tissue', 'Spleen'), (1, 'timepoint', '7d'), (1, 'sample_type', 'Blood'),
+    (2, 'tissue', 'Blood'), (2, 'timepoint', '12h'), (2, 'sample_type', 'Spleen'),
+    (3, 'tissue', 'Blood'), (3, 'timepoint', '12h'), (3, 'sample_type', '7d'),
+], columns=['sample_id', 'key', 'value'])
+
+def test_values_only_match_through_their_own_key():
+    sample_metadata = build_sample_metadata(OVERLAPPING_METADATA)
+    assert get_y_axis_key(sample_metadata, 'sample_origin') == 'tissue'
+    assert map_samples_to_values(sample_metadata, 'tissue', ['Spleen'], [1, 2, 3])['sample_id'].tolist() == [1]
+    assert map_samples_to_values(sample_metadata, 'sample_type', ['Spleen'], [1, 2, 3])['sample_id'].tolist() == [2]
+    assert get_x_axis_values(sample_metadata, [1, 2, 3], 'timepoint') == ([0.5, 7.0], ['12h', '7d'])
+    assert map_samples_to_values(sample_metadata, 'timepoint', ['7d'], [1, 2, 3])['sample_id'].tolist() == [1]
+
+    ###every sample has its own clone, so a cell has a clone for every sample that has both of its values
+    clone_matrix = build_clone_matrix(pd.DataFrame({'sample_id': [1, 2, 3], 'clone_id': [10, 20, 30]}))
+    x_axis_values_sorted, x_axis_values_unedited_sorted = get_x_axis_values(sample_metadata, [1, 2, 3], 'timepoint')
+    chart = build_distribution_chart(clone_matrix, sample_metadata, [1, 2, 3], 'timepoint', 'tissue', x_axis_values_sorted, x_axis_values_unedited_sorted, ['Spleen', 'Blood'])
+    clones = {(x, y): round(z * 3 / 100) for x, y, z in zip(chart['x_axis'], chart['y_axis'], chart['num_clones'])}
+    assert clones == {(0.5, 'Spleen'): 0, (0.5, 'Blood'): 2, (7.0, 'Spleen'): 1, (7.0, 'Blood'): 0}
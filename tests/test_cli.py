@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+The flags of "clonechart chart": defaults that follow other flags, and flags that can't be used together.
+"""
+
+import pytest
+
+from clonechart.cli import main
+
+
+def run_chart(synthetic_path, *flags):
+    main(['chart', '--url', 'sqlite:///' + synthetic_path, '-y', 'tissue', '-x', 'timepoint'] + list(flags))
+
+@pytest.mark.parametrize('flags', [
+    ['--prefetch'],
+    ['--incremental', '--cache-dir', '{tmp_path}'],
+    ['--overlap-path', '{tmp_path}/overlap.html'],
+])
+def test_defaults_follow_the_flags(synthetic_path, tmp_path, capsys, flags):
+    run_chart(synthetic_path, *[x.format(tmp_path=tmp_path) for x in flags])
+    assert "Peak memory usage" in capsys.readouterr().out
+
+@pytest.mark.parametrize('flags, error', [
+    (['--prefetch', '--num-workers', '4'], "--prefetch needs --num-workers 1"),
+    (['--prefetch', '--aggregation-engine', 'sql'], "--prefetch needs --aggregation-engine pandas"),
+    (['--incremental'], "--incremental needs --cache-dir"),
+    (['--incremental', '--cache-dir', 'cache', '--aggregation-engine', 'disk'], "--incremental needs --aggregation-engine pandas"),
+    (['--incremental', '--cache-dir', 'cache', '--offline'], "--incremental can't be used with --offline"),
+    (['--prefetch', '--incremental', '--cache-dir', 'cache'], "--prefetch can't be used with --incremental"),
+    (['--check-approximation'], "--check-approximation needs --aggregation-engine approximate"),
+])
+def test_conflicting_flags_are_usage_errors(synthetic_path, capsys, flags, error):
+    with pytest.raises(SystemExit) as exit_info:
+        run_chart(synthetic_path, *flags)
+    assert exit_info.value.code == 2
+    assert error in capsys.readouterr().err
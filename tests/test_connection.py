@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+A run whose connection drops during the downloads must give the same chart as a clean run.
+"""
+
+import pandas as pd
+import pytest
+
+from clonechart.chart import make_clone_distribution_chart
+from clonechart.synthetic import StandInConnection
+
+
+def assert_same_summaries(summaries, expected):
+    assert list(summaries) == list(expected)
+    for subject_id, summary in expected.items():
+        pd.testing.assert_frame_equal(summaries[subject_id].distribution_chart, summary.distribution_chart)
+        assert summaries[subject_id].num_clones == summary.num_clones
+
+###the connection drops twice, in the middle of the download of a subject, a shard or a table
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'shard_size': 5, 'shard_workers': 2},
+    {'prefetch': True},
+    {'aggregation_engine': 'sql'},
+])
+def test_run_recovers_from_dropped_connections(synthetic_path, connection, kwargs):
+    expected = make_clone_distribution_chart(None, None, None, 'tissue', 'timepoint', None, {}, aggregation_engine=kwargs.get('aggregation_engine', 'pandas'), connection=connection)
+    with StandInConnection(synthetic_path, drop_after_rows=500, drops=2) as stand_in:
+        summaries = make_clone_distribution_chart(None, None, None, 'tissue', 'timepoint', None, {}, connection=stand_in, **kwargs)
+        assert stand_in.num_drops > 0
+    assert_same_summaries(summaries, expected)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+The "sql" and "disk" aggregation engines must count the same clones as the "pandas" one.
+"""
+
+import pandas as pd
+import pytest
+
+from clonechart.aggregate import build_clone_matrix, build_distribution_chart, build_distribution_chart_sql, summarize_subject
+from clonechart.chart import get_y_axis_labels
+from clonechart.loading import load_clone_membership
+from clonechart.metadata import get_x_axis_values
+
+
+AXES = [('tissue', 'timepoint'), ('tissue', 'None'), ('None', 'timepoint'), ('tissue', 'pod')]
+
+@pytest.mark.parametrize('clone_source', ['sequences', 'clone_stats'])
+@pytest.mark.parametrize('y_axis_input, x_axis_input', AXES)
+def test_sql_engine_matches_pandas_engine(connection, synthetic_tables, y_axis_input, x_axis_input, clone_source):
+    subjects_dict, samples_dict, sample_metadata = synthetic_tables
+    y_axis_key, total_tissue_list, tissue_color_dict = get_y_axis_labels(sample_metadata, y_axis_input, {})
+    for subject_id, sample_ids in samples_dict.items():
+        x_axis_values_sorted, x_axis_values_unedited_sorted = get_x_axis_values(sample_metadata, sample_ids, x_axis_input)
+        clone_matrix = build_clone_matrix(load_clone_membership(connection, sample_ids, clone_source))
+        expected = build_distribution_chart(clone_matrix, sample_metadata, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted, total_tissue_list)
+        distribution_chart, num_clones = build_distribution_chart_sql(connection.engine, sample_ids, x_axis_input, y_axis_key, x_axis_values_sorted, x_axis_values_unedited_sorted,
+                                                                      total_tissue_list, clone_source)
+        assert len(expected) > 1
+        pd.testing.assert_frame_equal(distribution_chart, expected)
+        assert num_clones == len(clone_matrix.clone_ids)
+
+def assert_same_summary(summary, expected):
+    pd.testing.assert_frame_equal(summary.distribution_chart, expected.distribution_chart)
+    assert summary.num_clones == expected.num_clones
+    assert list(summary.x_axis_values_sorted) == list(expected.x_axis_values_sorted)
+
+###a block size of 7 pairs puts most samples across block boundaries, when the store is sorted and when the cells are counted
+@pytest.mark.parametrize('block_size', [7, 1000000])
+@pytest.mark.parametrize('y_axis_input, x_axis_input', AXES)
+def test_disk_engine_matches_pandas_engine(connection, synthetic_tables, tmp_path, y_axis_input, x_axis_input, block_size):
+    subjects_dict, samples_dict, sample_metadata = synthetic_tables
+    y_axis_key, total_tissue_list, tissue_color_dict = get_y_axis_labels(sample_metadata, y_axis_input, {})
+    for subject_id, sample_ids in samples_dict.items():
+        expected = summarize_subject(connection, subjects_dict[subject_id], sample_ids, sample_metadata, x_axis_input, y_axis_key, total_tissue_list, 'pandas')
+        summary = summarize_subject(connection, subjects_dict[subject_id], sample_ids, sample_metadata, x_axis_input, y_axis_key, total_tissue_list, 'disk',
+                                    chunk_size=block_size, store_dir=str(tmp_path))
+        assert_same_summary(summary, expected)
+    ###the stores are removed once they are counted
+    assert list(tmp_path.iterdir()) == []
+
+###a subject without samples, one whose samples have no clones, and one where only some samples have clones, given unsorted and with repeated pairs
+@pytest.mark.parametrize('case', ['no samples', 'no clones', 'some clones'])
+def test_disk_engine_matches_pandas_engine_without_clones(connection, synthetic_tables, case):
+    subjects_dict, samples_dict, sample_metadata = synthetic_tables
+    y_axis_key, total_tissue_list, tissue_color_dict = get_y_axis_labels(sample_metadata, 'tissue', {})
+    subject_id = next(iter(subjects_dict))
+    sample_ids = set() if case == 'no samples' else samples_dict[subject_id]
+    clone_membership = load_clone_membership(connection, sample_ids)
+    if case == 'no clones':
+        clone_membership = clone_membership.iloc[:0]
+    elif case == 'some clones':
+        kept = sorted(sample_ids)[::3]
+        clone_membership = clone_membership.loc[clone_membership['sample_id'].isin(kept)]
+        clone_membership = pd.concat([clone_membership, clone_membership.iloc[::5]]).iloc[::-1].reset_index(drop=True)
+    summaries = [summarize_subject(None, subjects_dict[subject_id], sample_ids, sample_metadata, 'timepoint', y_axis_key, total_tissue_list, aggregation_engine,
+                                   chunk_size=7, load_clones=lambda: clone_membership) for aggregation_engine in ('pandas', 'disk')]
+    assert_same_summary(summaries[1], summaries[0])
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+An incremental run must only download the clones of new or changed samples, and still draw the same chart as a full run.
+"""
+
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import clonechart.chart
+from clonechart.chart import make_clone_distribution_chart
+from clonechart.connection import Connection
+
+
+###a new sample of subject 1 with the metadata of its first sample, and the clones of that sample and some new ones. Returns its id.
+def add_sample(db, name, clone_offset):
+    sample_id = db.execute("insert into samples (name, subject_id) values (?, 1)", (name,)).lastrowid
+    db.execute("insert into sample_metadata (sample_id, key, value) select ?, key, value from sample_metadata where sample_id = 1", (sample_id,))
+    db.execute("insert into sequences (seq_id, sample_id, clone_id, copy_number) select seq_id || ?, ?, clone_id + ?, copy_number from sequences where sample_id = 1",
+               (name, sample_id, clone_offset))
+    db.execute("insert into clone_stats (clone_id, sample_id, unique_cnt, total_cnt) select distinct clone_id, sample_id, 1, 1 from sequences where sample_id = ?", (sample_id,))
+    return sample_id
+
+def remove_sample(db, sample_id):
+    for table, column in (('samples', 'id'), ('sample_metadata', 'sample_id'), ('sequences', 'sample_id'), ('clone_stats', 'sample_id')):
+        db.execute("delete from {} where {} = ?".format(table, column), (sample_id,))
+
+def add_two_samples(db):
+    return [add_sample(db, 'added 1', 0), add_sample(db, 'added 2', 1000000)]
+
+###the same number of samples, with another one in place of the second sample of subject 1
+def replace_sample(db):
+    remove_sample(db, db.execute("select min(id) from samples where subject_id = 1 and id > 1").fetchone()[0])
+    return [add_sample(db, 'replacement', 2000000)]
+
+###a corrected tissue, which changes no row count and no clones
+def edit_metadata(db):
+    db.execute("update sample_metadata set value = (select value from sample_metadata where key = 'tissue' and value != "
+               "(select value from sample_metadata where sample_id = 1 and key = 'tissue') limit 1) where sample_id = 1 and key = 'tissue'")
+    return []
+
+###the clones of the first sample of subject 1 imported again, without changing its row in the samples table
+def reimport_clones(db):
+    db.execute("insert into sequences (seq_id, sample_id, clone_id, copy_number) select seq_id || ' again', sample_id, clone_id + 3000000, copy_number from sequences where sample_id = 1")
+    db.execute("insert into clone_stats (clone_id, sample_id, unique_cnt, total_cnt) select distinct clone_id, sample_id, 1, 1 from sequences where sample_id = 1 and clone_id > 3000000")
+    return [1]
+
+@pytest.mark.parametrize('change', [add_two_samples, replace_sample, edit_metadata, reimport_clones])
+def test_incremental_run_matches_full_run(synthetic_copy, tmp_path, monkeypatch, change):
+    downloads = []
+    load_clone_membership = clonechart.chart.load_clone_membership
+    def record_download(connection, sample_ids, *args):
+        downloads.append(sorted(sample_ids))
+        return load_clone_membership(connection, sample_ids, *args)
+    monkeypatch.setattr(clonechart.chart, 'load_clone_membership', record_download)
+    def make_chart(**kwargs):
+        with Connection(url='sqlite:///' + synthetic_copy) as connection:
+            return make_clone_distribution_chart(None, None, None, 'tissue', 'timepoint', None, {}, connection=connection, **kwargs)
+
+    cache_dir = str(tmp_path / 'cache')
+    make_chart(cache_dir=cache_dir, incremental=True)
+    db = sqlite3.connect(synthetic_copy)
+    changed_samples = change(db)
+    db.commit()
+    db.close()
+    del downloads[:]
+    summaries = make_chart(cache_dir=cache_dir, incremental=True)
+    ###only the new samples are downloaded, and nothing at all for a metadata edit
+    assert downloads == ([sorted(changed_samples)] if changed_samples else [])
+    expected = make_chart()
+    assert list(summaries) == list(expected)
+    for subject_id, summary in expected.items():
+        pd.testing.assert_frame_equal(summaries[subject_id].distribution_chart, summary.distribution_chart)
+        assert summaries[subject_id].num_clones == summary.num_clones
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Choice of the clone source and download of the clone membership.
+"""
+
+import shutil
+import sqlite3
+
+import pytest
+
+from clonechart.connection import Connection
+from clonechart.loading import get_clone_source, load_clone_membership
+
+
+def test_auto_clone_source_uses_complete_clone_stats(connection):
+    assert get_clone_source(connection, 'auto') == 'clone_stats'
+
+def test_auto_clone_source_falls_back_when_samples_are_missing(synthetic_path, tmp_path):
+    ###a sample imported after immunedb_clone_stats last ran has sequences but no clone_stats rows
+    path = str(tmp_path / 'partial.sqlite')
+    shutil.copy(synthetic_path, path)
+    db = sqlite3.connect(path)
+    db.execute("delete from clone_stats where sample_id = (select max(sample_id) from sequences)")
+    db.commit()
+    db.close()
+    with Connection(url='sqlite:///' + path) as connection:
+        assert get_clone_source(connection, 'auto') == 'sequences'
+
+###a shard size that divides the samples of a subject, one that doesn't, and one sample per shard
+@pytest.mark.parametrize('shard_size', [1, 7, 12])
+def test_sharded_download_matches_unsharded(connection, synthetic_tables, shard_size):
+    subjects_dict, samples_dict, sample_metadata = synthetic_tables
+    for subject_id in subjects_dict:
+        unsharded = load_clone_membership(connection, samples_dict[subject_id], 'sequences', shard_size=0)
+        ###a small chunk size, so that the shards are read in several chunks
+        sharded = load_clone_membership(connection, samples_dict[subject_id], 'sequences', chunk_size=50, shard_size=shard_size, shard_workers=2)
+        assert sharded.duplicated().sum() == 0
+        assert set(map(tuple, sharded[['sample_id', 'clone_id']].to_numpy())) == set(map(tuple, unsharded[['sample_id', 'clone_id']].to_numpy()))
+        assert sharded['clone_id'].nunique() == unsharded['clone_id'].nunique()
+        assert (sharded.groupby('sample_id')['clone_id'].nunique() == unsharded.groupby('sample_id')['clone_id'].nunique()).all()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+The compact rendering must draw the same chart as the original one.
+"""
+
+import pytest
+
+from clonechart.chart import get_y_axis_labels, make_clone_distribution_chart
+from clonechart.render import check_compact_rendering
+from clonechart.synthetic import SYNTHETIC_TISSUES
+
+
+###blood first and the gut last, like the tissue_color_dict of the settings script, with allografted tissues that get an outline
+TISSUE_COLORS = {x: '#{:06X}'.format(0x102030 * (i + 1)) for i, x in enumerate(SYNTHETIC_TISSUES)}
+
+@pytest.mark.parametrize('y_axis_input, x_axis_input, tissue_color_dict', [
+    ('tissue', 'timepoint', {}),
+    ('tissue', 'timepoint', TISSUE_COLORS),
+    ('tissue', 'pod', TISSUE_COLORS),
+    ('tissue', 'None', TISSUE_COLORS),
+    ('None', 'timepoint', TISSUE_COLORS),
+])
+def test_compact_rendering_matches_original(connection, synthetic_tables, y_axis_input, x_axis_input, tissue_color_dict):
+    subjects_dict, samples_dict, sample_metadata = synthetic_tables
+    y_axis_key, total_tissue_list, tissue_color_dict = get_y_axis_labels(sample_metadata, y_axis_input, dict(tissue_color_dict))
+    assert any('allograft' in x for x in total_tissue_list) == (y_axis_input != 'None')
+    ###the chart is only counted here, not written
+    summaries = make_clone_distribution_chart(None, None, None, y_axis_input, x_axis_input, None, dict(tissue_color_dict), aggregation_engine='sql', connection=connection)
+    assert check_compact_rendering(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, connection.name) == []
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+The chart service: its memory cache, the charts it draws and the answers of its HTTP server, on the synthetic database.
+"""
+
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+
+import pytest
+
+from clonechart.chart import make_clone_distribution_chart
+from clonechart.connection import Connection
+from clonechart.service import ChartServer, ChartService, MemoryLRU
+
+
+def test_memory_lru_drops_least_recently_used():
+    memory = MemoryLRU(3)
+    for key in 'abc':
+        memory.put(key, key, 1)
+    assert memory.get('a') == 'a'
+    ###b and c are dropped, a was used after them
+    memory.put('d', 'd', 1.5)
+    assert [x for x, y in memory.items()] == ['a', 'd']
+    assert memory.get('b') is None
+    assert (memory.hits, memory.misses) == (1, 1)
+    ###an entry bigger than the budget is kept until the next one is added
+    memory.put('e', 'e', 10)
+    assert [x for x, y in memory.items()] == ['e']
+
+def test_memory_lru_loads_once_and_keeps_no_locks():
+    memory = MemoryLRU(100)
+    loads = []
+    def load():
+        loads.append(1)
+        time.sleep(0.05)
+        return b'value'
+    threads = [threading.Thread(target=memory.get_or_load, args=('key', load)) for x in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    for i in range(100):
+        memory.get_or_load(('chart', i), lambda: b'x' * 10)
+    with pytest.raises(ZeroDivisionError):
+        memory.get_or_load('broken', lambda: 1 / 0)
+    assert len(memory._load_locks) == 0
+
+@pytest.fixture
+def service(synthetic_path):
+    connection = Connection(url='sqlite:///' + synthetic_path)
+    with ChartService({'synthetic': connection}, memory_budget_mb=512, plotlyjs='cdn') as service:
+        yield service
+
+def test_service_charts_are_cached(service, connection):
+    page = service.get_chart('synthetic', 'tissue', 'timepoint')
+    assert b'<html' in page
+    misses = service.memory.misses
+    assert service.get_chart('synthetic', 'tissue', 'timepoint') == page
+    assert service.memory.misses == misses
+    ###another chart of the same database is counted from the clone matrices in memory
+    kinds = [x[0] for x, y in service.memory.items()]
+    service.get_chart('synthetic', 'None', 'timepoint')
+    assert [x[0] for x, y in service.memory.items()].count('clones') == kinds.count('clones')
+    assert 'tissue' in service.get_labels('synthetic')
+    with pytest.raises(KeyError):
+        service.get_chart('missing', 'tissue', 'timepoint')
+    with pytest.raises(ValueError):
+        service.get_chart('synthetic', 'no_such_label', 'timepoint')
+    service.reload('synthetic')
+    assert service.memory.items() == []
+
+###The service counts the same clones as make_clone_distribution_chart: its dataset and clone matrices give the same summaries.
+def test_service_dataset_matches_chart(service, connection):
+    dataset = service.get_dataset('synthetic')
+    expected = make_clone_distribution_chart(None, None, None, 'tissue', 'timepoint', None, {}, aggregation_engine='sql', clone_source='auto', connection=connection)
+    assert sorted(dataset.subjects_dict) == sorted(expected)
+    for subject_id in dataset.subjects_dict:
+        assert len(service.get_clone_matrix('synthetic', dataset, subject_id).clone_ids) == expected[subject_id].num_clones
+
+@pytest.fixture
+def server_url(service):
+    server = ChartServer(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+def request(url, method='GET'):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method=method)) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def test_http_answers(server_url):
+    status, body = request(server_url + '/chart?' + urlencode({'database': 'synthetic', 'y': 'tissue', 'x': 'timepoint', 'colors': json.dumps({'PBMC': '#FF0000'})}))
+    assert status == 200 and b'<html' in body
+    status, body = request(server_url + '/labels?database=synthetic')
+    assert status == 200 and 'timepoint' in json.loads(body)
+    assert request(server_url + '/chart?database=missing')[0] == 404
+    assert request(server_url + '/chart?database=synthetic&y=no_such_label')[0] == 400
+    assert request(server_url + '/chart?database=synthetic&colors=not-json')[0] == 400
+    assert request(server_url + '/no_such_path')[0] == 404
+    status, body = request(server_url + '/status')
+    assert status == 200 and len(json.loads(body)['entries']) > 0
+    status, body = request(server_url + '/reload?database=synthetic', 'POST')
+    assert status == 200 and json.loads(body) == {'reloaded': 'synthetic'}
+    assert json.loads(request(server_url + '/status')[1])['entries'] == []
+    assert request(server_url + '/reload?database=missing', 'POST')[0] == 404
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+The "approximate" aggregation engine must stay within MAX_APPROXIMATION_ERROR standard errors of the exact clone counts.
+"""
+
+import numpy as np
+import pytest
+
+from clonechart.chart import make_clone_distribution_chart
+from clonechart.sketch import (MAX_APPROXIMATION_ERROR, add_to_sketches, check_approximate_summaries, estimate_distinct, get_relative_error, load_clone_sketches,
+                               make_clone_sketches)
+
+
+@pytest.mark.parametrize('y_axis_input, x_axis_input', [('tissue', 'timepoint'), ('None', 'timepoint'), ('tissue', 'None')])
+def test_approximate_engine_is_within_bound(connection, y_axis_input, x_axis_input):
+    exact = make_clone_distribution_chart(None, None, None, y_axis_input, x_axis_input, None, {}, aggregation_engine='sql', connection=connection)
+    approximate = make_clone_distribution_chart(None, None, None, y_axis_input, x_axis_input, None, {}, aggregation_engine='approximate', connection=connection)
+    check = check_approximate_summaries(approximate, exact)
+    assert check.num_counts > 0
+    assert check.max_error <= MAX_APPROXIMATION_ERROR
+
+def test_estimate_of_many_clones_is_within_bound():
+    sketches = make_clone_sketches([1])
+    clone_ids = np.arange(1, 200001)
+    add_to_sketches(sketches, np.ones(len(clone_ids), dtype=np.int64), clone_ids)
+    estimate = estimate_distinct(sketches.registers)[0]
+    assert abs(estimate - len(clone_ids)) <= MAX_APPROXIMATION_ERROR * get_relative_error() * len(clone_ids)
+
+def test_sharded_sketches_match_unsharded(connection, synthetic_tables):
+    subjects_dict, samples_dict, sample_metadata = synthetic_tables
+    sample_ids = samples_dict[next(iter(subjects_dict))]
+    unsharded = load_clone_sketches(connection, sample_ids)
+    sharded = load_clone_sketches(connection, sample_ids, shard_size=5, shard_workers=2)
+    assert (sharded.sample_ids == unsharded.sample_ids).all()
+    assert (sharded.registers == unsharded.registers).all()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+A chart summary must read back as the summaries it was written from, and draw the same chart as the database when it is restyled.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from clonechart.chart import make_clone_distribution_chart
+from clonechart.render import build_clone_distribution_figure, get_visible_output
+from clonechart.summary import read_chart_summary, render_chart_summary, restyle_chart_summary
+from clonechart.synthetic import SYNTHETIC_TISSUES
+
+
+TISSUE_COLORS = {x: '#{:06X}'.format(0x102030 * (i + 1)) for i, x in enumerate(SYNTHETIC_TISSUES)}
+###fewer labels, in another order and with other colors
+NEW_TISSUE_COLORS = {x: '#{:06X}'.format(0x0A0B0C * (i + 1)) for i, x in enumerate(SYNTHETIC_TISSUES[::-2])}
+
+def get_figure_output(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database):
+    return get_visible_output(build_clone_distribution_figure(summaries, subjects_dict, total_tissue_list, tissue_color_dict, x_axis_input, database, compact=True))
+
+@pytest.mark.parametrize('x_axis_input', ['timepoint', 'None'])
+def test_summary_round_trip_and_restyle(connection, tmp_path, x_axis_input):
+    summary_path = str(tmp_path / 'summary.json')
+    summaries = make_clone_distribution_chart(None, None, None, 'tissue', x_axis_input, None, dict(TISSUE_COLORS), aggregation_engine='sql', connection=connection,
+                                              summary_path=summary_path)
+    chart_summary = read_chart_summary(summary_path)
+    assert list(chart_summary.summaries) == list(summaries)
+    assert chart_summary.total_tissue_list == list(TISSUE_COLORS)[::-1]
+    assert chart_summary.tissue_color_dict == TISSUE_COLORS
+    for subject_id, summary in summaries.items():
+        read_summary = chart_summary.summaries[subject_id]
+        pd.testing.assert_frame_equal(read_summary.distribution_chart, summary.distribution_chart, check_dtype=False)
+        assert read_summary.num_clones == summary.num_clones
+        assert list(read_summary.x_axis_values_sorted) == list(summary.x_axis_values_sorted)
+
+    ###restyled, the summary draws what a new run with the new colors draws
+    restyled = restyle_chart_summary(chart_summary, NEW_TISSUE_COLORS)
+    live = make_clone_distribution_chart(None, None, None, 'tissue', x_axis_input, None, dict(NEW_TISSUE_COLORS), aggregation_engine='sql', connection=connection)
+    new_tissue_list = list(NEW_TISSUE_COLORS)[::-1]
+    assert restyled.total_tissue_list == new_tissue_list
+    assert (get_figure_output(restyled.summaries, restyled.subjects_dict, restyled.total_tissue_list, restyled.tissue_color_dict, x_axis_input, restyled.database)
+            == get_figure_output(live, chart_summary.subjects_dict, new_tissue_list, NEW_TISSUE_COLORS, x_axis_input, connection.name))
+
+    output_path = str(tmp_path / 'chart.html')
+    render_chart_summary(summary_path, output_path, NEW_TISSUE_COLORS, plotlyjs='cdn')
+    assert os.path.getsize(output_path) > 0